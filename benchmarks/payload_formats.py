@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# Compares the XML and JSON payload builders on a typical user message.
+# Run from the repository root: python benchmarks/payload_formats.py [iterations]
+import json
+import sys, os
+import timeit
+
+sys.path.append(os.getcwd())
+sys.path.append(os.path.join(os.getcwd(), 'src'))
+from xml_parser import write_xml_user, read_xml_payload
+from json_payload import write_json_user
+
+ITERATIONS = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+variables = {
+    'id': 'a01', 'first_name': 'Jan', 'last_name': 'Peeters', 'email': 'jan.peeters@example.com',
+    'telephone': '+32470123456', 'birthday': '1990-01-01', 'country': 'Belgium', 'state': 'Brussels',
+    'city': 'Brussels', 'zip': '1000', 'street': 'Nijverheidskaai', 'house_number': '170',
+    'company_email': 'jan@intratech.be', 'company_id': 'a02', 'source': 'frontend', 'user_role': 'Speaker',
+    'invoice': 'BE0123456789', 'calendar_link': 'https://calendar.example.com/jan',
+}
+
+cases = {
+    # Building the request body sent by the single-record REST calls
+    'xml body': lambda: write_xml_user(**variables).encode('utf-8'),
+    'json body': lambda: json.dumps(write_json_user(**variables)).encode('utf-8'),
+    # Building the record handed to the Collections and Composite endpoints
+    'xml record': lambda: read_xml_payload(write_xml_user(**variables)),
+    'json record': lambda: write_json_user(**variables),
+}
+
+if __name__ == '__main__':
+    for name, case in cases.items():
+        seconds = min(timeit.repeat(case, number=ITERATIONS, repeat=3))
+        print(f"{name:12} {seconds / ITERATIONS * 1e6:8.2f} us/payload")
@@ -3,4 +3,60 @@ KEY_FILE = '{SALESFORCE_KEY_FILE}'
 ISSUER = '{SALESFORCE_CONSUMER_KEY}'
 SUBJECT = '{SALESFORCE_SUBJECT}'
 DOMAIN_NAME = '{SALESFORCE_DOMAIN_NAME}'
-ACCESS_TOKEN = ''
\ No newline at end of file
+ACCESS_TOKEN = ''
+SALESFORCE_POOL_SIZE = 10
+SALESFORCE_TIMEOUT = (5, 30)
+COLLECTIONS_BATCHING = False
+COLLECTIONS_FLUSH_SIZE = 200
+COLLECTIONS_FLUSH_INTERVAL = 1.0
+SALESFORCE_SESSION_TIMEOUT = 7200
+SALESFORCE_REFRESH_MARGIN = 300
+BULK_MODE_THRESHOLD = 0
+BULK_FLUSH_SIZE = 10000
+BULK_FLUSH_INTERVAL = 30.0
+BULK_CHECK_INTERVAL = 5
+BULK_POLL_INTERVAL = 2.0
+BULK_JOB_TIMEOUT = 600
+ASYNC_POOL_SIZE = 50
+ASYNC_MAX_CONCURRENCY = 25
+UPSERT_BY_MASTER_UUID = False
+MASTER_UUID_FIELD = 'master_uuid__c'
+SALESFORCE_API_BUDGET = 0.8
+SALESFORCE_API_RAMP = 0.1
+SALESFORCE_OVER_BUDGET_PACE = 1.0
+CONSUMER_METRICS_PORT = 9966
+PUBLISHER_METRICS_PORT = 9967
+RETRY_ATTEMPTS = 3
+RETRY_BASE_DELAY = 0.2
+RETRY_MAX_DELAY = 5.0
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_TIMEOUT = 30.0
+FINGERPRINT_CACHE_SIZE = 10000
+FINGERPRINT_TTL = 3600
+PAYLOAD_FORMAT = 'json'
+SOBJECTS = {'user': 'user__c', 'company': 'Company__c', 'event': 'event__c', 'attendance': 'attendance__c', 'product': 'product__c', 'order': 'order__c'}
+SALESFORCE_GZIP_THRESHOLD = 1024
+SALESFORCE_GZIP_LEVEL = 6
+UUID_CACHE_SIZE = 10000
+UUID_CACHE_TTL = 3600
+UUID_BATCH_ENDPOINT = None
+UUID_LOOKUP_CONCURRENCY = 8
+UUID_STORE_PATH = '/var/lib/crm/uuid_mappings.db'
+UUID_NEGATIVE_TTL = 5
+UUID_PARK_TIMEOUT = 30
+UUID_PARK_LIMIT = 1000
+UUID_POOL_SIZE = 10
+UUID_TIMEOUT = (2, 10)
+MAPPING_SYNC_RETRY_DELAY = 5
+UUID_ADD_BATCH_ENDPOINT = None
+UUID_WRITE_BEHIND = True
+UUID_OUTBOX_FLUSH_SIZE = 100
+UUID_OUTBOX_FLUSH_INTERVAL = 0.5
+UUID_OUTBOX_MAX_DELAY = 300
+CONSUMER_PREFETCH = 20
+CONSUMER_LANES = 8
+CONSUMER_BATCH_SIZE = 0
+CONSUMER_BATCH_WAIT = 0.05
+SALESFORCE_CLIENT_NAME = 'crm-integration'
+ORDER_INDEX_SIZE = 10000
+ORDER_INDEX_TTL = 3600
\ No newline at end of file
@@ -1,8 +1,8 @@
-import requests
-from datetime import datetime
-import xml.etree.ElementTree as ET
-import jwt
+import gzip
+import json
+import time
 import sys, os
+from urllib.parse import urlparse
 
 if os.path.isdir('/app'):
     sys.path.append('/app')
@@ -12,219 +12,392 @@ else:
 import config.secrets as secrets
 from xml_parser import *
 from logger import init_logger
+from http_session import create_session
+from token_manager import TokenManager
+from rate_limiter import AdaptiveLimiter
+import resilience
+import metrics
+from fingerprint import PayloadFingerprints
+from change_events import CALL_OPTIONS
+
+# Connection pool settings for the Salesforce REST API
+SALESFORCE_POOL_SIZE = getattr(secrets, 'SALESFORCE_POOL_SIZE', 10)
+SALESFORCE_TIMEOUT = getattr(secrets, 'SALESFORCE_TIMEOUT', (5, 30))
+
+# Request bodies of at least this many bytes are sent gzip-compressed (0 disables compression)
+SALESFORCE_GZIP_THRESHOLD = getattr(secrets, 'SALESFORCE_GZIP_THRESHOLD', 1024)
+SALESFORCE_GZIP_LEVEL = getattr(secrets, 'SALESFORCE_GZIP_LEVEL', 6)
+
+# Shared keep-alive session, the Authorization header is attached once by authenticate().
+# The call options tag our writes, so the publisher can tell their change events apart
+salesforce_session = create_session(SALESFORCE_POOL_SIZE, {'Accept-Encoding': 'gzip', **CALL_OPTIONS})
+
+# Slow down once this share of the org's daily API requests is used, gradually over the last SALESFORCE_API_RAMP before it
+SALESFORCE_API_BUDGET = getattr(secrets, 'SALESFORCE_API_BUDGET', 0.8)
+SALESFORCE_API_RAMP = getattr(secrets, 'SALESFORCE_API_RAMP', 0.1)
+SALESFORCE_OVER_BUDGET_PACE = getattr(secrets, 'SALESFORCE_OVER_BUDGET_PACE', 1.0)
+limiter = AdaptiveLimiter(SALESFORCE_API_BUDGET, SALESFORCE_POOL_SIZE, 1, SALESFORCE_OVER_BUDGET_PACE, SALESFORCE_API_RAMP)
+
+# Hashes of the last payload written per record id, identical updates are not sent again
+FINGERPRINT_CACHE_SIZE = getattr(secrets, 'FINGERPRINT_CACHE_SIZE', 10000)
+FINGERPRINT_TTL = getattr(secrets, 'FINGERPRINT_TTL', 3600)
+payload_fingerprints = PayloadFingerprints(FINGERPRINT_CACHE_SIZE, FINGERPRINT_TTL)
 
 ##############################
 ## Authentication API Calls ##
 ##############################
 
-# Get the access token and domain name
+# Salesforce sessions expire after the org's session timeout, the token is renewed this many seconds before that
+SALESFORCE_SESSION_TIMEOUT = getattr(secrets, 'SALESFORCE_SESSION_TIMEOUT', 7200)
+SALESFORCE_REFRESH_MARGIN = getattr(secrets, 'SALESFORCE_REFRESH_MARGIN', 300)
+TOKEN_URL = 'https://erasmushogeschoolbrussel4-dev-ed.develop.my.salesforce.com/services/oauth2/token'
+
+token_manager = None
+
+# Store a new access token and attach it to the shared session
+def set_access_token(token):
+    secrets.ACCESS_TOKEN = token
+    salesforce_session.headers['Authorization'] = 'Bearer ' + token
+
+# Get the access token and keep it fresh in the background
 def authenticate():
-    with open(secrets.KEY_FILE) as file:
-        private_key = file.read()
-
-    claimSet = {
-        'iss': secrets.ISSUER,
-        'exp': int(datetime.now().timestamp()) + 300,
-        'aud': 'https://login.salesforce.com',
-        'sub': secrets.SUBJECT
-    }
+    global token_manager
+    if token_manager is None:
+        token_manager = TokenManager(secrets.KEY_FILE, secrets.ISSUER, secrets.SUBJECT, TOKEN_URL,
+                                     SALESFORCE_SESSION_TIMEOUT, SALESFORCE_REFRESH_MARGIN)
+        token_manager.add_listener(set_access_token)
+    token_manager.get_token()
+    token_manager.start()
 
-    assertion = jwt.encode(claimSet, private_key, algorithm='RS256', headers={'alg': 'RS256'})
+# Only these methods are retried after the request may have reached Salesforce
+IDEMPOTENT_METHODS = {'GET', 'PUT', 'PATCH', 'DELETE'}
 
-    req = requests.post('https://erasmushogeschoolbrussel4-dev-ed.develop.my.salesforce.com/services/oauth2/token',
-                        data={
-                            'grant_type': 'urn:ietf:params:oauth:grant-type:jwt-bearer',
-                            'assertion': assertion
-                        })
+# Send a request to the Salesforce REST API over the shared session, with retries behind the 'salesforce' circuit breaker
+def salesforce_request(method, path, **kwargs):
+    kwargs.setdefault('timeout', SALESFORCE_TIMEOUT)
+    headers = dict(kwargs.pop('headers', None) or {})
+    # Payloads are sent as JSON when they are dicts, the write_xml_* strings are sent as XML
+    if isinstance(kwargs.get('data'), dict):
+        kwargs['json'] = kwargs.pop('data')
+    elif 'data' in kwargs:
+        headers.setdefault('Content-Type', 'application/xml')
+    encode_body(kwargs, headers)
+    kwargs['headers'] = headers
+    return resilience.call('salesforce', lambda: send_request(method, path, kwargs), idempotent=method in IDEMPOTENT_METHODS)
 
-    response = req.json()
-    secrets.ACCESS_TOKEN = response['access_token']
-    logger.info("Authenticated successfully")
+def send_request(method, path, kwargs):
+    limiter.acquire()
+    try:
+        response = salesforce_session.request(method, secrets.DOMAIN_NAME + path, **kwargs)
+
+        # An expired session is refreshed once and the request is sent again
+        if response.status_code == 401 and token_manager is not None:
+            rejected_token = response.request.headers.get('Authorization', '').removeprefix('Bearer ')
+            token_manager.invalidate(rejected_token)
+            response = salesforce_session.request(method, secrets.DOMAIN_NAME + path, **kwargs)
+    finally:
+        limiter.release()
+    limiter.observe(response.headers.get('Sforce-Limit-Info'))
+    record_response_size(response)
+    return response
+
+# Serialize the request body to bytes and gzip it when it is large enough to be worth it, updates kwargs and headers in place
+def encode_body(kwargs, headers):
+    if 'json' in kwargs:
+        kwargs['data'] = json.dumps(kwargs.pop('json')).encode('utf-8')
+        headers.setdefault('Content-Type', 'application/json')
+    body = kwargs.get('data')
+    if body is None:
+        return
+    if isinstance(body, str):
+        body = kwargs['data'] = body.encode('utf-8')
+    if SALESFORCE_GZIP_THRESHOLD <= 0 or len(body) < SALESFORCE_GZIP_THRESHOLD:
+        record_size('request', len(body), len(body))
+        return
+
+    compressed = gzip.compress(body, SALESFORCE_GZIP_LEVEL)
+    if len(compressed) >= len(body):
+        record_size('request', len(body), len(body))
+        return
+    kwargs['data'] = compressed
+    headers['Content-Encoding'] = 'gzip'
+    record_size('request', len(body), len(compressed))
+
+# Compare the decoded response body with the bytes that came over the wire
+def record_response_size(response):
+    size = len(response.content)
+    tell = getattr(response.raw, 'tell', None)
+    wire_size = tell() if tell is not None and response.headers.get('Content-Encoding') == 'gzip' else size
+    record_size('response', size, wire_size)
+
+# Body and wire sizes per direction, the difference is what gzip saved
+def record_size(direction, size, wire_size):
+    metrics.inc('crm_salesforce_body_bytes_total', size, direction=direction)
+    metrics.inc('crm_salesforce_wire_bytes_total', wire_size, direction=direction)
+    if wire_size < size:
+        metrics.inc('crm_salesforce_gzip_saved_bytes_total', size - wire_size, direction=direction)
 
 ########################
 ## Consumer API Calls ##
 ########################
 
+# Upserts find records by the master UUID stored in this external id field
+MASTER_UUID_FIELD = getattr(secrets, 'MASTER_UUID_FIELD', 'master_uuid__c')
+
+# sObject type of every entity we write to Salesforce, a new entity only needs an entry here
+SOBJECTS = getattr(secrets, 'SOBJECTS', {
+    'user': 'user__c',
+    'company': 'Company__c',
+    'event': 'event__c',
+    'attendance': 'attendance__c',
+    'product': 'product__c',
+    'order': 'order__c',
+})
+
+# Count every call and its latency per sObject type and operation, errors are counted separately for the error rate
+def record_call(sobject, operation, started, ok):
+    metrics.inc('crm_sobject_calls_total', sobject=sobject, operation=operation)
+    metrics.observe('crm_sobject_call_seconds', time.monotonic() - started, sobject=sobject, operation=operation)
+    if not ok:
+        metrics.inc('crm_sobject_errors_total', sobject=sobject, operation=operation)
+
+# Send a Salesforce request on behalf of one sObject type and record the call
+def sobject_request(sobject, operation, method, path, **kwargs):
+    started = time.monotonic()
+    ok = False
+    try:
+        response = salesforce_request(method, path, **kwargs)
+        ok = response.ok
+        return response
+    finally:
+        record_call(sobject, operation, started, ok)
+
+# Create, update, upsert, delete and query calls for one sObject type, with its endpoints built once
+class SObjectClient:
+    def __init__(self, sobject):
+        self.sobject = sobject
+        self.create_path = f'sobjects/{sobject}'
+        self.record_path = f'sobjects/{sobject}/'
+        self.upsert_path = f'sobjects/{sobject}/{MASTER_UUID_FIELD}/'
+        self.query_path = f'query?q=SELECT+{{}}+FROM+{sobject}+WHERE+{{}}'
+
+    # Create a record, returns its Salesforce id
+    def create(self, payload):
+        response = sobject_request(self.sobject, 'create', 'POST', self.create_path, data=payload)
+        return response.json().get('id', None)
+
+    # Update a record unless the payload matches the one last written to it
+    def update(self, id, payload):
+        if payload_fingerprints.unchanged(self.sobject, id, payload):
+            logger.debug(f"Skipping unchanged update of {self.sobject} {id}")
+            return
+        response = sobject_request(self.sobject, 'update', 'PATCH', self.record_path + id, data=payload)
+        if response.ok:
+            payload_fingerprints.remember(id, payload)
+        else:
+            payload_fingerprints.forget(id)
+
+    # Create or update a record by its master UUID in one call, returns the Salesforce id (None when an existing record was updated)
+    def upsert(self, master_uuid, payload):
+        response = sobject_request(self.sobject, 'upsert', 'PATCH', self.upsert_path + master_uuid, data=payload)
+        response.raise_for_status()
+        result = response.json() if response.content else {}
+        return result.get('id', None) if result.get('created', True) else None
+
+    def delete(self, id):
+        sobject_request(self.sobject, 'delete', 'DELETE', self.record_path + id)
+        payload_fingerprints.forget(id)
+
+    # Get the given fields of every record matching a SOQL condition
+    def query(self, fields, condition):
+        response = sobject_request(self.sobject, 'query', 'GET', self.query_path.format(','.join(fields), condition))
+        response.raise_for_status()
+        return response.json().get('records', [])
+
+sobjects = {entity: SObjectClient(sobject) for entity, sobject in SOBJECTS.items()}
+
 # Add an user api call
 def add_user(payload):
-    url = secrets.DOMAIN_NAME + 'sobjects/user__c'
-    headers = {
-        'Authorization': 'Bearer ' + secrets.ACCESS_TOKEN,
-        'Content-Type': 'application/xml'
-    }
-    response = requests.post(url, headers=headers, data=payload)
-    return response.json().get('id', None)
+    return sobjects['user'].create(payload)
 
 # Update an user api call
 def update_user(id, payload):
-    print("update user: " + id)
-    url = secrets.DOMAIN_NAME + f'sobjects/user__c/{id}'
-    headers = {
-        'Authorization': 'Bearer ' + secrets.ACCESS_TOKEN,
-        'Content-Type': 'application/xml'
-    }
-    requests.patch(url, headers=headers, data=payload)
+    sobjects['user'].update(id, payload)
 
 # Delete an user api call
 def delete_user(user_id):
-    url = secrets.DOMAIN_NAME + f'sobjects/user__c/{user_id}'
-    headers = {
-        'Authorization': 'Bearer ' + secrets.ACCESS_TOKEN,
-        'Content-Type': 'application/xml'
-    }
-    requests.delete(url, headers=headers)
+    sobjects['user'].delete(user_id)
 
 # Add a company api call
 def add_company(payload):
-    url = secrets.DOMAIN_NAME + f'sobjects/Company__c'
-    headers = {
-        'Authorization': 'Bearer ' + secrets.ACCESS_TOKEN,
-        'Content-Type': 'application/xml'
-    }
-    response = requests.post(url, headers=headers, data=payload)
-    return response.json().get('id', None)
+    return sobjects['company'].create(payload)
 
 # Update a company api call
 def update_company(id, payload):
-    url = secrets.DOMAIN_NAME + f'sobjects/Company__c/{id}'
-    headers = {
-        'Authorization': 'Bearer ' + secrets.ACCESS_TOKEN,
-        'Content-Type': 'application/xml'
-    }
-    requests.patch(url, headers=headers, data=payload)
+    sobjects['company'].update(id, payload)
 
 # Delete a company api call
 def delete_company(company_id):
-    url = secrets.DOMAIN_NAME + f'sobjects/company__c/{company_id}'
-    headers = {
-        'Authorization': 'Bearer ' + secrets.ACCESS_TOKEN,
-        'Content-Type': 'application/xml'
-    }
-    requests.delete(url, headers=headers)
+    sobjects['company'].delete(company_id)
 
 # Add an event api call
 def add_event(payload):
-    url = secrets.DOMAIN_NAME + f'sobjects/event__c'
-    headers = {
-        'Authorization': 'Bearer ' + secrets.ACCESS_TOKEN,
-        'Content-Type': 'application/xml'
-    }
-    response = requests.post(url, headers=headers, data=payload)
-    return response.json().get('id', None)
+    return sobjects['event'].create(payload)
 
 # Update an event api call
 def update_event(id, payload):
-    url = secrets.DOMAIN_NAME + f'sobjects/event__c/{id}'
-    headers = {
-        'Authorization': 'Bearer ' + secrets.ACCESS_TOKEN,
-        'Content-Type': 'application/xml'
-    }
-    requests.patch(url, headers=headers, data=payload)
+    sobjects['event'].update(id, payload)
 
 # Delete an event api call
 def delete_event(event_id):
-    url = secrets.DOMAIN_NAME + f'sobjects/event__c/{event_id}'
-    headers = {
-        'Authorization': 'Bearer ' + secrets.ACCESS_TOKEN,
-        'Content-Type': 'application/xml'
-    }
-    requests.delete(url, headers=headers)
+    sobjects['event'].delete(event_id)
 
 # Add an attendance
 def add_attendance(payload):
-    url = secrets.DOMAIN_NAME + f'sobjects/attendance__c'
-    headers = {
-        'Authorization': 'Bearer ' + secrets.ACCESS_TOKEN,
-        'Content-Type': 'application/xml'
-    }
-    response = requests.post(url, headers=headers, data=payload)
-    return response.json().get('id', None)
+    return sobjects['attendance'].create(payload)
 
 # Update an attendance
 def update_attendance(id, payload):
-    url = secrets.DOMAIN_NAME + f'sobjects/attendance__c/{id}'
-    headers = {
-        'Authorization': 'Bearer ' + secrets.ACCESS_TOKEN,
-        'Content-Type': 'application/xml'
-    }
-    requests.patch(url, headers=headers, data=payload)
+    sobjects['attendance'].update(id, payload)
 
 # Delete an attendance api call
 def delete_attendance(attendance_id):
-    url = secrets.DOMAIN_NAME + f'sobjects/attendance__c/{attendance_id}'
-    headers = {
-        'Authorization': 'Bearer ' + secrets.ACCESS_TOKEN,
-        'Content-Type': 'application/xml'
-    }
-    requests.delete(url, headers=headers)
+    sobjects['attendance'].delete(attendance_id)
 
 # Add a product
 def add_product(payload):
-    url = secrets.DOMAIN_NAME + f'sobjects/product__c'
-    headers = {
-        'Authorization': 'Bearer ' + secrets.ACCESS_TOKEN,
-        'Content-Type': 'application/xml'
-    }
-    response = requests.post(url, headers=headers, data=payload)
-    return response.json().get("id", None)
+    return sobjects['product'].create(payload)
 
 # Update a product
 def update_product(id, payload):
-    url = secrets.DOMAIN_NAME + f'sobjects/product__c/{id}'
-    headers = {
-        'Authorization': 'Bearer ' + secrets.ACCESS_TOKEN,
-        'Content-Type': 'application/xml'
-    }
-    requests.patch(url, headers=headers, data=payload)
+    sobjects['product'].update(id, payload)
 
 # Add an order
 def add_order(payload):
-    url = secrets.DOMAIN_NAME + f'sobjects/order__c'
-    headers = {
-        'Authorization': 'Bearer ' + secrets.ACCESS_TOKEN,
-        'Content-Type': 'application/xml'
-    }
-    requests.post(url, headers=headers, data=payload)
+    return sobjects['order'].create(payload)
 
 def update_order(id, payload):
-    url = secrets.DOMAIN_NAME + f'sobjects/order__c/{id}'
-    headers = {
-        'Authorization': 'Bearer ' + secrets.ACCESS_TOKEN,
-        'Content-Type': 'application/xml'
-    }
-    requests.patch(url, headers=headers, data=payload)
+    sobjects['order'].update(id, payload)
 
 # Get order from user to change amount
 def get_order_user(user_id, product_id):
-    url = secrets.DOMAIN_NAME + f'query?q=SELECT+Id,amount__c+FROM+order__c+WHERE+user_id__c=\'{user_id}\'AND+product_id__c=\'{product_id}\''
-    headers = {
-        'Authorization': 'Bearer ' + secrets.ACCESS_TOKEN,
-        'Content-Type': 'application/xml'
-    }
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-    data = response.json().get("records", [])
-
-    if data:
-        return data[0]['Id'], data[0]['amount__c']
+    records = sobjects['order'].query(['Id', 'amount__c'], f"user_id__c='{user_id}'+AND+product_id__c='{product_id}'")
+    if records:
+        return records[0]['Id'], records[0]['amount__c']
     else:
         return None, None
-    
+
 # Get order from company to change amount
 def get_order_company(company_id, product_id):
-    url = secrets.DOMAIN_NAME + f'query?q=SELECT+Id,amount__c+FROM+order__c+WHERE+company_id__c=\'{company_id}\'AND+product_id__c=\'{product_id}\''
-    headers = {
-        'Authorization': 'Bearer ' + secrets.ACCESS_TOKEN,
-        'Content-Type': 'application/xml'
+    records = sobjects['order'].query(['Id', 'amount__c'], f"company_id__c='{company_id}'+AND+product_id__c='{product_id}'")
+    if records:
+        return records[0]['Id'], records[0]['amount__c']
+    else:
+        return None, None
+
+######################
+## Upsert API Calls ##
+######################
+
+def upsert_user(master_uuid, payload):
+    return sobjects['user'].upsert(master_uuid, payload)
+
+def upsert_company(master_uuid, payload):
+    return sobjects['company'].upsert(master_uuid, payload)
+
+def upsert_event(master_uuid, payload):
+    return sobjects['event'].upsert(master_uuid, payload)
+
+def upsert_attendance(master_uuid, payload):
+    return sobjects['attendance'].upsert(master_uuid, payload)
+
+###########################
+## Collections API Calls ##
+###########################
+
+# The composite sObject Collections endpoint accepts at most 200 records per request
+COLLECTIONS_LIMIT = 200
+
+# Request body shared by the create and update collection calls
+def collection_payload(sobject, records):
+    return {
+        'allOrNone': False,
+        'records': [{'attributes': {'type': sobject}, **record} for record in records]
     }
-    response = requests.get(url, headers=headers)
+
+# Create up to 200 records of one sObject type, returns a result per record in the same order
+def create_records(sobject, records):
+    response = sobject_request(sobject, 'create_records', 'POST', 'composite/sobjects', json=collection_payload(sobject, records))
     response.raise_for_status()
-    data = response.json().get("records", [])
+    return response.json()
 
-    if data:
-        return data[0]['Id'], data[0]['amount__c']
-    else:
-        return None, None
+# Update up to 200 records of one sObject type, every record needs its 'Id'
+def update_records(sobject, records):
+    response = sobject_request(sobject, 'update_records', 'PATCH', 'composite/sobjects', json=collection_payload(sobject, records))
+    response.raise_for_status()
+    return response.json()
+
+# Create or update up to 200 records of one sObject type by their master UUID field
+def upsert_records(sobject, records):
+    response = sobject_request(sobject, 'upsert_records', 'PATCH', f'composite/sobjects/{sobject}/{MASTER_UUID_FIELD}', json=collection_payload(sobject, records))
+    response.raise_for_status()
+    return response.json()
+
+# Delete up to 200 records by id, regardless of their sObject type (recorded under 'composite')
+def delete_records(ids):
+    response = sobject_request('composite', 'delete_records', 'DELETE', 'composite/sobjects', params={'ids': ','.join(ids), 'allOrNone': 'false'})
+    response.raise_for_status()
+    return response.json()
+
+#########################
+## Composite API Calls ##
+#########################
+
+# Send up to 25 subrequests in one Composite API call, returns every subrequest's response by its reference id
+def composite_request(subrequests):
+    base_path = urlparse(secrets.DOMAIN_NAME).path
+    payload = {
+        'allOrNone': False,
+        'compositeRequest': [
+            {'method': method, 'url': base_path + path, 'referenceId': reference_id, 'body': body}
+            for reference_id, (method, path, body) in subrequests.items()
+        ]
+    }
+    response = sobject_request('composite', 'composite', 'POST', 'composite', json=payload)
+    response.raise_for_status()
+    return {result['referenceId']: result for result in response.json()['compositeResponse']}
+
+# Get the existing orders of a user or company for all given products with one query,
+# returns {product_id: (order_id, amount)}
+def get_orders(owner_field, owner_id, product_ids):
+    ids = ','.join(f"'{product_id}'" for product_id in product_ids)
+    records = sobjects['order'].query(['Id', 'product_id__c', 'amount__c'], f"{owner_field}='{owner_id}'+AND+product_id__c+IN+({ids})")
+    return {record['product_id__c']: (record['Id'], record['amount__c']) for record in records}
+
+def get_orders_user(user_id, product_ids):
+    return get_orders('user_id__c', user_id, product_ids)
+
+def get_orders_company(company_id, product_ids):
+    return get_orders('company_id__c', company_id, product_ids)
+
+# Create and update order lines in a single Composite call, returns the result of every new order followed by every updated one
+def save_orders(new_orders, updated_orders):
+    subrequests = {}
+    if new_orders:
+        subrequests['new_orders'] = ('POST', 'composite/sobjects', collection_payload('order__c', new_orders))
+    if updated_orders:
+        subrequests['updated_orders'] = ('PATCH', 'composite/sobjects', collection_payload('order__c', updated_orders))
+    if not subrequests:
+        return []
+
+    responses = composite_request(subrequests)
+    results = []
+    for reference_id in subrequests:
+        result = responses[reference_id]
+        if result['httpStatusCode'] >= 400:
+            raise Exception(f"Saving {reference_id} failed: {result['body']}")
+        results.extend(result['body'])
+    return results
 
 # Create a custom logger
 logger = init_logger("__API__")
\ No newline at end of file
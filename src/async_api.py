@@ -0,0 +1,190 @@
+import asyncio
+import json
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import aiohttp
+import sys, os
+
+if os.path.isdir('/app'):
+    sys.path.append('/app')
+else:
+    local_dir = os.path.dirname(os.path.realpath(__file__))
+    sys.path.append(local_dir)
+import config.secrets as secrets
+import API
+import resilience
+from rate_limiter import AsyncAdaptiveLimiter
+
+# Connection pool size and the number of requests allowed in flight at once
+ASYNC_POOL_SIZE = getattr(secrets, 'ASYNC_POOL_SIZE', 50)
+ASYNC_MAX_CONCURRENCY = getattr(secrets, 'ASYNC_MAX_CONCURRENCY', 25)
+
+Response = namedtuple('Response', ['status', 'data'])
+
+# The async client has its own adaptive limit, so waiting for it never holds a thread and ASYNC_MAX_CONCURRENCY is not
+# capped by the blocking client's pool. It slows down on the same API budget.
+limiter = AsyncAdaptiveLimiter(API.SALESFORCE_API_BUDGET, ASYNC_MAX_CONCURRENCY, 1, API.SALESFORCE_OVER_BUDGET_PACE, API.SALESFORCE_API_RAMP)
+
+# Token refreshes after a 401 run here instead of on the default executor, so they never queue behind other blocking work
+token_refresher = ThreadPoolExecutor(max_workers=1, thread_name_prefix='async-token-refresh')
+
+# Shared session and concurrency limit, created on first use inside the running event loop
+session = None
+semaphore = None
+
+
+async def get_session():
+    global session, semaphore
+    if session is None or session.closed:
+        connect_timeout, read_timeout = API.SALESFORCE_TIMEOUT
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=ASYNC_POOL_SIZE, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        )
+        semaphore = asyncio.Semaphore(ASYNC_MAX_CONCURRENCY)
+    return session
+
+
+async def close():
+    if session is not None:
+        await session.close()
+
+
+# Send a request to the Salesforce REST API, returns the status code and the decoded JSON body (or None).
+# Uses the token of the synchronous client, so both share one TokenManager.
+async def salesforce_request(method, path, **kwargs):
+    client = await get_session()
+    headers = dict(kwargs.pop('headers', None) or {})
+    if isinstance(kwargs.get('data'), dict):
+        kwargs['json'] = kwargs.pop('data')
+    elif 'data' in kwargs:
+        headers.setdefault('Content-Type', 'application/xml')
+    API.encode_body(kwargs, headers)
+
+    async def send():
+        async with semaphore:
+            await limiter.acquire()
+            try:
+                return await _send(client, method, path, headers, kwargs)
+            finally:
+                limiter.release()
+
+    return await resilience.call_async('salesforce', send, idempotent=method in API.IDEMPOTENT_METHODS)
+
+
+async def _send(client, method, path, headers, kwargs):
+    for attempt in range(2):
+        token = API.salesforce_session.headers.get('Authorization', '')
+        async with client.request(method, secrets.DOMAIN_NAME + path, headers={'Authorization': token, 'Accept-Encoding': 'gzip', **API.CALL_OPTIONS, **headers}, **kwargs) as response:
+            # An expired session is refreshed once and the request is sent again
+            if response.status == 401 and attempt == 0 and API.token_manager is not None:
+                await asyncio.get_running_loop().run_in_executor(token_refresher, API.token_manager.invalidate, token.removeprefix('Bearer '))
+                continue
+            limiter.observe(response.headers.get('Sforce-Limit-Info'))
+            body = await response.read()
+            API.record_size('response', len(body), response.content_length or len(body))
+            data = json.loads(body) if body else None
+            return Response(response.status, data)
+
+
+# Send a request on behalf of one sObject type and record the call like the blocking client does
+async def sobject_request(sobject, operation, method, path, **kwargs):
+    started = time.monotonic()
+    ok = False
+    try:
+        response = await salesforce_request(method, path, **kwargs)
+        ok = response.status < 400
+        return response
+    finally:
+        API.record_call(sobject, operation, started, ok)
+
+
+# Create, update and delete go through the endpoints of the entity's SObjectClient in API.sobjects
+async def create(entity, payload):
+    client = API.sobjects[entity]
+    status, data = await sobject_request(client.sobject, 'create', 'POST', client.create_path, data=payload)
+    return data.get('id', None) if isinstance(data, dict) else None
+
+
+async def update(entity, id, payload):
+    client = API.sobjects[entity]
+    await sobject_request(client.sobject, 'update', 'PATCH', client.record_path + id, data=payload)
+
+
+async def delete(entity, id):
+    client = API.sobjects[entity]
+    await sobject_request(client.sobject, 'delete', 'DELETE', client.record_path + id)
+
+
+async def query_order(owner_field, owner_id, product_id):
+    path = f'query?q=SELECT+Id,amount__c+FROM+order__c+WHERE+{owner_field}=\'{owner_id}\'+AND+product_id__c=\'{product_id}\''
+    status, data = await sobject_request('order__c', 'query', 'GET', path)
+    if status >= 400:
+        raise Exception(f"Order query failed with status {status}: {data}")
+    records = data.get("records", [])
+
+    if records:
+        return records[0]['Id'], records[0]['amount__c']
+    else:
+        return None, None
+
+
+##########################
+## Async Consumer Calls ##
+##########################
+
+async def add_user(payload):
+    return await create('user', payload)
+
+async def update_user(id, payload):
+    await update('user', id, payload)
+
+async def delete_user(user_id):
+    await delete('user', user_id)
+
+async def add_company(payload):
+    return await create('company', payload)
+
+async def update_company(id, payload):
+    await update('company', id, payload)
+
+async def delete_company(company_id):
+    await delete('company', company_id)
+
+async def add_event(payload):
+    return await create('event', payload)
+
+async def update_event(id, payload):
+    await update('event', id, payload)
+
+async def delete_event(event_id):
+    await delete('event', event_id)
+
+async def add_attendance(payload):
+    return await create('attendance', payload)
+
+async def update_attendance(id, payload):
+    await update('attendance', id, payload)
+
+async def delete_attendance(attendance_id):
+    await delete('attendance', attendance_id)
+
+async def add_product(payload):
+    return await create('product', payload)
+
+async def update_product(id, payload):
+    await update('product', id, payload)
+
+async def add_order(payload):
+    return await create('order', payload)
+
+async def update_order(id, payload):
+    await update('order', id, payload)
+
+async def get_order_user(user_id, product_id):
+    return await query_order('user_id__c', user_id, product_id)
+
+async def get_order_company(company_id, product_id):
+    return await query_order('company_id__c', company_id, product_id)
+
@@ -0,0 +1,62 @@
+import sys, os
+
+if os.path.isdir('/app'):
+    sys.path.append('/app')
+else:
+    local_dir = os.path.dirname(os.path.realpath(__file__))
+    sys.path.append(local_dir)
+from API import COLLECTIONS_LIMIT, MASTER_UUID_FIELD, authenticate, sobjects, update_records
+import uuidapi
+from logger import init_logger
+
+# Entities written by master UUID when UPSERT_BY_MASTER_UUID is on
+BACKFILL_ENTITIES = ('user', 'company', 'event', 'attendance')
+BACKFILL_PAGE_SIZE = 2000
+
+
+# Write the master UUID into the external id field of every record of an entity that does not have it yet,
+# so turning on UPSERT_BY_MASTER_UUID updates those records instead of creating duplicates.
+# Records are read in Id order, so those the UUID service has no master UUID for are passed over instead of read again.
+# Returns the number of records updated and the number left without a master UUID.
+def backfill_master_uuids(entity, service='crm'):
+    client = sobjects[entity]
+    updated = skipped = 0
+    last_id = None
+    while True:
+        after = f"+AND+Id>'{last_id}'" if last_id else ''
+        records = client.query(['Id'], f"{MASTER_UUID_FIELD}=null{after}+ORDER+BY+Id+LIMIT+{BACKFILL_PAGE_SIZE}")
+        if not records:
+            return updated, skipped
+        last_id = records[-1]['Id']
+
+        changes = []
+        for record in records:
+            master_uuid = uuidapi.get_master_uuid(record['Id'], service)
+            if master_uuid is None:
+                skipped += 1
+            else:
+                changes.append({'Id': record['Id'], MASTER_UUID_FIELD: master_uuid})
+
+        for start in range(0, len(changes), COLLECTIONS_LIMIT):
+            chunk = changes[start:start + COLLECTIONS_LIMIT]
+            for change, result in zip(chunk, update_records(client.sobject, chunk)):
+                if result['success']:
+                    updated += 1
+                else:
+                    # A duplicate value error means an upsert already created a second record for this master UUID
+                    skipped += 1
+                    logger.warning(f"Backfilling {client.sobject} {change['Id']} failed: {result['errors']}")
+
+
+# Create a custom logger
+logger = init_logger("__backfill__")
+
+
+# python src/backfill.py [entity ...]
+# Run once before turning on UPSERT_BY_MASTER_UUID
+if __name__ == '__main__':
+    authenticate()
+    uuidapi.open_store()
+    for entity in sys.argv[1:] or BACKFILL_ENTITIES:
+        updated, skipped = backfill_master_uuids(entity)
+        print(f"Backfilled {entity}: {updated} records updated, {skipped} without a master UUID")
@@ -0,0 +1,170 @@
+import threading
+import time
+from collections import Counter
+from concurrent.futures import wait
+import sys, os
+
+if os.path.isdir('/app'):
+    sys.path.append('/app')
+else:
+    local_dir = os.path.dirname(os.path.realpath(__file__))
+    sys.path.append(local_dir)
+from API import COLLECTIONS_LIMIT, MASTER_UUID_FIELD, create_records, update_records, upsert_records, delete_records, payload_fingerprints
+from bulk import run_ingest_job
+from lanes import SerialLanes
+from logger import init_logger
+
+
+# Accumulates create/update/upsert/delete operations per sObject type and flushes them through the Collections API.
+# Every queued record carries its own callback, which receives that record's result:
+#   {'id': <salesforce id or None>, 'success': <bool>, 'errors': [...]}
+# A group is flushed as soon as it holds flush_size records, or once its oldest record is flush_interval seconds old.
+# In bulk mode the groups grow to bulk_flush_size records and are written as Bulk API 2.0 ingest jobs instead.
+# Flushes run on background lanes, so slow bulk jobs never block the caller, and bulk jobs get lanes of their own,
+# so they never hold up Collections flushes either. The groups of one sObject share a lane and are written in the order
+# they were flushed, and queuing an operation on a record flushes the groups holding earlier operations on it first,
+# its own group included, so a record never appears twice in one request.
+# A group that touches records of a flush still running on the other lanes waits for it, so operations on the same
+# record reach Salesforce in the order they were queued.
+class CollectionsBatcher:
+    def __init__(self, flush_size=COLLECTIONS_LIMIT, flush_interval=1.0, bulk_flush_size=10000, bulk_flush_interval=30.0):
+        self.flush_size = min(flush_size, COLLECTIONS_LIMIT)
+        self.flush_interval = flush_interval
+        self.bulk_flush_size = bulk_flush_size
+        self.bulk_flush_interval = bulk_flush_interval
+        self.bulk_mode = False
+        self.lock = threading.Lock()
+        self.groups = {}
+        self.lanes = SerialLanes('batcher', 2)
+        self.bulk_lanes = SerialLanes('bulk', 2)
+        self.in_flight = {}
+        self.pending = Counter()
+        self.stopped = threading.Event()
+        self.timer = threading.Thread(target=self._run_timer, daemon=True)
+        self.timer.start()
+
+    # Switch between Collections and Bulk API flushing, groups already queued are flushed the old way
+    def set_bulk_mode(self, enabled):
+        if enabled != self.bulk_mode:
+            logger.info(f"Bulk mode {'enabled' if enabled else 'disabled'}")
+            self.flush()
+            self.bulk_mode = enabled
+
+    # Queue one operation, records for 'update' need an 'Id' field, 'upsert' the master UUID field and 'delete' takes the record id itself
+    # Updates identical to the last payload written to the record succeed right away without being queued,
+    # unless other operations on the record are still queued or in flight and would leave it at another value
+    def add(self, operation, sobject, record, callback):
+        key = (operation, sobject)
+        record_key = self._record_key(operation, record)
+        flush_size = self.bulk_flush_size if self.bulk_mode else self.flush_size
+        # Groups are submitted under the lock, so they reach their lane in the order they were flushed
+        with self.lock:
+            unchanged = operation == 'update' and not self.pending[(sobject, record_key)] and payload_fingerprints.unchanged(sobject, record_key, record)
+            if not unchanged:
+                self._queue(key, record_key, record, callback, flush_size)
+        if unchanged:
+            callback({'id': record['Id'], 'success': True, 'errors': []})
+
+    # Called under the lock
+    def _queue(self, key, record_key, record, callback, flush_size):
+        sobject = key[1]
+        if record_key is not None:
+            self.pending[(sobject, record_key)] += 1
+            # Including the group this operation goes to, Salesforce rejects a Collections request that names a record twice
+            for earlier in [other for other, group in self.groups.items() if other[1] == sobject and record_key in group['records']]:
+                self._submit(earlier, self.groups.pop(earlier))
+        group = self.groups.setdefault(key, {'created': time.monotonic(), 'bulk': self.bulk_mode, 'items': [], 'records': set()})
+        group['items'].append((record, callback))
+        if record_key is not None:
+            group['records'].add(record_key)
+        if len(group['items']) >= flush_size:
+            self._submit(key, self.groups.pop(key))
+
+    # Flush every pending group right away
+    def flush(self):
+        with self.lock:
+            for key in list(self.groups):
+                self._submit(key, self.groups.pop(key))
+
+    # Stop the timer thread, flush what is left and wait for every flush to finish
+    def close(self):
+        self.stopped.set()
+        self.timer.join()
+        self.flush()
+        self.lanes.shutdown(wait=True)
+        self.bulk_lanes.shutdown(wait=True)
+
+    # The record an operation is about, None for creates which cannot refer to a record queued before them
+    @staticmethod
+    def _record_key(operation, record):
+        match operation:
+            case 'update':
+                return record['Id']
+            case 'upsert':
+                return record.get(MASTER_UUID_FIELD)
+            case 'delete':
+                return record
+        return None
+
+    # Called under the lock, in_flight keeps the flushes of every sObject that have not finished yet
+    def _submit(self, key, group):
+        sobject, bulk = key[1], group['bulk']
+        running = [flush for flush in self.in_flight.get(sobject, []) if not flush[2].done()]
+        earlier = [future for other_bulk, records, future in running if other_bulk != bulk and records & group['records']]
+        lanes = self.bulk_lanes if bulk else self.lanes
+        future = lanes.submit(sobject, self._flush, key, group['items'], bulk, earlier)
+        running.append((bulk, group['records'], future))
+        self.in_flight[sobject] = running
+
+    def _run_timer(self):
+        while not self.stopped.wait(self.flush_interval / 4):
+            now = time.monotonic()
+            with self.lock:
+                expired = [
+                    key for key, group in self.groups.items()
+                    if now - group['created'] >= (self.bulk_flush_interval if group['bulk'] else self.flush_interval)
+                ]
+                for key in expired:
+                    self._submit(key, self.groups.pop(key))
+
+    def _flush(self, key, batch, bulk, earlier=()):
+        operation, sobject = key
+        records = [record for record, _ in batch]
+        wait(earlier)
+        try:
+            if bulk:
+                results = run_ingest_job(sobject, operation, [{'Id': record} if operation == 'delete' else record for record in records])
+            else:
+                match operation:
+                    case 'create':
+                        results = create_records(sobject, records)
+                    case 'update':
+                        results = update_records(sobject, records)
+                    case 'upsert':
+                        results = upsert_records(sobject, records)
+                    case 'delete':
+                        results = delete_records(records)
+            logger.debug(f"Flushed {len(records)} {operation} operations for {sobject}")
+        except Exception as e:
+            logger.error(f"Failed to flush {len(records)} {operation} operations for {sobject}: {e}")
+            results = [{'id': None, 'success': False, 'errors': [str(e)], 'exception': e}] * len(records)
+
+        for (record, callback), result in zip(batch, results):
+            if operation == 'update' and result['success']:
+                payload_fingerprints.remember(record['Id'], record)
+            elif operation in ('update', 'delete'):
+                payload_fingerprints.forget(record['Id'] if operation == 'update' else record)
+            record_key = self._record_key(operation, record)
+            if record_key is not None:
+                with self.lock:
+                    self.pending[(sobject, record_key)] -= 1
+                    if not self.pending[(sobject, record_key)]:
+                        del self.pending[(sobject, record_key)]
+            try:
+                callback(result)
+            except Exception as e:
+                logger.error(f"Batch callback for {operation} {sobject} failed: {e}")
+
+
+# Create a custom logger
+logger = init_logger("__batcher__")
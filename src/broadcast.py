@@ -0,0 +1,39 @@
+import json
+import sys, os
+
+if os.path.isdir('/app'):
+    sys.path.append('/app')
+else:
+    local_dir = os.path.dirname(os.path.realpath(__file__))
+    sys.path.append(local_dir)
+from logger import init_logger
+
+
+# Fanout exchanges keep in-process state of the consumer and publisher in sync.
+# Every subscriber gets its own exclusive queue, so each running process receives every message.
+def declare(channel, exchange):
+    channel.exchange_declare(exchange=exchange, exchange_type='fanout', durable=True)
+
+
+def publish(channel, exchange, message):
+    declare(channel, exchange)
+    channel.basic_publish(exchange=exchange, routing_key='', body=json.dumps(message, default=str))
+
+
+def subscribe(channel, exchange, handler):
+    declare(channel, exchange)
+    queue = channel.queue_declare(queue='', exclusive=True, auto_delete=True).method.queue
+    channel.queue_bind(exchange=exchange, queue=queue)
+
+    # A message the handler cannot take must not stop start_consuming() on the channel it shares
+    def callback(ch, method, properties, body):
+        try:
+            handler(json.loads(body))
+        except Exception as e:
+            logger.error(f"Failed to handle message from {exchange}: {e}")
+
+    channel.basic_consume(queue=queue, on_message_callback=callback, auto_ack=True)
+
+
+# Create a custom logger
+logger = init_logger("__broadcast__")
@@ -0,0 +1,118 @@
+import csv
+import io
+import time
+from collections import defaultdict, deque
+import sys, os
+
+if os.path.isdir('/app'):
+    sys.path.append('/app')
+else:
+    local_dir = os.path.dirname(os.path.realpath(__file__))
+    sys.path.append(local_dir)
+import config.secrets as secrets
+from API import MASTER_UUID_FIELD, sobject_request
+from logger import init_logger
+
+# How often the job state is polled and how long a job may take before it is given up on
+BULK_POLL_INTERVAL = getattr(secrets, 'BULK_POLL_INTERVAL', 2.0)
+BULK_JOB_TIMEOUT = getattr(secrets, 'BULK_JOB_TIMEOUT', 600)
+
+# Bulk API 2.0 operation for every batcher operation
+OPERATIONS = {
+    'create': 'insert',
+    'update': 'update',
+    'upsert': 'upsert',
+    'delete': 'delete',
+}
+
+
+# Write the records as one CSV upload, columns are the union of the fields of every record
+def write_csv(records):
+    columns = []
+    for record in records:
+        for field in record:
+            if field not in columns:
+                columns.append(field)
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(columns)
+    for record in records:
+        writer.writerow(['' if record.get(field) is None else record[field] for field in columns])
+    return buffer.getvalue(), columns
+
+
+def read_csv(text):
+    return list(csv.DictReader(io.StringIO(text)))
+
+
+# Run one Bulk API 2.0 ingest job and return a result per record, in the same order as the records:
+#   {'id': <salesforce id or None>, 'success': <bool>, 'errors': [...]}
+def run_ingest_job(sobject, operation, records):
+    body, columns = write_csv(records)
+
+    job = {
+        'object': sobject,
+        'operation': OPERATIONS[operation],
+        'contentType': 'CSV',
+        'lineEnding': 'LF',
+    }
+    if operation == 'upsert':
+        job['externalIdFieldName'] = MASTER_UUID_FIELD
+    response = sobject_request(sobject, 'bulk_' + operation, 'POST', 'jobs/ingest', json=job)
+    response.raise_for_status()
+    job_id = response.json()['id']
+    logger.info(f"Opened bulk {operation} job {job_id} for {len(records)} {sobject} records")
+
+    response = sobject_request(sobject, 'bulk_' + operation, 'PUT', f'jobs/ingest/{job_id}/batches', data=body.encode('utf-8'), headers={'Content-Type': 'text/csv'})
+    response.raise_for_status()
+    response = sobject_request(sobject, 'bulk_' + operation, 'PATCH', f'jobs/ingest/{job_id}', json={'state': 'UploadComplete'})
+    response.raise_for_status()
+
+    state = wait_for_job(sobject, operation, job_id)
+    if state != 'JobComplete':
+        raise Exception(f"Bulk job {job_id} ended in state {state}")
+
+    return map_results(sobject, operation, job_id, records, columns)
+
+
+# Poll the job until Salesforce is done with it
+def wait_for_job(sobject, operation, job_id):
+    deadline = time.monotonic() + BULK_JOB_TIMEOUT
+    while True:
+        response = sobject_request(sobject, 'bulk_' + operation, 'GET', f'jobs/ingest/{job_id}')
+        response.raise_for_status()
+        state = response.json()['state']
+        if state in ('JobComplete', 'Failed', 'Aborted'):
+            return state
+        if time.monotonic() >= deadline:
+            sobject_request(sobject, 'bulk_' + operation, 'PATCH', f'jobs/ingest/{job_id}', json={'state': 'Aborted'})
+            return 'Aborted'
+        time.sleep(BULK_POLL_INTERVAL)
+
+
+# Result rows echo the uploaded columns, so every row is matched to its record by those values
+def map_results(sobject, operation, job_id, records, columns):
+    rows = defaultdict(deque)
+    for path, success in (('successfulResults/', True), ('failedResults/', False)):
+        response = sobject_request(sobject, 'bulk_' + operation, 'GET', f'jobs/ingest/{job_id}/{path}')
+        response.raise_for_status()
+        for row in read_csv(response.text):
+            key = tuple(row.get(field, '') for field in columns)
+            if success:
+                rows[key].append({'id': row['sf__Id'], 'success': True, 'errors': [], 'created': row.get('sf__Created', 'true') == 'true'})
+            else:
+                rows[key].append({'id': row.get('sf__Id') or None, 'success': False, 'errors': [row['sf__Error']]})
+
+    results = []
+    for record in records:
+        key = tuple('' if record.get(field) is None else str(record[field]) for field in columns)
+        if rows[key]:
+            results.append(rows[key].popleft())
+        else:
+            results.append({'id': None, 'success': False, 'errors': ['Record was not processed by the bulk job']})
+    return results
+
+
+# Create a custom logger
+logger = init_logger("__bulk__")
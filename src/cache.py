@@ -0,0 +1,75 @@
+import threading
+import time
+from collections import OrderedDict
+import sys, os
+
+if os.path.isdir('/app'):
+    sys.path.append('/app')
+else:
+    local_dir = os.path.dirname(os.path.realpath(__file__))
+    sys.path.append(local_dir)
+import metrics
+
+# Returned by get() for keys that are not cached, so a cached None can be told apart from a miss
+MISSING = object()
+
+
+# Thread-safe LRU cache whose entries expire after a time to live.
+# Hits, misses, evictions and the size are exported as metrics labelled with the cache name.
+class LRUCache:
+    def __init__(self, name, maxsize=10000, ttl=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key, default=MISSING):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                metrics.inc('crm_cache_misses_total', cache=self.name)
+                return default
+            self.entries.move_to_end(key)
+        metrics.inc('crm_cache_hits_total', cache=self.name)
+        return entry[0]
+
+    # Store a value, ttl overrides the cache's time to live for this entry
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        evicted = 0
+        with self.lock:
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                evicted += 1
+            size = len(self.entries)
+        if evicted:
+            metrics.inc('crm_cache_evictions_total', evicted, cache=self.name)
+        metrics.set_gauge('crm_cache_size', size, cache=self.name)
+
+    def delete(self, key):
+        self.pop(key)
+
+    # Remove an entry and return its value, without counting a hit or miss
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            size = len(self.entries)
+        metrics.set_gauge('crm_cache_size', size, cache=self.name)
+        if entry is None or (entry[1] is not None and entry[1] <= time.monotonic()):
+            return default
+        return entry[0]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+        metrics.set_gauge('crm_cache_size', 0, cache=self.name)
+
+    def __len__(self):
+        return len(self.entries)
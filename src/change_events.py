@@ -0,0 +1,19 @@
+import sys, os
+
+if os.path.isdir('/app'):
+    sys.path.append('/app')
+else:
+    local_dir = os.path.dirname(os.path.realpath(__file__))
+    sys.path.append(local_dir)
+import config.secrets as secrets
+
+# Every Salesforce call we make names this client in its Sforce-Call-Options header, which Salesforce appends to the
+# changeOrigin of the change events our writes cause: "com/salesforce/api/rest/60.0;client=crm-integration"
+SALESFORCE_CLIENT_NAME = getattr(secrets, 'SALESFORCE_CLIENT_NAME', 'crm-integration')
+CALL_OPTIONS = {'Sforce-Call-Options': f'client={SALESFORCE_CLIENT_NAME}'}
+
+
+# Whether a change event header describes a change we made ourselves, other integrations using the same API are not us
+def is_own_change(header):
+    options = (header.get('changeOrigin') or '').split(';')[1:]
+    return f'client={SALESFORCE_CLIENT_NAME}' in (option.strip() for option in options)
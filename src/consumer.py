@@ -1,5 +1,9 @@
 #!/usr/bin/env python
 import pika, sys, os
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import xml.etree.ElementTree as ET
 
 if os.path.isdir('/app'):
@@ -11,9 +15,171 @@ import config.secrets as secrets
 from monitoring import log
 from API import *
 from xml_parser import *
+from json_payload import *
 from logger import init_logger
+from batcher import CollectionsBatcher
+from lanes import SerialLanes
+from order_index import OrderIndex, ORDER_EXCHANGE
+from mapping_sync import MappingSync
+from uuid_outbox import MappingOutbox, UUID_WRITE_BEHIND
+import uuidapi
+import broadcast
+import metrics
+from resilience import CircuitOpenError
 from config.secrets import *
 
+# Port the consumer serves its metrics on
+CONSUMER_METRICS_PORT = getattr(secrets, 'CONSUMER_METRICS_PORT', 9966)
+
+# Batch creates/updates/deletes through the Collections API instead of one REST call per message
+COLLECTIONS_BATCHING = getattr(secrets, 'COLLECTIONS_BATCHING', False)
+COLLECTIONS_FLUSH_SIZE = getattr(secrets, 'COLLECTIONS_FLUSH_SIZE', 200)
+COLLECTIONS_FLUSH_INTERVAL = getattr(secrets, 'COLLECTIONS_FLUSH_INTERVAL', 1.0)
+
+# Switch to Bulk API 2.0 ingest jobs while the queue holds more than BULK_MODE_THRESHOLD messages (0 disables bulk mode)
+BULK_MODE_THRESHOLD = getattr(secrets, 'BULK_MODE_THRESHOLD', 0)
+BULK_FLUSH_SIZE = getattr(secrets, 'BULK_FLUSH_SIZE', 10000)
+BULK_FLUSH_INTERVAL = getattr(secrets, 'BULK_FLUSH_INTERVAL', 30.0)
+BULK_CHECK_INTERVAL = getattr(secrets, 'BULK_CHECK_INTERVAL', 5)
+
+# Send sObject payloads as JSON dicts (default) or as the XML built by the write_xml_* builders
+PAYLOAD_FORMAT = getattr(secrets, 'PAYLOAD_FORMAT', 'json')
+if PAYLOAD_FORMAT == 'json':
+    write_user, write_company, write_event, write_attendance = write_json_user, write_json_company, write_json_event, write_json_attendance
+    write_product, write_order, write_existing_order = write_json_product, write_json_order, write_json_existing_order
+    to_record = dict
+else:
+    write_user, write_company, write_event, write_attendance = write_xml_user, write_xml_company, write_xml_event, write_xml_attendance
+    write_product, write_order, write_existing_order = write_xml_product, write_xml_order, write_xml_existing_order
+    to_record = read_xml_payload
+
+# RabbitMQ hands out at most CONSUMER_PREFETCH unacknowledged deliveries, which bounds the messages in flight,
+# and CONSUMER_LANES threads process them concurrently. Messages about the same entity always share a lane,
+# so they are processed in the order they arrived.
+CONSUMER_PREFETCH = getattr(secrets, 'CONSUMER_PREFETCH', 20)
+CONSUMER_LANES = getattr(secrets, 'CONSUMER_LANES', 8)
+
+# Gather up to CONSUMER_BATCH_SIZE deliveries, or what arrived within CONSUMER_BATCH_WAIT seconds, and dispatch them together:
+# their master UUIDs are resolved in one go and their writes are flushed as one Collections call per sObject type.
+# Messages are still acknowledged one by one (0 disables micro-batching)
+CONSUMER_BATCH_SIZE = getattr(secrets, 'CONSUMER_BATCH_SIZE', 0)
+CONSUMER_BATCH_WAIT = getattr(secrets, 'CONSUMER_BATCH_WAIT', 0.05)
+
+# Messages referring to master UUIDs that are not mapped yet are held back until the mapping is added,
+# for at most UUID_PARK_TIMEOUT seconds and UUID_PARK_LIMIT messages at a time, then processed as they are
+UUID_PARK_TIMEOUT = getattr(secrets, 'UUID_PARK_TIMEOUT', 30)
+UUID_PARK_LIMIT = getattr(secrets, 'UUID_PARK_LIMIT', 1000)
+
+# Create and update records by their master UUID external id instead of looking up their Salesforce id first.
+# Run backfill.py before turning this on, so records created without their master UUID are not created a second time
+UPSERT_BY_MASTER_UUID = getattr(secrets, 'UPSERT_BY_MASTER_UUID', False)
+UPSERTS = {
+    'user': (read_xml_user, write_user, upsert_user),
+    'company': (read_xml_company, write_company, upsert_company),
+    'event': (read_xml_event, write_event, upsert_event),
+    'attendance': (read_xml_attendance, write_attendance, upsert_attendance),
+}
+
+# Every record we create carries its master UUID in the external id field, so upserts find it later on.
+# Records created before that are given theirs by backfill.py
+def with_master_uuid(payload, master_uuid):
+    if isinstance(payload, dict):
+        return {**payload, MASTER_UUID_FIELD: master_uuid}
+    closing = payload.rindex('</')
+    return f'{payload[:closing]}<{MASTER_UUID_FIELD}>{master_uuid}</{MASTER_UUID_FIELD}>{payload[closing:]}'
+
+# Write-through index of existing orders, kept current by our own writes and the publisher's order change events
+order_index = OrderIndex()
+
+# Create or increment every line of one order with at most one query for the existing orders and one composite write.
+# Amounts known from the order index skip the query; lines whose indexed order turns out stale are retried with fresh amounts.
+def save_order_lines(user_id, company_id, products, use_index=True):
+    owner_id = user_id or company_id
+    amounts = {}
+    for product in products:
+        amounts[product['product_id']] = amounts.get(product['product_id'], 0) + int(product['amount'])
+
+    existing_orders = {}
+    if use_index:
+        for product_id in amounts:
+            indexed = order_index.get(owner_id, product_id)
+            if indexed is not None:
+                existing_orders[product_id] = indexed
+    indexed_products = set(existing_orders)
+    missing = [product_id for product_id in amounts if product_id not in existing_orders]
+    if missing:
+        if user_id:
+            existing_orders.update(get_orders_user(user_id, missing))
+        else:
+            existing_orders.update(get_orders_company(company_id, missing))
+    logger.debug(f"Existing orders: {existing_orders}")
+
+    new_orders, new_lines = [], []
+    updated_orders, updated_lines = [], []
+    for product_id, amount in amounts.items():
+        if product_id in existing_orders:
+            order_id, old_amount = existing_orders[product_id]
+            payload = write_existing_order(str(amount + int(old_amount)))
+            updated_orders.append({'Id': order_id, **to_record(payload)})
+            updated_lines.append((product_id, amount, amount + int(old_amount), order_id))
+        else:
+            payload = write_order(user_id, company_id, product_id, str(amount))
+            new_orders.append(to_record(payload))
+            new_lines.append((product_id, amount, amount, None))
+
+    errors = []
+    stale = []
+    for (product_id, amount, total, order_id), result in zip(new_lines + updated_lines, save_orders(new_orders, updated_orders)):
+        if result['success']:
+            order_index.put(owner_id, product_id, result['id'] or order_id, total)
+        elif product_id in indexed_products:
+            order_index.invalidate(order_id)
+            stale.append({'product_id': product_id, 'amount': amount})
+        else:
+            errors.append(result['errors'])
+
+    if stale:
+        logger.warning(f"Order index was stale for {len(stale)} lines, retrying with fresh amounts")
+        save_order_lines(user_id, company_id, stale, use_index=False)
+    if errors:
+        raise Exception(f"Failed to save order lines: {errors}")
+
+# Resolve every master UUID a message refers to in one go, the lookups of read_xml_* are then served from the cache.
+# The record's own id is skipped when it is not resolved: creates are not mapped yet and upserts address the master UUID.
+# Returns the master UUIDs that are not mapped yet.
+def prime_service_ids(root, crud_operation):
+    upsert = UPSERT_BY_MASTER_UUID and root.tag in UPSERTS and crud_operation == 'update'
+    referenced = read_xml_master_uuids(root, resolve_id=crud_operation != 'create' and not upsert)
+    if not referenced:
+        return []
+    try:
+        resolved = get_service_ids(referenced, TEAM)
+    except Exception as e:
+        logger.warning(f"Resolving {len(referenced)} master UUIDs up front failed, looking them up one by one: {e}")
+        return []
+    return [master_uuid for master_uuid, service_id in resolved.items() if service_id is None]
+
+# Resolve the master UUIDs of a whole batch of messages in one go, the lookups of every message are then answered from the cache.
+# The records' own ids are included, the create branches look them up too and their unmapped answers are cached briefly.
+def prime_batch(roots):
+    referenced = list(dict.fromkeys(master_uuid for root in roots for master_uuid in read_xml_master_uuids(root)))
+    if not referenced:
+        return
+    try:
+        get_service_ids(referenced, TEAM)
+    except Exception as e:
+        logger.warning(f"Resolving {len(referenced)} master UUIDs of a batch failed, resolving them per message: {e}")
+
+# The entity a message is about: the master UUID of its record, or for orders the user or company they belong to.
+# Master UUIDs are unique across types, so a user's orders queue up behind the user itself.
+def entity_key(root):
+    fields = ('user_id', 'company_id') if root.tag == 'order' else ('id',)
+    for field in fields:
+        value = (root.findtext(field) or '').strip()
+        if value:
+            return value
+    return root.tag
+
 def main():
     # Global variables
     TEAM = 'crm'
@@ -28,36 +194,298 @@ def main():
         sys.exit(1)
     channel = connection.channel()
     channel.queue_declare(queue=TEAM, durable=True)
+    batcher = None
+    if COLLECTIONS_BATCHING or BULK_MODE_THRESHOLD or CONSUMER_BATCH_SIZE:
+        batcher = CollectionsBatcher(COLLECTIONS_FLUSH_SIZE, COLLECTIONS_FLUSH_INTERVAL, BULK_FLUSH_SIZE, BULK_FLUSH_INTERVAL)
+    in_flight = set()
 
-    # Callback function
-    def callback(ch, method, properties, body):
+    # New mappings are written to the UUID service in the background once the local store is open
+    outbox = MappingOutbox(uuidapi.store) if UUID_WRITE_BEHIND and uuidapi.store is not None else None
+    record_service_id = outbox.add if outbox is not None else add_service_id
+
+    # Queue depth is what RabbitMQ still holds plus what we received but did not settle yet
+    def check_queue_depth():
+        depth = channel.queue_declare(queue=TEAM, durable=True, passive=True).method.message_count + len(in_flight)
+        if depth >= BULK_MODE_THRESHOLD:
+            batcher.set_bulk_mode(True)
+        elif depth < BULK_MODE_THRESHOLD // 2:
+            batcher.set_bulk_mode(False)
+        connection.call_later(BULK_CHECK_INTERVAL, check_queue_depth)
+
+    # Bulk mode needs a window the size of a bulk job, with a smaller one the queue always looks empty
+    prefetch = max(CONSUMER_PREFETCH, BULK_FLUSH_SIZE) if BULK_MODE_THRESHOLD else CONSUMER_PREFETCH
+    # A Collections group or a micro-batch can only fill up when the window holds at least two of them
+    if COLLECTIONS_BATCHING:
+        prefetch = max(prefetch, 2 * COLLECTIONS_FLUSH_SIZE)
+    prefetch = max(prefetch, 2 * CONSUMER_BATCH_SIZE)
+    channel.basic_qos(prefetch_count=prefetch)
+    if BULK_MODE_THRESHOLD:
+        connection.call_later(BULK_CHECK_INTERVAL, check_queue_depth)
+
+    # Deliveries are processed on serial lanes per entity, everything touching the channel stays on the connection thread
+    lanes = SerialLanes('consumer', CONSUMER_LANES)
+    # Micro-batches are resolved one after the other, so the lanes see their messages in arrival order
+    resolver = ThreadPoolExecutor(max_workers=1, thread_name_prefix='consumer-batches')
+
+    # Parked messages count against the prefetch window, half of it is kept free for messages that can go ahead
+    park_limit = min(UUID_PARK_LIMIT, max(1, prefetch // 2))
+
+    # Parked messages by delivery tag, the delivery tags waiting for every master UUID and when each parked message is due.
+    # Later messages about the entity of a parked message wait behind it, so they cannot overtake it.
+    # Messages are parked from the lanes and released from the connection thread, park_lock guards all of it.
+    park_lock = threading.Lock()
+    parked = {}
+    waiting = {}
+    deadlines = {}
+    behind = {}
+
+    # Hold a message back until the given master UUIDs are mapped, returns False when it has to be processed right away
+    def park(ch, method, properties, body, key, unmapped):
+        delivery_tag = method.delivery_tag
+        now = time.monotonic()
+        with park_lock:
+            deadline = deadlines.setdefault(delivery_tag, now + UUID_PARK_TIMEOUT)
+            if now >= deadline or len(parked) >= park_limit:
+                logger.warning(f"Processing message {delivery_tag} although {', '.join(unmapped)} is not mapped yet")
+                return False
+            parked[delivery_tag] = (ch, method, properties, body, key, unmapped)
+            behind.setdefault(key, [])
+            for master_uuid in unmapped:
+                waiting.setdefault(master_uuid, set()).add(delivery_tag)
+            metrics.set_gauge('crm_parked_messages', len(parked))
+        logger.info(f"Parked message {delivery_tag} until {', '.join(unmapped)} is mapped")
+        connection.add_callback_threadsafe(functools.partial(connection.call_later, deadline - now, functools.partial(unpark, delivery_tag)))
+        return True
+
+    # Queue a message behind the parked message about the same entity, returns False when there is none
+    def wait_behind(ch, method, properties, body, key):
+        with park_lock:
+            if key not in behind:
+                return False
+            behind[key].append((ch, method, properties, body))
+        logger.info(f"Message {method.delivery_tag} waits for an earlier message about {key}")
+        return True
+
+    # Hand a parked message back to the callback, which parks it again if it still waits for another mapping,
+    # followed by the messages that waited behind it
+    def unpark(delivery_tag):
+        with park_lock:
+            entry = parked.pop(delivery_tag, None)
+            if entry is None:
+                return
+            ch, method, properties, body, key, unmapped = entry
+            for master_uuid in unmapped:
+                delivery_tags = waiting.get(master_uuid, set())
+                delivery_tags.discard(delivery_tag)
+                if not delivery_tags:
+                    waiting.pop(master_uuid, None)
+            followers = behind.pop(key, [])
+            metrics.set_gauge('crm_parked_messages', len(parked))
+        callback(ch, method, properties, body)
+        for follower in followers:
+            callback(*follower)
+
+    def release(master_uuid):
+        with park_lock:
+            delivery_tags = list(waiting.get(master_uuid, ()))
+        for delivery_tag in delivery_tags:
+            unpark(delivery_tag)
+
+    # Mappings are also added from the batcher's threads, so releasing is handed to the connection thread
+    def on_mapped(master_uuid, service):
+        if service == TEAM and master_uuid in waiting:
+            connection.add_callback_threadsafe(functools.partial(release, master_uuid))
+
+    add_mapping_listener(on_mapped)
+
+    consumer = {'tag': None}
+
+    def consume():
+        consumer['tag'] = channel.basic_consume(queue=TEAM, on_message_callback=gather if CONSUMER_BATCH_SIZE else callback, auto_ack=False)
+        logger.info("Waiting for messages to receive. To exit press CTRL+C")
+
+    # Stop taking messages while a dependency's circuit is open instead of burning through the queue.
+    # start_consuming() keeps running on the order index subscription in the meantime.
+    def pause(seconds):
+        if consumer['tag'] is not None:
+            channel.basic_cancel(consumer['tag'])
+            consumer['tag'] = None
+            logger.warning(f"Pausing consumption for {seconds:.0f}s")
+            connection.call_later(seconds, consume)
+
+    # monitoring.log() opens a connection of its own, it runs on a separate thread so acks never wait for it
+    log_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='consumer-log')
+
+    def report(process, message, error='false'):
+        log_executor.submit(log, logger, process, message, error)
+
+    # Acknowledge or reject a message once its Salesforce write is done, on the connection thread
+    def settle(ch, delivery_tag, root, crud_operation, error=None):
+        in_flight.discard(delivery_tag)
+        with park_lock:
+            deadlines.pop(delivery_tag, None)
+        metrics.set_gauge('crm_consumer_in_flight', len(in_flight))
+        if error is None:
+            ch.basic_ack(delivery_tag=delivery_tag)
+            logger.info(f'Processed {crud_operation} request for {root.tag}')
+            report(f"CONSUMER: {root.tag}.{crud_operation}", f"Processed {crud_operation} request for {root.tag}")
+        elif isinstance(error, CircuitOpenError):
+            ch.basic_nack(delivery_tag=delivery_tag, requeue=True)
+            logger.warning(f'Requeued {crud_operation} request for {root.tag}: {error}')
+            connection.add_callback_threadsafe(functools.partial(pause, error.retry_after))
+        else:
+            ch.basic_nack(delivery_tag=delivery_tag, requeue=False)
+            logger.error(f'Failed to process {crud_operation} request for {root.tag}: {error}')
+            report(f"CONSUMER: {root.tag}.{crud_operation}", f"Failed to process {crud_operation} request for {root.tag}: {error}", error='true')
+
+    # Settle from a worker or the batcher's thread, acks are sent by the connection thread in the order messages finish
+    def finish(ch, delivery_tag, root, crud_operation, error=None):
+        connection.add_callback_threadsafe(functools.partial(settle, ch, delivery_tag, root, crud_operation, error))
+
+    def reject(ch, delivery_tag, error):
+        in_flight.discard(delivery_tag)
+        metrics.set_gauge('crm_consumer_in_flight', len(in_flight))
+        ch.basic_nack(delivery_tag=delivery_tag, requeue=False)
+        logger.error(f'Rejected unreadable message {delivery_tag}: {error}')
+
+    def on_batch_result(ch, delivery_tag, root, crud_operation, then, result):
+        error = None
+        try:
+            if not result['success']:
+                raise result.get('exception') or Exception(result['errors'])
+            # Upsert results name the record even when it already existed, only a created one is new to us
+            if then is not None:
+                then(result['id'] if result.get('created', True) else None)
+        except Exception as e:
+            error = e
+        finish(ch, delivery_tag, root, crud_operation, error)
+
+    # Take a delivery in, returns its root and crud operation or None when it was rejected
+    def receive(ch, method, body):
+        in_flight.add(method.delivery_tag)
+        metrics.set_gauge('crm_consumer_in_flight', len(in_flight))
 
         # Parce XML
-        xml_string = body
-        xml_string = xml_string.decode().strip()
+        try:
+            xml_string = body
+            xml_string = xml_string.decode().strip()
+
+            # Get MATCH CASE attributes
+            root = ET.fromstring(xml_string)
+            crud_operation = root.find('crud_operation').text
+        except Exception as e:
+            reject(ch, method.delivery_tag, e)
+            return None
+        return root, crud_operation
+
+    # Callback function, runs on the connection thread and hands the delivery to the lane of its entity
+    def callback(ch, method, properties, body):
+        received = receive(ch, method, body)
+        if received is not None:
+            lanes.submit(entity_key(received[0]), process, ch, method, properties, body, *received)
+
+    # Deliveries gathered for the next micro-batch, the generation tells a batch's timer whether it was dispatched already
+    gathered = []
+    gathering = {'generation': 0}
+
+    # Callback function when micro-batching, runs on the connection thread
+    def gather(ch, method, properties, body):
+        gathered.append((ch, method, properties, body))
+        if len(gathered) >= CONSUMER_BATCH_SIZE:
+            dispatch()
+        elif len(gathered) == 1:
+            connection.call_later(CONSUMER_BATCH_WAIT, functools.partial(dispatch, gathering['generation']))
+
+    def dispatch(generation=None):
+        if generation is not None and generation != gathering['generation'] or not gathered:
+            return
+        gathering['generation'] += 1
+        batch = []
+        for ch, method, properties, body in gathered:
+            received = receive(ch, method, body)
+            if received is not None:
+                batch.append((ch, method, properties, body, *received))
+        gathered.clear()
+        metrics.observe('crm_consumer_batch_size', len(batch))
+        if batch:
+            resolver.submit(run_batch, batch)
+
+    # Resolve the batch's master UUIDs in one go, hand its messages to their lanes and flush their writes
+    # together once the last of them is processed
+    def run_batch(batch):
+        try:
+            prime_batch([root for _, _, _, _, root, _ in batch])
+        finally:
+            remaining = {'count': len(batch)}
+            remaining_lock = threading.Lock()
+
+            def processed(future):
+                with remaining_lock:
+                    remaining['count'] -= 1
+                    last = remaining['count'] == 0
+                if last:
+                    batcher.flush()
+
+            for ch, method, properties, body, root, crud_operation in batch:
+                lanes.submit(entity_key(root), process, ch, method, properties, body, root, crud_operation).add_done_callback(processed)
 
-        # Get MATCH CASE attributes
-        root = ET.fromstring(xml_string)
-        crud_operation = root.find('crud_operation').text
+    def process(ch, method, properties, body, root, crud_operation):
+        key = entity_key(root)
+        if wait_behind(ch, method, properties, body, key):
+            return
         logger.info(f"Received a {crud_operation} request for {root.tag}")
-        logger.debug(f"Message: {xml_string}")
+        logger.debug(f"Message: {body.decode().strip()}")
+        batching = batcher is not None and (COLLECTIONS_BATCHING or CONSUMER_BATCH_SIZE or batcher.bulk_mode)
+
+        # Hand one write on an entity to the batcher, the message is settled from its per-record result
+        def defer(operation, entity, record, then=None):
+            batcher.add(operation, sobjects[entity].sobject, record, functools.partial(on_batch_result, ch, method.delivery_tag, root, crud_operation, then))
+            return True
 
         try:
+            unmapped = prime_service_ids(root, crud_operation)
+            if unmapped and park(ch, method, properties, body, key, unmapped):
+                return
             variables = {}
+            deferred = False
             # MATCH CASE
             match root.tag, crud_operation:
+                # Case: create or update by master UUID, the same call is idempotent on redelivery
+                case ('user' | 'company' | 'event' | 'attendance'), ('create' | 'update') if UPSERT_BY_MASTER_UUID:
+                    read_xml, write, upsert = UPSERTS[root.tag]
+                    read_xml(variables, root, resolve_id=False)
+                    master_uuid = variables['id']
+                    payload = write(**variables)
+
+                    # An upsert returns an id only when it created the record, also on an update of a record Salesforce did not have.
+                    # Upserting a record that already exists, as on a redelivered create, returns no id and its mapping is recorded already
+                    def then(service_id):
+                        if service_id is not None:
+                            record_service_id(master_uuid, service_id, TEAM)
+                    if batching:
+                        deferred = defer('upsert', root.tag, {MASTER_UUID_FIELD: master_uuid, **to_record(payload)}, then)
+                    else:
+                        then(upsert(master_uuid, payload))
+
                 # Case: create user request from RabbitMQ
                 case 'user', 'create':
                     read_xml_user(variables, root)
-                    payload = write_xml_user(**variables)
-                    service_id = add_user(payload)
-                    add_service_id(root.find('id').text, service_id, TEAM)
+                    master_uuid = root.find('id').text
+                    payload = with_master_uuid(write_user(**variables), master_uuid)
+                    if batching:
+                        deferred = defer('create', 'user', to_record(payload), lambda service_id: record_service_id(master_uuid, service_id, TEAM))
+                    else:
+                        service_id = add_user(payload)
+                        record_service_id(master_uuid, service_id, TEAM)
 
                 # Case: update user request from RabbitMQ
                 case 'user', 'update':
                     read_xml_user(variables, root)
-                    payload = write_xml_user(**variables)
-                    update_user(variables['id'], payload)
+                    payload = write_user(**variables)
+                    if batching:
+                        deferred = defer('update', 'user', {'Id': variables['id'], **to_record(payload)})
+                    else:
+                        update_user(variables['id'], payload)
 
                 # Case: delete user request from RabbitMQ
                 case 'user', 'delete':
@@ -65,133 +493,165 @@ def main():
                         master_uuid = root.find('id').text
                         service_id = get_service_id(master_uuid, TEAM)
                         if service_id is not None:
-                            delete_user(service_id)
-                            delete_service_id(master_uuid, TEAM)
+                            if batching:
+                                deferred = defer('delete', 'user', service_id, lambda _: delete_service_id(master_uuid, TEAM))
+                            else:
+                                delete_user(service_id)
+                                delete_service_id(master_uuid, TEAM)
 
                 # Case: create company request from RabbitMQ
                 case 'company', 'create':
                     read_xml_company(variables, root)
-                    payload = write_xml_company(**variables)
-                    service_id = add_company(payload)
-                    add_service_id(root.find('id').text, service_id, TEAM)
+                    master_uuid = root.find('id').text
+                    payload = with_master_uuid(write_company(**variables), master_uuid)
+                    if batching:
+                        deferred = defer('create', 'company', to_record(payload), lambda service_id: record_service_id(master_uuid, service_id, TEAM))
+                    else:
+                        service_id = add_company(payload)
+                        record_service_id(master_uuid, service_id, TEAM)
 
                 # Case: update company request from RabbitMQ
                 case 'company', 'update':
                     read_xml_company(variables, root)
-                    payload = write_xml_company(**variables)
-                    update_company(variables['id'], payload)
+                    payload = write_company(**variables)
+                    if batching:
+                        deferred = defer('update', 'company', {'Id': variables['id'], **to_record(payload)})
+                    else:
+                        update_company(variables['id'], payload)
 
                 # Case: delete company request from RabbitMQ
                 case 'company', 'delete':
                     master_uuid = root.find('id').text
                     service_id = get_service_id(service_name="crm", master_uuid=master_uuid)
                     if service_id is not None:
-                        delete_company(service_id)
-                        delete_service_id(master_uuid, TEAM)
+                        if batching:
+                            deferred = defer('delete', 'company', service_id, lambda _: delete_service_id(master_uuid, TEAM))
+                        else:
+                            delete_company(service_id)
+                            delete_service_id(master_uuid, TEAM)
 
                 # Case: create event request from RabbitMQ
                 case 'event', 'create':
                     logger.debug("Creating event request from RabbitMQ")
                     read_xml_event(variables, root)
-                    payload = write_xml_event(**variables)
-                    service_id = add_event(payload)
-                    add_service_id(root.find('id').text, service_id, TEAM)
+                    master_uuid = root.find('id').text
+                    payload = with_master_uuid(write_event(**variables), master_uuid)
+                    if batching:
+                        deferred = defer('create', 'event', to_record(payload), lambda service_id: record_service_id(master_uuid, service_id, TEAM))
+                    else:
+                        service_id = add_event(payload)
+                        record_service_id(master_uuid, service_id, TEAM)
 
                 # Case: update event request from RabbitMQ
                 case 'event', 'update':
                     read_xml_event(variables, root)
-                    payload = write_xml_event(**variables)
-                    update_event(variables['id'], payload)
+                    payload = write_event(**variables)
+                    if batching:
+                        deferred = defer('update', 'event', {'Id': variables['id'], **to_record(payload)})
+                    else:
+                        update_event(variables['id'], payload)
 
                 # Case: delete event request from RabbitMQ
                 case 'event', 'delete':
                     master_uuid = root.find('id').text
                     service_id = get_service_id(master_uuid, TEAM)
                     if service_id is not None:
-                        delete_event(service_id)
-                        delete_service_id(master_uuid, TEAM)
+                        if batching:
+                            deferred = defer('delete', 'event', service_id, lambda _: delete_service_id(master_uuid, TEAM))
+                        else:
+                            delete_event(service_id)
+                            delete_service_id(master_uuid, TEAM)
     
                 # Case: create attendance request from RabbitMQ
                 case 'attendance', 'create':
                     read_xml_attendance(variables, root)
-                    payload = write_xml_attendance(**variables)
-                    service_id = add_attendance(payload)
-                    add_service_id(root.find('id').text, service_id, TEAM)
+                    master_uuid = root.find('id').text
+                    payload = with_master_uuid(write_attendance(**variables), master_uuid)
+                    if batching:
+                        deferred = defer('create', 'attendance', to_record(payload), lambda service_id: record_service_id(master_uuid, service_id, TEAM))
+                    else:
+                        service_id = add_attendance(payload)
+                        record_service_id(master_uuid, service_id, TEAM)
 
                 # Case: update attendance request from RabbitMQ
                 case 'attendance', 'update':
                     read_xml_attendance(variables, root)
-                    payload = write_xml_attendance(**variables)
-                    update_attendance(variables['id'], payload)
+                    payload = write_attendance(**variables)
+                    if batching:
+                        deferred = defer('update', 'attendance', {'Id': variables['id'], **to_record(payload)})
+                    else:
+                        update_attendance(variables['id'], payload)
 
                 # Case: delete attendance request from RabbitMQ
                 case 'attendance', 'delete':
                     master_uuid = root.find('id').text
                     service_id = get_service_id(master_uuid, TEAM)
                     if service_id is not None:
-                        delete_attendance(service_id)
-                        delete_service_id(master_uuid, TEAM)
+                        if batching:
+                            deferred = defer('delete', 'attendance', service_id, lambda _: delete_service_id(master_uuid, TEAM))
+                        else:
+                            delete_attendance(service_id)
+                            delete_service_id(master_uuid, TEAM)
 
                 # Case: create product request from RabbitMQ
                 case 'product', 'create':
                     read_xml_product(variables, root)
-                    payload = write_xml_product(**variables)
+                    payload = write_product(**variables)
                     logger.debug(f"Payload: {payload}")
                     service_id = add_product(payload)
-                    add_service_id(root.find('id').text, service_id, TEAM)
+                    record_service_id(root.find('id').text, service_id, TEAM)
 
                 # Case: update product request from RabbitMQ
                 case 'product', 'update':
                     read_xml_product(variables, root)
-                    payload = write_xml_product(**variables)
+                    payload = write_product(**variables)
                     update_product(variables['id'], payload)
 
                 # Case: create order request from RabbitMQ
                 case 'order', 'create':
                     read_xml_order(variables, root)
-                    if variables['user_id'] is not None and variables['user_id'] is not '':
+                    if variables['user_id'] is not None and variables['user_id'] != '':
                         logger.debug(f"User ID: {variables['user_id']}")
-                        for product in variables['products']:
-                            order_id, old_amount = get_order_user(variables['user_id'], product['product_id'])
-                            logger.debug(f"Order ID: {order_id}, Old Amount: {old_amount}")
-                            if order_id is not None:
-                                payload = write_xml_existing_order(str(int(product['amount']) + int(old_amount)))
-                                update_order(order_id, payload)
-                            else:
-                                payload = write_xml_order(variables['user_id'], '', **product)
-                                add_order(payload)
-                    elif variables['company_id'] is not None and variables['company_id'] is not '':
+                        save_order_lines(variables['user_id'], '', variables['products'])
+                    elif variables['company_id'] is not None and variables['company_id'] != '':
                         logger.debug(f"Company ID: {variables['company_id']}")
-                        for product in variables['products']:
-                            order_id, old_amount = get_order_company(variables['company_id'], product['product_id'])
-                            logger.debug(f"Order ID: {order_id}, Old Amount: {old_amount}")
-                            if order_id is not None:
-                                payload = write_xml_existing_order(str(int(product['amount']) + int(old_amount)))
-                                update_order(order_id, payload)
-                            else:
-                                payload = write_xml_order('', variables['company_id'], **product)
-                                add_order(payload)
+                        save_order_lines('', variables['company_id'], variables['products'])
 
-            # Acknowledge the message
-            ch.basic_ack(delivery_tag=method.delivery_tag)
-            logger.info(f'Processed {crud_operation} request for {root.tag}')
-            log(logger, f"CONSUMER: {root.tag}.{crud_operation}", f"Processed {crud_operation} request for {root.tag}")
+            # Acknowledge the message, batched writes are acknowledged once their result comes back
+            if not deferred:
+                finish(ch, method.delivery_tag, root, crud_operation)
 
         # Handle exceptions from the consumer
         except Exception as e:
-            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
-            logger.error(f'Failed to process {crud_operation} request for {root.tag}: {e}')
-            log(logger, f"CONSUMER: {root.tag}.{crud_operation}", f"Failed to process {crud_operation} request for {root.tag}: {e}", error='true')
+            finish(ch, method.delivery_tag, root, crud_operation, e)
+
+    # Invalidate the order index on order changes the publisher sees in Salesforce, on the consumer's own channel
+    broadcast.subscribe(channel, ORDER_EXCHANGE, order_index.apply_change_event)
 
     # Start consuming messages
-    channel.basic_consume(queue=TEAM, on_message_callback=callback, auto_ack=False)
-    logger.info("Waiting for messages to receive. To exit press CTRL+C")
-    channel.start_consuming()
+    consume()
+    try:
+        channel.start_consuming()
+    finally:
+        # Unacknowledged messages are redelivered, so whatever the workers still hold is dropped
+        resolver.shutdown(wait=False, cancel_futures=True)
+        lanes.shutdown(wait=False, cancel_futures=True)
+        log_executor.shutdown(wait=False)
+        if batcher is not None:
+            batcher.close()
+        if outbox is not None:
+            outbox.close()
 
 if __name__ == '__main__':
     # Create a custom logger
     logger = init_logger("__consumer__")
     try:
+        metrics.start_server(CONSUMER_METRICS_PORT)
+        try:
+            open_store()
+        except Exception as e:
+            logger.warning(f"UUID store unavailable, mappings are only cached in memory: {e}")
+        MappingSync().start()
         authenticate()
         main()
     except Exception as e:
@@ -0,0 +1,41 @@
+import hashlib
+import json
+import sys, os
+
+if os.path.isdir('/app'):
+    sys.path.append('/app')
+else:
+    local_dir = os.path.dirname(os.path.realpath(__file__))
+    sys.path.append(local_dir)
+import metrics
+from cache import LRUCache
+
+
+# Remembers a hash of the last payload written to every Salesforce record, so re-broadcasts of unchanged
+# records can skip the PATCH (and the change event it would cause). Entries expire after `ttl` seconds
+# to bound how long an edit made directly in Salesforce can hide behind a remembered payload.
+class PayloadFingerprints:
+    def __init__(self, maxsize=10000, ttl=3600):
+        self.cache = LRUCache('payload_fingerprints', maxsize, ttl)
+
+    @staticmethod
+    def digest(payload):
+        if isinstance(payload, dict):
+            payload = json.dumps({field: value for field, value in payload.items() if field != 'Id'}, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    # True when the payload matches what was last written to this record
+    def unchanged(self, sobject, record_id, payload):
+        if record_id is None:
+            return False
+        if self.cache.get(record_id, None) == self.digest(payload):
+            metrics.inc('crm_skipped_updates_total', sobject=sobject)
+            return True
+        return False
+
+    def remember(self, record_id, payload):
+        if record_id is not None:
+            self.cache.set(record_id, self.digest(payload))
+
+    def forget(self, record_id):
+        self.cache.delete(record_id)
@@ -0,0 +1,29 @@
+import requests
+from requests.adapters import HTTPAdapter
+
+
+# Create a keep-alive session backed by a bounded connection pool.
+# The urllib3 pool behind the adapter is thread-safe, so one session can be shared by every worker thread;
+# with pool_block set, callers wait for a free connection instead of opening throwaway ones.
+def create_session(pool_size=10, headers=None):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if headers:
+        session.headers.update(headers)
+    return session
+
+
+# Connections opened and requests sent over all pools of a session, the difference is the number of reused connections
+def pool_stats(session):
+    connections = requests_sent = 0
+    # The same adapter is mounted for http and https
+    for adapter in {id(adapter): adapter for adapter in session.adapters.values()}.values():
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+                requests_sent += pool.num_requests
+    return connections, requests_sent
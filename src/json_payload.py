@@ -0,0 +1,90 @@
+from datetime import datetime
+
+# JSON counterparts of the write_xml_* builders in xml_parser.py.
+# They take the same variables and return the sObject fields as a dict, which the Salesforce client sends as
+# application/json and the Composite and Collections endpoints take as records without any further conversion.
+
+
+def _sobject_fields(values):
+    return {f'{field}__c': value for field, value in values.items() if value != '' and value != None}
+
+
+def write_json_user(id, first_name, last_name, email, telephone, birthday, country, state, city, zip, street,
+                    house_number, company_email, company_id, source, user_role, invoice, calendar_link):
+    return _sobject_fields({
+        "first_name": first_name,
+        "last_name": last_name,
+        "email": email,
+        "telephone": telephone,
+        "birthday": birthday,
+        "country": country,
+        "state": state,
+        "city": city,
+        "zip": zip,
+        "street": street,
+        "house_number": house_number,
+        "company_email": company_email,
+        "company_id": company_id,
+        "source": source,
+        "user_role": user_role,
+        "invoice": invoice,
+        "calendar_link": calendar_link,
+    })
+
+
+def write_json_company(id, name, email, telephone, country, state, city, zip, street, house_number, sponsor, invoice):
+    return _sobject_fields({
+        "name": name,
+        "email": email,
+        "telephone": telephone,
+        "country": country,
+        "state": state,
+        "city": city,
+        "zip": zip,
+        "street": street,
+        "house_number": house_number,
+        "sponsor": sponsor,
+        "invoice": invoice,
+    })
+
+
+def write_json_event(id, title, date, start_time, end_time, location, user_id, company_id, max_registrations, available_seats, description):
+    return _sobject_fields({
+        "title": title,
+        "date": date,
+        "start_time": "" if start_time == None else datetime.strptime(start_time, '%H:%M:%S').strftime('%H:%M:%S'),
+        "end_time": "" if end_time == None else datetime.strptime(end_time, '%H:%M:%S').strftime('%H:%M:%S'),
+        "location": location,
+        "user_id": user_id,
+        "company_id": company_id,
+        "max_registrations": max_registrations,
+        "available_seats": available_seats,
+        "description": description,
+    })
+
+
+def write_json_attendance(id, user_id, event_id):
+    return _sobject_fields({
+        "user_id": user_id,
+        "event_id": event_id,
+    })
+
+
+def write_json_product(id, name):
+    # Name is a standard field, so it has no __c suffix
+    return {"Name": name} if name != '' and name != None else {}
+
+
+def write_json_order(user_id, company_id, product_id, amount):
+    return _sobject_fields({
+        "user_id": user_id,
+        "company_id": company_id,
+        "product_id": product_id,
+        "amount": amount,
+    })
+
+
+def write_json_existing_order(amount):
+    return _sobject_fields({
+        "amount": amount,
+    })
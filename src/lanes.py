@@ -0,0 +1,56 @@
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import sys, os
+
+if os.path.isdir('/app'):
+    sys.path.append('/app')
+else:
+    local_dir = os.path.dirname(os.path.realpath(__file__))
+    sys.path.append(local_dir)
+import metrics
+
+
+# A fixed number of single-threaded lanes: calls with the same key always run on the same lane, one after the other
+# and in submission order, while calls with other keys run on the other lanes in parallel.
+# The calls queued or running on every lane are exported as crm_lane_occupancy.
+class SerialLanes:
+    def __init__(self, name, count):
+        self.name = name
+        self.lock = threading.Lock()
+        self.occupancy = [0] * count
+        self.lanes = [ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'{name}-{index}') for index in range(count)]
+        for index in range(count):
+            self._export(index)
+
+    # Keys are hashed with crc32, which unlike hash() is the same in every process
+    def lane(self, key):
+        return zlib.crc32(key.encode()) % len(self.lanes)
+
+    def submit(self, key, call, *args, **kwargs):
+        index = self.lane(key)
+        self._occupy(index, 1)
+        try:
+            return self.lanes[index].submit(self._run, index, call, *args, **kwargs)
+        except BaseException:
+            self._occupy(index, -1)
+            raise
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        for lane in self.lanes:
+            lane.shutdown(wait=wait, cancel_futures=cancel_futures)
+
+    def _run(self, index, call, *args, **kwargs):
+        try:
+            return call(*args, **kwargs)
+        finally:
+            self._occupy(index, -1)
+
+    def _occupy(self, index, delta):
+        with self.lock:
+            self.occupancy[index] += delta
+            self._export(index)
+
+    def _export(self, index):
+        metrics.set_gauge('crm_lane_occupancy', self.occupancy[index], lanes=self.name, lane=str(index))
+        metrics.set_gauge('crm_lanes_busy', sum(1 for occupied in self.occupancy if occupied), lanes=self.name)
@@ -0,0 +1,85 @@
+import functools
+import socket
+import threading
+import time
+import pika
+import sys, os
+
+if os.path.isdir('/app'):
+    sys.path.append('/app')
+else:
+    local_dir = os.path.dirname(os.path.realpath(__file__))
+    sys.path.append(local_dir)
+import config.secrets as secrets
+import broadcast
+import metrics
+import uuidapi
+from logger import init_logger
+
+MAPPING_EXCHANGE = 'crm.uuid_mappings'
+MAPPING_SYNC_RETRY_DELAY = getattr(secrets, 'MAPPING_SYNC_RETRY_DELAY', 5)
+
+# Identifies this process in the changes it broadcasts, so it can skip its own
+ORIGIN = f'{socket.gethostname()}:{os.getpid()}'
+
+
+# Broadcasts the mapping changes made by this process and applies those of every other process to its UUID caches.
+# It runs its own RabbitMQ connection on a daemon thread, because pika connections may only be used from the thread that owns them.
+# Changes missed while the connection is down are covered by clearing the caches on reconnect, the local store stays current.
+class MappingSync:
+    def __init__(self):
+        self.connection = None
+        self.channel = None
+        self.thread = threading.Thread(target=self._run, daemon=True, name='mapping-sync')
+
+    def start(self):
+        uuidapi.add_change_listener(self.publish)
+        self.thread.start()
+
+    # Called from any thread, the message is published from the sync thread
+    def publish(self, action, master_uuid, service_id, service):
+        connection = self.connection
+        if connection is None or not connection.is_open:
+            metrics.inc('crm_mapping_changes_dropped_total', action=action)
+            return
+        message = {'origin': ORIGIN, 'action': action, 'master_uuid': master_uuid, 'service_id': service_id, 'service': service}
+        connection.add_callback_threadsafe(functools.partial(self._publish, message))
+
+    def _publish(self, message):
+        broadcast.publish(self.channel, MAPPING_EXCHANGE, message)
+        metrics.inc('crm_mapping_changes_sent_total', action=message['action'])
+
+    # The process that made the change already wrote it to the shared store, only the caches are updated here
+    def apply(self, message):
+        if message.get('origin') == ORIGIN:
+            return
+        match message['action']:
+            case 'add':
+                uuidapi.remember_mapping(message['master_uuid'], message['service_id'], message['service'], persist=False)
+            case 'delete':
+                uuidapi.forget_mapping(message['master_uuid'], message['service'], persist=False, service_id=message['service_id'])
+        metrics.inc('crm_mapping_changes_received_total', action=message['action'])
+
+    def _run(self):
+        connected_before = False
+        while True:
+            try:
+                credentials = pika.PlainCredentials(secrets.RABBITMQ_USER, secrets.RABBITMQ_PASSWORD)
+                connection = pika.BlockingConnection(pika.ConnectionParameters(host=secrets.HOST, port=secrets.RABBITMQ_PORT, credentials=credentials))
+                self.channel = connection.channel()
+                broadcast.subscribe(self.channel, MAPPING_EXCHANGE, self.apply)
+                self.connection = connection
+                if connected_before:
+                    uuidapi.service_ids.clear()
+                    uuidapi.master_uuids.clear()
+                connected_before = True
+                logger.info(f"Syncing UUID mappings over {MAPPING_EXCHANGE}")
+                self.channel.start_consuming()
+            except Exception as e:
+                logger.warning(f"UUID mapping sync disconnected, reconnecting in {MAPPING_SYNC_RETRY_DELAY}s: {e}")
+            self.connection = None
+            time.sleep(MAPPING_SYNC_RETRY_DELAY)
+
+
+# Create a custom logger
+logger = init_logger("__mapping_sync__")
@@ -0,0 +1,91 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# In-process metrics registry, served in the Prometheus text format by start_server()
+lock = threading.Lock()
+counters = {}
+gauges = {}
+summaries = {}
+collectors = []
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    with lock:
+        key = _key(name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    with lock:
+        gauges[_key(name, labels)] = value
+
+
+# Record one observation, exported as <name>_count, <name>_sum and <name>_max
+def observe(name, value, **labels):
+    with lock:
+        summary = summaries.setdefault(_key(name, labels), {'count': 0, 'sum': 0.0, 'max': 0.0})
+        summary['count'] += 1
+        summary['sum'] += value
+        summary['max'] = max(summary['max'], value)
+
+
+# Collectors are called before every export, to refresh gauges that are cheaper to read on demand
+def register_collector(collector):
+    collectors.append(collector)
+
+
+def get(name, **labels):
+    key = _key(name, labels)
+    with lock:
+        if key in counters:
+            return counters[key]
+        if key in gauges:
+            return gauges[key]
+        return dict(summaries[key]) if key in summaries else None
+
+
+def _format(name, labels, value):
+    if labels:
+        label_text = ','.join(f'{label}="{label_value}"' for label, label_value in labels)
+        return f'{name}{{{label_text}}} {value}'
+    return f'{name} {value}'
+
+
+def render():
+    for collector in collectors:
+        collector()
+
+    lines = []
+    with lock:
+        for (name, labels), value in sorted(counters.items()):
+            lines.append(_format(name, labels, value))
+        for (name, labels), value in sorted(gauges.items()):
+            lines.append(_format(name, labels, value))
+        for (name, labels), summary in sorted(summaries.items()):
+            for field in ('count', 'sum', 'max'):
+                lines.append(_format(f'{name}_{field}', labels, summary[field]))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Serve the metrics over HTTP from a daemon thread
+def start_server(port):
+    server = ThreadingHTTPServer(('0.0.0.0', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -37,11 +37,6 @@ def heartbeat(timestamp):
     channel.basic_publish(exchange='', routing_key='heartbeat_queue', body=heartbeat_xml)
 
 def log(logger, process, message, error='false'):
-    credentials = pika.PlainCredentials('user', 'password')
-    connection = pika.BlockingConnection(pika.ConnectionParameters(host=secrets.HOST, credentials=credentials))
-    channel = connection.channel()
-    channel.exchange_declare(exchange="amq.topic", exchange_type="topic", durable=True)
-
     loggin_xml = f'''
         <LogEntry>
             <SystemName>{TEAM}</SystemName>
@@ -62,7 +57,14 @@ def log(logger, process, message, error='false'):
         logger.error('Invalid XML')
         return
 
-    channel.basic_publish(exchange='amq.topic', routing_key='logs', body=loggin_xml)
+    credentials = pika.PlainCredentials('user', 'password')
+    connection = pika.BlockingConnection(pika.ConnectionParameters(host=secrets.HOST, credentials=credentials))
+    try:
+        channel = connection.channel()
+        channel.exchange_declare(exchange="amq.topic", exchange_type="topic", durable=True)
+        channel.basic_publish(exchange='amq.topic', routing_key='logs', body=loggin_xml)
+    finally:
+        connection.close()
     logger.debug('Sent logs to controlroom.')
 
 if __name__ == '__main__':
@@ -0,0 +1,84 @@
+import threading
+import sys, os
+
+if os.path.isdir('/app'):
+    sys.path.append('/app')
+else:
+    local_dir = os.path.dirname(os.path.realpath(__file__))
+    sys.path.append(local_dir)
+import config.secrets as secrets
+from cache import LRUCache
+from change_events import is_own_change
+
+# Fanout exchange the publisher shares order__c change events on
+ORDER_EXCHANGE = 'crm.orders'
+
+# Entries are evicted least recently used first, and dropped after ORDER_INDEX_TTL seconds in case change events were missed
+ORDER_INDEX_SIZE = getattr(secrets, 'ORDER_INDEX_SIZE', 10000)
+ORDER_INDEX_TTL = getattr(secrets, 'ORDER_INDEX_TTL', 3600)
+
+
+# Local index of (owner id, product id) -> (order id, amount).
+# It is written through by the consumer after every order write, so repeat orders can be incremented without first
+# querying Salesforce for the current amount. Order changes made by anyone else invalidate the entries they touch.
+# Both directions are bounded LRU caches. An entry whose order id was evicted from the reverse map could no longer be
+# invalidated by its change events, so it is only used while the reverse entry still points back at it.
+class OrderIndex:
+    def __init__(self, maxsize=ORDER_INDEX_SIZE, ttl=ORDER_INDEX_TTL):
+        self.lock = threading.Lock()
+        self.orders = LRUCache('order_index', maxsize, ttl)
+        self.keys = LRUCache('order_index_keys', maxsize, ttl)
+
+    def get(self, owner_id, product_id):
+        with self.lock:
+            entry = self.orders.get((owner_id, product_id), None)
+            if entry is None:
+                return None
+            if self.keys.get(entry[0]) != (owner_id, product_id):
+                self.orders.delete((owner_id, product_id))
+                return None
+            return entry
+
+    def put(self, owner_id, product_id, order_id, amount):
+        with self.lock:
+            self.keys.set(order_id, (owner_id, product_id))
+            self.orders.set((owner_id, product_id), (order_id, amount))
+
+    def invalidate(self, order_id):
+        with self.lock:
+            key = self.keys.pop(order_id)
+            if key is not None:
+                self.orders.delete(key)
+
+    def invalidate_key(self, owner_id, product_id):
+        with self.lock:
+            entry = self.orders.pop((owner_id, product_id))
+            if entry is not None:
+                self.keys.delete(entry[0])
+
+    def clear(self):
+        with self.lock:
+            self.orders.clear()
+            self.keys.clear()
+
+    # Apply an order__c change data capture event.
+    # Events of our own writes arrive seconds late and are skipped, the index already holds what we wrote and
+    # applying them could overwrite a newer amount. Other changes only invalidate, the next order queries Salesforce.
+    def apply_change_event(self, change_event):
+        header = change_event['ChangeEventHeader']
+        if is_own_change(header):
+            return
+
+        match header['changeType']:
+            case 'CREATE' | 'UNDELETE':
+                owner_id = change_event.get('user_id__c') or change_event.get('company_id__c')
+                if owner_id and change_event.get('product_id__c'):
+                    self.invalidate_key(owner_id, change_event['product_id__c'])
+                for order_id in header['recordIds']:
+                    self.invalidate(order_id)
+            case 'UPDATE' | 'DELETE':
+                for order_id in header['recordIds']:
+                    self.invalidate(order_id)
+            case _:
+                # Gap and overflow events do not say what changed
+                self.clear()
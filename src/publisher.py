@@ -23,8 +23,14 @@ from API import *
 from uuidapi import *
 from xml_parser import *
 from logger import init_logger
+from order_index import ORDER_EXCHANGE
+from change_events import is_own_change
+from mapping_sync import MappingSync
+import broadcast
+import metrics
 
 TEAM = 'crm'
+PUBLISHER_METRICS_PORT = getattr(secrets, 'PUBLISHER_METRICS_PORT', 9967)
 semaphore = threading.Semaphore(1)
 latest_replay_id = None
 
@@ -52,11 +58,42 @@ def authenticate_rabbitmq():
     return channel
 
 
+# Order changes are shared over one channel, opened on first use and again when the connection dropped in between
+order_channel = None
+
+def share_order_change(change_event):
+    global order_channel
+    for attempt in range(2):
+        try:
+            if order_channel is None or order_channel.is_closed:
+                order_channel = authenticate_rabbitmq()
+            broadcast.publish(order_channel, ORDER_EXCHANGE, change_event)
+            return
+        except Exception as e:
+            close_order_channel()
+            if attempt == 1:
+                logger.error(f"Failed to share order change: {e}")
+
+def close_order_channel():
+    global order_channel
+    channel, order_channel = order_channel, None
+    try:
+        if channel is not None and channel.connection.is_open:
+            channel.connection.close()
+    except Exception:
+        pass
+
+
 def handle_change_event(change_event):
     change_event_header = change_event['ChangeEventHeader']
 
-    if (change_event_header['changeOrigin'] == 'com/salesforce/api/rest/60.0'):
-        return # This means the event was generated by the REST API, so we received it through our consumer so we DO NOT want to send it back to the queue
+    if is_own_change(change_event_header):
+        return # This means the event was generated by our own writes, so we received it through our consumer so we DO NOT want to send it back to the queue
+
+    # Order changes are not published to other teams, they only keep the consumer's order index current
+    if change_event_header['entityName'] == 'order__c':
+        share_order_change(change_event)
+        return
 
     object_type = f"{change_event_header['entityName']}"[:-3]
     crud_operation = f"{change_event_header['changeType']}".lower()
@@ -115,6 +152,12 @@ def handle_change_event(change_event):
 if __name__ == '__main__':
     logger = init_logger("__publisher__")
     try:
+        metrics.start_server(PUBLISHER_METRICS_PORT)
+        try:
+            open_store()
+        except Exception as e:
+            logger.warning(f"UUID store unavailable, mappings are only cached in memory: {e}")
+        MappingSync().start()
         authenticate()
         with open(certifi.where(), 'rb') as f:
             creds = grpc.ssl_channel_credentials(f.read())
@@ -0,0 +1,145 @@
+import asyncio
+import re
+import threading
+import time
+import sys, os
+
+if os.path.isdir('/app'):
+    sys.path.append('/app')
+else:
+    local_dir = os.path.dirname(os.path.realpath(__file__))
+    sys.path.append(local_dir)
+import metrics
+
+# The org-wide usage, not the per-app-api-usage Salesforce may report next to it
+LIMIT_INFO = re.compile(r'(?<![\w-])api-usage=(\d+)/(\d+)')
+
+
+# AIMD concurrency limit on Salesforce requests, driven by the org's API usage.
+# Every response reports the usage in its Sforce-Limit-Info header ("api-usage=25/5000").
+# Well below the budget the limit grows by one per response up to max_concurrency. Over the last `ramp` of usage
+# before the budget the ceiling on the limit falls linearly to min_concurrency and requests are paced at a growing
+# fraction of `pace` seconds apart. At the budget the limit is halved on every response and requests are paced a full
+# `pace` seconds apart, so consumption slows down gradually before the daily limit is exhausted.
+# The gauges are labelled with the client the limiter belongs to.
+class AdaptiveLimiter:
+    def __init__(self, budget=0.8, max_concurrency=10, min_concurrency=1, pace=1.0, ramp=0.1, client='blocking'):
+        self.client = client
+        self.budget = budget
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.pace = pace
+        self.ramp = ramp
+        self.condition = threading.Condition()
+        self.limit = max_concurrency
+        self.in_flight = 0
+        self.over_budget = False
+        self.interval = 0.0
+        self.next_slot = 0.0
+
+    def acquire(self):
+        started = time.monotonic()
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+            delay = self._reserve()
+        if delay > 0:
+            time.sleep(delay)
+        metrics.observe('crm_salesforce_limiter_wait_seconds', time.monotonic() - started, client=self.client)
+        self._export()
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self._wake()
+        self._export()
+
+    # Adjust the limit to the usage reported in a Sforce-Limit-Info header
+    def observe(self, limit_info):
+        match = LIMIT_INFO.search(limit_info or '')
+        if match is None:
+            return
+        used, maximum = int(match.group(1)), int(match.group(2))
+        usage = used / maximum if maximum else 0.0
+
+        with self.condition:
+            self.over_budget = usage >= self.budget
+            if self.over_budget:
+                self.limit = max(self.min_concurrency, self.limit // 2)
+                self.interval = self.pace
+            else:
+                pressure = self.pressure(usage)
+                ceiling = self.max_concurrency - round(pressure * (self.max_concurrency - self.min_concurrency))
+                self.limit = min(ceiling, self.limit + 1)
+                self.interval = self.pace * pressure
+            self._wake()
+
+        metrics.set_gauge('crm_salesforce_api_usage', used)
+        metrics.set_gauge('crm_salesforce_api_limit', maximum)
+        metrics.set_gauge('crm_salesforce_api_usage_ratio', round(usage, 4))
+        self._export()
+
+    # Called under the lock for a request that got a slot, returns how long it has to wait for its turn while paced
+    def _reserve(self):
+        if self.interval <= 0:
+            return 0.0
+        now = time.monotonic()
+        self.next_slot = max(self.next_slot, now) + self.interval
+        return self.next_slot - self.interval - now
+
+    # Called under the lock whenever a slot may have come free
+    def _wake(self):
+        self.condition.notify_all()
+
+    # How far the usage is into the ramp before the budget, from 0.0 at its start to 1.0 at the budget
+    def pressure(self, usage):
+        if self.ramp <= 0:
+            return 0.0
+        return min(1.0, max(0.0, (usage - (self.budget - self.ramp)) / self.ramp))
+
+    def _export(self):
+        metrics.set_gauge('crm_salesforce_concurrency_limit', self.limit, client=self.client)
+        metrics.set_gauge('crm_salesforce_in_flight', self.in_flight, client=self.client)
+        metrics.set_gauge('crm_salesforce_over_budget', int(self.over_budget), client=self.client)
+        metrics.set_gauge('crm_salesforce_pace_seconds', self.interval, client=self.client)
+
+
+# The same limit for the coroutines of one event loop: acquire() is awaited and never blocks a thread.
+# Cancelling a waiting acquire() takes no slot, cancelling it while it is paced gives its slot back.
+class AsyncAdaptiveLimiter(AdaptiveLimiter):
+    def __init__(self, budget=0.8, max_concurrency=10, min_concurrency=1, pace=1.0, ramp=0.1, client='async'):
+        super().__init__(budget, max_concurrency, min_concurrency, pace, ramp, client)
+        self.waiters = []
+
+    async def acquire(self):
+        started = time.monotonic()
+        while True:
+            with self.condition:
+                if self.in_flight < self.limit:
+                    self.in_flight += 1
+                    delay = self._reserve()
+                    break
+                waiter = asyncio.get_running_loop().create_future()
+                self.waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                with self.condition:
+                    if waiter in self.waiters:
+                        self.waiters.remove(waiter)
+        if delay > 0:
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                self.release()
+                raise
+        metrics.observe('crm_salesforce_limiter_wait_seconds', time.monotonic() - started, client=self.client)
+        self._export()
+
+    # Only called from the event loop's thread, like acquire()
+    def _wake(self):
+        for waiter in self.waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self.waiters.clear()
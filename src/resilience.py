@@ -0,0 +1,158 @@
+import asyncio
+import random
+import threading
+import time
+import aiohttp
+import requests
+import sys, os
+
+if os.path.isdir('/app'):
+    sys.path.append('/app')
+else:
+    local_dir = os.path.dirname(os.path.realpath(__file__))
+    sys.path.append(local_dir)
+import config.secrets as secrets
+import metrics
+
+# Retry and circuit breaker settings shared by the Salesforce and UUID service clients
+RETRY_ATTEMPTS = getattr(secrets, 'RETRY_ATTEMPTS', 3)
+RETRY_BASE_DELAY = getattr(secrets, 'RETRY_BASE_DELAY', 0.2)
+RETRY_MAX_DELAY = getattr(secrets, 'RETRY_MAX_DELAY', 5.0)
+BREAKER_FAILURE_THRESHOLD = getattr(secrets, 'BREAKER_FAILURE_THRESHOLD', 5)
+BREAKER_RESET_TIMEOUT = getattr(secrets, 'BREAKER_RESET_TIMEOUT', 30.0)
+
+CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, endpoint, retry_after):
+        super().__init__(f"Circuit for {endpoint} is open, retry in {retry_after:.0f}s")
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+
+# Opens after `failure_threshold` consecutive failures and rejects calls for `reset_timeout` seconds.
+# After that a single trial call is let through: success closes the circuit, failure opens it again.
+class CircuitBreaker:
+    def __init__(self, endpoint, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.endpoint = endpoint
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._export()
+
+    def retry_after(self):
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    # Raise CircuitOpenError unless a call may go through
+    def check(self):
+        with self.lock:
+            if self.state == CLOSED:
+                return
+            if self.retry_after() > 0:
+                raise CircuitOpenError(self.endpoint, self.retry_after())
+            # Let one trial call through, and another one if that trial never reported back
+            self.state = HALF_OPEN
+            self.opened_at = time.monotonic()
+            self._export()
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            if self.state != CLOSED:
+                self.state = CLOSED
+                self._export()
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            metrics.inc('crm_request_failures_total', endpoint=self.endpoint)
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    metrics.inc('crm_circuit_opened_total', endpoint=self.endpoint)
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+                self._export()
+
+    def _export(self):
+        metrics.set_gauge('crm_circuit_state', self.state, endpoint=self.endpoint)
+
+
+breakers = {}
+breakers_lock = threading.Lock()
+
+
+def get_breaker(endpoint):
+    with breakers_lock:
+        if endpoint not in breakers:
+            breakers[endpoint] = CircuitBreaker(endpoint)
+        return breakers[endpoint]
+
+
+# Server errors and throttling responses count as failures and may be retried
+def is_transient(response):
+    status = getattr(response, 'status_code', getattr(response, 'status', None))
+    return isinstance(status, int) and (status >= 500 or status == 429)
+
+
+# Errors that mean the dependency could not be reached or did not answer in time
+NETWORK_ERRORS = (requests.ConnectionError, requests.Timeout, aiohttp.ClientConnectionError, asyncio.TimeoutError)
+
+
+# A request that never reached the server can always be retried, anything else only when it is idempotent
+def is_retryable(error, idempotent):
+    if isinstance(error, (requests.ConnectTimeout, aiohttp.ClientConnectorError)):
+        return True
+    return idempotent
+
+
+def backoff(attempt):
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+# Call send() through the endpoint's circuit breaker, retrying transient failures with full-jitter backoff.
+# Non-idempotent calls are only retried when the request could not have reached the server.
+# After the last attempt the final response is returned, or the final error raised.
+def call(endpoint, send, idempotent=True, attempts=RETRY_ATTEMPTS):
+    breaker = get_breaker(endpoint)
+    for attempt in range(attempts):
+        breaker.check()
+        try:
+            response = send()
+        except NETWORK_ERRORS as e:
+            breaker.record_failure()
+            if attempt == attempts - 1 or not is_retryable(e, idempotent):
+                raise
+        else:
+            if not is_transient(response):
+                breaker.record_success()
+                return response
+            breaker.record_failure()
+            if attempt == attempts - 1 or not idempotent:
+                return response
+        metrics.inc('crm_retries_total', endpoint=endpoint)
+        time.sleep(backoff(attempt))
+
+
+async def call_async(endpoint, send, idempotent=True, attempts=RETRY_ATTEMPTS):
+    breaker = get_breaker(endpoint)
+    for attempt in range(attempts):
+        breaker.check()
+        try:
+            response = await send()
+        except NETWORK_ERRORS as e:
+            breaker.record_failure()
+            if attempt == attempts - 1 or not is_retryable(e, idempotent):
+                raise
+        else:
+            if not is_transient(response):
+                breaker.record_success()
+                return response
+            breaker.record_failure()
+            if attempt == attempts - 1 or not idempotent:
+                return response
+        metrics.inc('crm_retries_total', endpoint=endpoint)
+        await asyncio.sleep(backoff(attempt))
@@ -0,0 +1,42 @@
+import threading
+from concurrent.futures import Future
+import sys, os
+
+if os.path.isdir('/app'):
+    sys.path.append('/app')
+else:
+    local_dir = os.path.dirname(os.path.realpath(__file__))
+    sys.path.append(local_dir)
+import metrics
+
+
+# Coalesces concurrent calls for the same key: the first caller runs the call and every caller arriving while it runs
+# waits for it and gets the same result, or the same exception. Nothing is remembered once the call is done.
+class SingleFlight:
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, call):
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = Future()
+        if not leader:
+            metrics.inc('crm_single_flight_shared_total', group=self.name)
+            return future.result()
+
+        metrics.inc('crm_single_flight_calls_total', group=self.name)
+        try:
+            result = call()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.calls[key]
@@ -0,0 +1,99 @@
+import threading
+import time
+import jwt
+import requests
+from cryptography.hazmat.primitives import serialization
+import sys, os
+
+if os.path.isdir('/app'):
+    sys.path.append('/app')
+else:
+    local_dir = os.path.dirname(os.path.realpath(__file__))
+    sys.path.append(local_dir)
+from logger import init_logger
+
+
+# Holds the Salesforce access token obtained through the OAuth JWT bearer flow.
+# The private key is parsed once, the token is cached with its expiry and renewed by a background thread
+# refresh_margin seconds before it runs out. Listeners are called with every new token.
+class TokenManager:
+    def __init__(self, key_file, issuer, subject, token_url, session_timeout=7200, refresh_margin=300):
+        with open(key_file, 'rb') as file:
+            self.private_key = serialization.load_pem_private_key(file.read(), password=None)
+        self.issuer = issuer
+        self.subject = subject
+        self.token_url = token_url
+        self.session_timeout = session_timeout
+        self.refresh_margin = refresh_margin
+        self.lock = threading.Lock()
+        self.token = None
+        self.expires_at = 0
+        self.listeners = []
+        self.refresher = None
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    # Return a valid token, fetching a new one if the cached token has expired
+    def get_token(self):
+        with self.lock:
+            if self.token is None or time.time() >= self.expires_at:
+                self._refresh()
+            return self.token
+
+    # Called after a 401, only refreshes if nobody else replaced the rejected token in the meantime
+    def invalidate(self, rejected_token):
+        with self.lock:
+            if rejected_token == self.token:
+                self._refresh()
+            return self.token
+
+    # Start renewing the token in the background before it expires
+    def start(self):
+        if self.refresher is None:
+            self.refresher = threading.Thread(target=self._run_refresher, daemon=True)
+            self.refresher.start()
+
+    def _refresh(self):
+        claim_set = {
+            'iss': self.issuer,
+            'exp': int(time.time()) + 300,
+            'aud': 'https://login.salesforce.com',
+            'sub': self.subject
+        }
+        assertion = jwt.encode(claim_set, self.private_key, algorithm='RS256', headers={'alg': 'RS256'})
+
+        response = requests.post(self.token_url,
+                                 data={
+                                     'grant_type': 'urn:ietf:params:oauth:grant-type:jwt-bearer',
+                                     'assertion': assertion
+                                 },
+                                 timeout=30)
+        response.raise_for_status()
+        data = response.json()
+
+        # The JWT bearer flow does not return expires_in, the lifetime is the org's session timeout
+        issued_at = int(data.get('issued_at', time.time() * 1000)) / 1000
+        self.token = data['access_token']
+        self.expires_at = issued_at + self.session_timeout
+        logger.info("Authenticated successfully")
+        for listener in self.listeners:
+            listener(self.token)
+
+    def _run_refresher(self):
+        while True:
+            with self.lock:
+                delay = self.expires_at - self.refresh_margin - time.time()
+            if delay > 0:
+                time.sleep(delay)
+                continue
+            try:
+                with self.lock:
+                    self._refresh()
+            except Exception as e:
+                logger.error(f"Failed to refresh access token: {e}")
+                time.sleep(30)
+
+
+# Create a custom logger
+logger = init_logger("__token_manager__")
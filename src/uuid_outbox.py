@@ -0,0 +1,89 @@
+import sqlite3
+import threading
+import sys, os
+
+if os.path.isdir('/app'):
+    sys.path.append('/app')
+else:
+    local_dir = os.path.dirname(os.path.realpath(__file__))
+    sys.path.append(local_dir)
+import config.secrets as secrets
+import metrics
+import uuidapi
+from logger import init_logger
+
+# Write new mappings to the UUID service in the background instead of before the message is acknowledged
+UUID_WRITE_BEHIND = getattr(secrets, 'UUID_WRITE_BEHIND', True)
+UUID_OUTBOX_FLUSH_SIZE = getattr(secrets, 'UUID_OUTBOX_FLUSH_SIZE', 100)
+UUID_OUTBOX_FLUSH_INTERVAL = getattr(secrets, 'UUID_OUTBOX_FLUSH_INTERVAL', 0.5)
+UUID_OUTBOX_MAX_DELAY = getattr(secrets, 'UUID_OUTBOX_MAX_DELAY', 300)
+
+
+# Write-behind queue for add_service_id: a mapping is committed to the local store's outbox table and cached right away,
+# and a timer thread writes the outbox to the UUID service in batches. Failed writes stay queued and are retried
+# with exponential backoff, also by the next process when this one stops before they went through.
+class MappingOutbox:
+    def __init__(self, store, flush_size=UUID_OUTBOX_FLUSH_SIZE, flush_interval=UUID_OUTBOX_FLUSH_INTERVAL):
+        self.store = store
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.flushing = threading.Lock()
+        self.stopped = threading.Event()
+        self.timer = threading.Thread(target=self._run_timer, daemon=True, name='uuid-outbox')
+        self.timer.start()
+
+    # Same signature as add_service_id, falls back to writing synchronously when the store cannot take the mapping
+    def add(self, master_uuid, service_id, service):
+        try:
+            self.store.enqueue(master_uuid, service_id, service)
+        except sqlite3.Error as e:
+            logger.warning(f"Queueing the mapping of {master_uuid} failed, writing it right away: {e}")
+            return uuidapi.add_service_id(master_uuid, service_id, service)
+        uuidapi.remember_mapping(master_uuid, service_id, service, persist=False)
+        uuidapi.notify_change('add', master_uuid, service_id, service)
+        metrics.inc('crm_uuid_outbox_queued_total')
+
+    # Write every due mapping, returns the number written
+    def flush(self):
+        written = 0
+        with self.flushing:
+            while True:
+                due = self.store.due(self.flush_size)
+                if not due:
+                    break
+                mappings = [(master_uuid, service_id, service) for master_uuid, service_id, service, _ in due]
+                try:
+                    sent = set(uuidapi.send_service_ids(mappings))
+                except Exception as e:
+                    logger.warning(f"Writing {len(mappings)} queued mappings failed: {e}")
+                    sent = set()
+                for master_uuid, service_id, service, attempts in due:
+                    if (master_uuid, service_id, service) in sent:
+                        self.store.dequeue(master_uuid, service_id, service)
+                    else:
+                        self.store.postpone(master_uuid, service_id, service, min(UUID_OUTBOX_MAX_DELAY, self.flush_interval * 2 ** attempts))
+                written += len(sent)
+                metrics.inc('crm_uuid_outbox_written_total', len(sent))
+                metrics.inc('crm_uuid_outbox_failures_total', len(due) - len(sent))
+                # Leave the rest for the next round while the UUID service is failing
+                if len(sent) < len(due):
+                    break
+            metrics.set_gauge('crm_uuid_outbox_pending', self.store.outbox_size())
+        return written
+
+    # Stop the timer thread and make a last attempt at what is queued
+    def close(self):
+        self.stopped.set()
+        self.timer.join()
+        self.flush()
+
+    def _run_timer(self):
+        while not self.stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Flushing the UUID outbox failed: {e}")
+
+
+# Create a custom logger
+logger = init_logger("__uuid_outbox__")
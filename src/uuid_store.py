@@ -0,0 +1,142 @@
+import sqlite3
+import threading
+import time
+import sys, os
+
+if os.path.isdir('/app'):
+    sys.path.append('/app')
+else:
+    local_dir = os.path.dirname(os.path.realpath(__file__))
+    sys.path.append(local_dir)
+import config.secrets as secrets
+
+# SQLite file mirroring the UUID service's mappings, on the volume next to /var/log so it survives restarts
+UUID_STORE_PATH = getattr(secrets, 'UUID_STORE_PATH', '/var/lib/crm/uuid_mappings.db')
+
+
+# Durable mirror of the (service, service_id) <-> master_uuid mappings.
+# WAL mode lets the consumer and publisher read the file concurrently while either of them writes its own new mappings.
+class UuidStore:
+    def __init__(self, path=UUID_STORE_PATH):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5.0)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS mappings (
+                service TEXT NOT NULL,
+                master_uuid TEXT NOT NULL,
+                service_id TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (service, master_uuid)
+            )
+        ''')
+        self.connection.execute('CREATE UNIQUE INDEX IF NOT EXISTS mappings_service_id ON mappings (service, service_id)')
+        # Mappings recorded locally that still have to be written to the UUID service, see uuid_outbox.py
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS outbox (
+                service TEXT NOT NULL,
+                master_uuid TEXT NOT NULL,
+                service_id TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt REAL NOT NULL,
+                PRIMARY KEY (service, master_uuid)
+            )
+        ''')
+
+    # Every stored mapping as (master_uuid, service_id, service)
+    def mappings(self, service=None):
+        with self.lock:
+            if service is None:
+                return self.connection.execute('SELECT master_uuid, service_id, service FROM mappings').fetchall()
+            return self.connection.execute('SELECT master_uuid, service_id, service FROM mappings WHERE service = ?', (service,)).fetchall()
+
+    def get_service_id(self, master_uuid, service):
+        with self.lock:
+            row = self.connection.execute('SELECT service_id FROM mappings WHERE service = ? AND master_uuid = ?', (service, master_uuid)).fetchone()
+        return row[0] if row else None
+
+    def get_master_uuid(self, service_id, service):
+        with self.lock:
+            row = self.connection.execute('SELECT master_uuid FROM mappings WHERE service = ? AND service_id = ?', (service, service_id)).fetchone()
+        return row[0] if row else None
+
+    # Store a mapping, replacing whatever either of its ids was mapped to before
+    def put(self, master_uuid, service_id, service):
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO mappings (service, master_uuid, service_id, updated_at) VALUES (?, ?, ?, ?)',
+                (service, master_uuid, service_id, time.time())
+            )
+
+    # A pending write of the mapping stays queued unless discard_pending is set,
+    # which deleting the mapping for good needs so the write cannot bring it back
+    def delete(self, master_uuid, service, discard_pending=False):
+        with self.lock:
+            self.connection.execute('DELETE FROM mappings WHERE service = ? AND master_uuid = ?', (service, master_uuid))
+            if discard_pending:
+                self.connection.execute('DELETE FROM outbox WHERE service = ? AND master_uuid = ?', (service, master_uuid))
+
+    # Store a mapping and queue it for the UUID service in one transaction
+    def enqueue(self, master_uuid, service_id, service):
+        now = time.time()
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO mappings (service, master_uuid, service_id, updated_at) VALUES (?, ?, ?, ?)',
+                    (service, master_uuid, service_id, now)
+                )
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO outbox (service, master_uuid, service_id, attempts, next_attempt) VALUES (?, ?, ?, 0, ?)',
+                    (service, master_uuid, service_id, now)
+                )
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+
+    # Queued mappings that are due, oldest first, as (master_uuid, service_id, service, attempts)
+    def due(self, limit):
+        with self.lock:
+            return self.connection.execute(
+                'SELECT master_uuid, service_id, service, attempts FROM outbox WHERE next_attempt <= ? ORDER BY next_attempt LIMIT ?',
+                (time.time(), limit)
+            ).fetchall()
+
+    # Remove a written mapping from the outbox, unless it was queued again with another service id in the meantime
+    def dequeue(self, master_uuid, service_id, service):
+        with self.lock:
+            self.connection.execute('DELETE FROM outbox WHERE service = ? AND master_uuid = ? AND service_id = ?', (service, master_uuid, service_id))
+
+    def postpone(self, master_uuid, service_id, service, delay):
+        with self.lock:
+            self.connection.execute(
+                'UPDATE outbox SET attempts = attempts + 1, next_attempt = ? WHERE service = ? AND master_uuid = ? AND service_id = ?',
+                (time.time() + delay, service, master_uuid, service_id)
+            )
+
+    # Master UUIDs with a mapping still waiting in the outbox
+    def pending(self, service):
+        with self.lock:
+            return {row[0] for row in self.connection.execute('SELECT master_uuid FROM outbox WHERE service = ?', (service,))}
+
+    def outbox_size(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+# python src/uuid_store.py reconcile [service]
+# Re-resolves every stored master UUID against the UUID service in bulk, updating changed mappings and dropping removed ones
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] != 'reconcile':
+        print(f"Usage: {sys.argv[0]} reconcile [service]")
+        sys.exit(2)
+    import uuidapi
+    updated, removed = uuidapi.reconcile_store(UuidStore(), sys.argv[2] if len(sys.argv) > 2 else 'crm')
+    print(f"Reconciled UUID store: {updated} mappings updated, {removed} removed")
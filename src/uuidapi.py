@@ -1,8 +1,11 @@
 import os
 
-import requests
-import json
+import aiohttp
+import sqlite3
 import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 if os.path.isdir('/app'):
     sys.path.append('/app')
@@ -10,76 +13,401 @@ else:
     local_dir = os.path.dirname(os.path.realpath(__file__))
     sys.path.append(local_dir)
 import config.secrets as secrets
+import resilience
+import metrics
+from http_session import create_session, pool_stats
+from cache import LRUCache, MISSING
+from uuid_store import UuidStore, UUID_STORE_PATH
+from single_flight import SingleFlight
+from logger import init_logger
 
 headers = {
     "Content-Type": "application/json"
 }
 
+# Keep-alive connection pool to the UUID service, shared by every lookup in the process
+UUID_POOL_SIZE = getattr(secrets, 'UUID_POOL_SIZE', 10)
+UUID_TIMEOUT = getattr(secrets, 'UUID_TIMEOUT', (2, 10))
+uuid_session = create_session(UUID_POOL_SIZE, headers)
+
+# aiohttp counterpart for asyncio callers, created on first use inside the running event loop
+async_uuid_session = None
+
+Response = namedtuple('Response', ['status', 'data'])
+
+
+# POST a payload to an endpoint of the UUID service, with retries behind the 'uuid-service' circuit breaker
+def uuid_request(endpoint, payload, idempotent=True):
+    url = f"http://{secrets.HOST}:6000/{endpoint}"
+    started = time.monotonic()
+    try:
+        return resilience.call('uuid-service', lambda: uuid_session.post(url, json=payload, timeout=UUID_TIMEOUT), idempotent=idempotent)
+    finally:
+        metrics.observe('crm_uuid_request_seconds', time.monotonic() - started, endpoint=endpoint)
+
+
+async def get_async_uuid_session():
+    global async_uuid_session
+    if async_uuid_session is None or async_uuid_session.closed:
+        connect_timeout, read_timeout = UUID_TIMEOUT
+        async_uuid_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=UUID_POOL_SIZE, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout),
+            headers=headers
+        )
+    return async_uuid_session
+
+
+# Async variant of uuid_request, returns the status code and the decoded JSON body
+async def uuid_request_async(endpoint, payload, idempotent=True):
+    url = f"http://{secrets.HOST}:6000/{endpoint}"
+    client = await get_async_uuid_session()
+
+    async def send():
+        async with client.post(url, json=payload) as response:
+            return Response(response.status, await response.json(content_type=None))
+
+    started = time.monotonic()
+    try:
+        return await resilience.call_async('uuid-service', send, idempotent=idempotent)
+    finally:
+        metrics.observe('crm_uuid_request_seconds', time.monotonic() - started, endpoint=endpoint)
+
+
+# Connection reuse of the pooled session, read when the metrics are exported
+def collect_pool_metrics():
+    connections, requests_sent = pool_stats(uuid_session)
+    metrics.set_gauge('crm_uuid_connections_opened', connections)
+    metrics.set_gauge('crm_uuid_requests_sent', requests_sent)
+
+
+metrics.register_collector(collect_pool_metrics)
+
+# Mappings between master UUIDs and service ids hardly ever change, so both directions are cached in memory
+UUID_CACHE_SIZE = getattr(secrets, 'UUID_CACHE_SIZE', 10000)
+UUID_CACHE_TTL = getattr(secrets, 'UUID_CACHE_TTL', 3600)
+service_ids = LRUCache('service_ids', UUID_CACHE_SIZE, UUID_CACHE_TTL)
+master_uuids = LRUCache('master_uuids', UUID_CACHE_SIZE, UUID_CACHE_TTL)
+
+# Ids the UUID service reported as unmapped are remembered for a short while, they usually get mapped soon after
+UUID_NEGATIVE_TTL = getattr(secrets, 'UUID_NEGATIVE_TTL', 5)
+
+# Called with (master_uuid, service) whenever a mapping becomes known, see add_mapping_listener()
+mapping_listeners = []
+
+# Called with (action, master_uuid, service_id, service) when this process adds or deletes a mapping at the UUID service
+change_listeners = []
+
+# Batch lookup endpoint of the UUID service, taking {"MASTERUUIDS": [...], "Service": ...} and answering {master_uuid: service_id}.
+# Without it get_service_ids falls back to concurrent single lookups.
+UUID_BATCH_ENDPOINT = getattr(secrets, 'UUID_BATCH_ENDPOINT', None)
+UUID_LOOKUP_CONCURRENCY = getattr(secrets, 'UUID_LOOKUP_CONCURRENCY', 8)
+
+# Batch write endpoint of the UUID service, taking {"Mappings": [{"MasterUuid", "Service", "ServiceId"}, ...]}.
+# Without it send_service_ids falls back to concurrent single writes.
+UUID_ADD_BATCH_ENDPOINT = getattr(secrets, 'UUID_ADD_BATCH_ENDPOINT', None)
+lookup_executor = ThreadPoolExecutor(max_workers=UUID_LOOKUP_CONCURRENCY, thread_name_prefix='uuid-lookup')
+
+# Concurrent lookups of the same id share one request to the UUID service, unmapped answers included
+lookups = SingleFlight('uuid-lookups')
+
+# Durable mirror of the mappings behind the in-memory caches, opened by open_store() when a process starts
+store = None
+
+
+# Open the local mirror and warm the caches with the most recently stored mappings, returns the number of stored mappings
+def open_store(path=UUID_STORE_PATH):
+    global store
+    store = UuidStore(path)
+    mappings = store.mappings()
+    for master_uuid, service_id, service in mappings[-UUID_CACHE_SIZE:]:
+        remember_mapping(master_uuid, service_id, service, persist=False)
+    logger.info(f"Loaded {len(mappings)} UUID mappings from {path}")
+    return len(mappings)
+
+
+# Run a call on the local mirror, a broken mirror only costs the lookups it would have saved
+def from_store(method, *args):
+    if store is None:
+        return None
+    try:
+        return getattr(store, method)(*args)
+    except sqlite3.Error as e:
+        logger.warning(f"UUID store {method} failed: {e}")
+        return None
+
+
+def add_mapping_listener(listener):
+    mapping_listeners.append(listener)
+
+
+def add_change_listener(listener):
+    change_listeners.append(listener)
+
+
+def notify_change(action, master_uuid, service_id, service):
+    for listener in change_listeners:
+        try:
+            listener(action, master_uuid, service_id, service)
+        except Exception as e:
+            logger.warning(f"Mapping change listener failed: {e}")
+
+
+def remember_mapping(master_uuid, service_id, service, persist=True):
+    if master_uuid is not None and service_id is not None:
+        service_ids.set((master_uuid, service), service_id)
+        master_uuids.set((service_id, service), master_uuid)
+        if persist:
+            from_store('put', master_uuid, service_id, service)
+        for listener in mapping_listeners:
+            listener(master_uuid, service)
+
+
+# Remember that the UUID service knows no mapping for an id, for UUID_NEGATIVE_TTL seconds
+def remember_unmapped(cache, key):
+    cache.set(key, None, ttl=UUID_NEGATIVE_TTL)
+
+
+# Drop a mapping from both caches, and from the local mirror unless persist is False. Returns the service id it was mapped to.
+# Other processes pass the service id along, the mirror no longer knows it by the time they hear of the delete.
+def forget_mapping(master_uuid, service, persist=True, service_id=None):
+    cached = service_ids.pop((master_uuid, service))
+    service_id = service_id or cached or from_store('get_service_id', master_uuid, service)
+    if service_id is not None:
+        master_uuids.pop((service_id, service))
+    if persist:
+        from_store('delete', master_uuid, service, True)
+    return service_id
+
+
+# Look a mapping up in memory first and in the local mirror second, returns MISSING when neither knows it.
+# A None from memory means the id was recently reported as unmapped.
+def cached_service_id(master_uuid, service_name):
+    service_id = service_ids.get((master_uuid, service_name))
+    if service_id is MISSING:
+        service_id = from_store('get_service_id', master_uuid, service_name)
+        if service_id is None:
+            return MISSING
+        remember_mapping(master_uuid, service_id, service_name, persist=False)
+    return service_id
+
+
+def cached_master_uuid(service_id, service_name):
+    master_uuid = master_uuids.get((service_id, service_name))
+    if master_uuid is MISSING:
+        master_uuid = from_store('get_master_uuid', service_id, service_name)
+        if master_uuid is None:
+            return MISSING
+        remember_mapping(master_uuid, service_id, service_name, persist=False)
+    return master_uuid
+
 
 def create_master_uuid(service_id, service_name):
-    url = f"http://{secrets.HOST}:6000/createMasterUuid"
     payload = {
         "ServiceId": service_id,
         "Service": service_name
     }
-    response = requests.post(url, headers=headers, data=json.dumps(payload))
+    response = uuid_request('createMasterUuid', payload, idempotent=False)
     if response.status_code == 200 and response.json().get("success") or response.status_code == 201 and response.json().get("success"):
-        return response.json().get("MasterUuid")
+        master_uuid = response.json().get("MasterUuid")
+        remember_mapping(master_uuid, service_id, service_name)
+        notify_change('add', master_uuid, service_id, service_name)
+        return master_uuid
     else:
         return None
 
 
 def get_service_id(master_uuid, service_name):
-    url = f"http://{secrets.HOST}:6000/getServiceId"
+    service_id = cached_service_id(master_uuid, service_name)
+    if service_id is MISSING:
+        service_id = request_service_id(master_uuid, service_name)
+        if service_id is MISSING:
+            return None
+        if service_id is None:
+            remember_unmapped(service_ids, (master_uuid, service_name))
+        remember_mapping(master_uuid, service_id, service_name)
+    return service_id
+
+
+# Ask the UUID service for a service id, returns MISSING when it did not answer successfully
+def request_service_id(master_uuid, service_name):
+    return lookups.do(('service_id', master_uuid, service_name), lambda: post_service_id(master_uuid, service_name))
+
+
+def post_service_id(master_uuid, service_name):
     payload = {
         "MASTERUUID": master_uuid,
         "Service": service_name
     }
-    response = requests.post(url, headers=headers, data=json.dumps(payload))
+    response = uuid_request('getServiceId', payload)
     if response.status_code == 200:
         return response.json()[service_name]
     else:
-        return None
+        return MISSING
 
 
 def get_master_uuid(service_id, service_name):
-    url = f"http://{secrets.HOST}:6000/getMasterUuid"
+    master_uuid = cached_master_uuid(service_id, service_name)
+    if master_uuid is MISSING:
+        master_uuid = request_master_uuid(service_id, service_name)
+        if master_uuid is MISSING:
+            return None
+        if master_uuid is None:
+            remember_unmapped(master_uuids, (service_id, service_name))
+        remember_mapping(master_uuid, service_id, service_name)
+    return master_uuid
+
+
+def request_master_uuid(service_id, service_name):
+    return lookups.do(('master_uuid', service_id, service_name), lambda: post_master_uuid(service_id, service_name))
+
+
+def post_master_uuid(service_id, service_name):
     payload = {
         "ServiceId": service_id,
         "Service": service_name
     }
-    response = requests.post(url, headers=headers, data=json.dumps(payload))
+    response = uuid_request('getMasterUuid', payload)
     if response.status_code == 200:
         return response.json().get("UUID")
     else:
-        return None
+        return MISSING
 
 
 def add_service_id(master_uuid, service_id, service):
-    url = f"http://{secrets.HOST}:6000/addServiceId"
     payload = {
         "MasterUuid": master_uuid,
         "Service": service,
         "ServiceId": service_id
     }
-    response = requests.post(url, headers=headers, data=json.dumps(payload))
+    response = uuid_request('addServiceId', payload)
     if response.status_code == 200:
+        remember_mapping(master_uuid, service_id, service)
+        notify_change('add', master_uuid, service_id, service)
         return response.json()
     elif response.status_code == 201:
+        remember_mapping(master_uuid, service_id, service)
+        notify_change('add', master_uuid, service_id, service)
         return response.json()
     else:
         return None
 
 
+# Write (master_uuid, service_id, service) mappings to the UUID service without touching the caches,
+# returns the mappings that were written
+def send_service_ids(mappings):
+    payloads = [{"MasterUuid": master_uuid, "Service": service, "ServiceId": service_id} for master_uuid, service_id, service in mappings]
+    if len(payloads) > 1 and UUID_ADD_BATCH_ENDPOINT:
+        response = uuid_request(UUID_ADD_BATCH_ENDPOINT, {"Mappings": payloads})
+        return list(mappings) if response.status_code in (200, 201) else []
+
+    def send(payload):
+        try:
+            return uuid_request('addServiceId', payload).status_code in (200, 201)
+        except Exception as e:
+            logger.warning(f"Writing the mapping of {payload['MasterUuid']} failed: {e}")
+            return False
+
+    return [mapping for mapping, sent in zip(mappings, lookup_executor.map(send, payloads)) if sent]
+
+
 def delete_service_id(master_uuid, service):
-    url = f"http://{secrets.HOST}:6000/updateServiceId"
+    service_id = forget_mapping(master_uuid, service)
+    notify_change('delete', master_uuid, service_id, service)
     payload = {
         "MASTERUUID": master_uuid,
         "NewServiceId": None,
         "Service": service
     }
-    response = requests.post(url, headers=headers, data=json.dumps(payload))
+    response = uuid_request('updateServiceId', payload)
     if response.status_code == 200:
         return response.json()
     else:
-        return None
\ No newline at end of file
+        return None
+
+
+# Resolve many master UUIDs in one round trip, returns {master_uuid: service_id} with None for unmapped ids.
+# Ids the UUID service did not answer for are left out.
+def get_service_ids(uuids, service_name):
+    result = {}
+    missing = []
+    for master_uuid in dict.fromkeys(uuids):
+        service_id = cached_service_id(master_uuid, service_name)
+        if service_id is MISSING:
+            missing.append(master_uuid)
+        else:
+            result[master_uuid] = service_id
+
+    for master_uuid, service_id in request_service_ids(missing, service_name).items():
+        if service_id is None:
+            remember_unmapped(service_ids, (master_uuid, service_name))
+        remember_mapping(master_uuid, service_id, service_name)
+        result[master_uuid] = service_id
+    return result
+
+
+# Ask the UUID service for many service ids, through the batch endpoint when there is one and concurrently otherwise.
+# Ids the service did not answer for are left out of the result.
+def request_service_ids(uuids, service_name):
+    if len(uuids) > 1 and UUID_BATCH_ENDPOINT:
+        payload = {
+            "MASTERUUIDS": uuids,
+            "Service": service_name
+        }
+        response = uuid_request(UUID_BATCH_ENDPOINT, payload)
+        if response.status_code == 200:
+            found = response.json()
+            return {master_uuid: found.get(master_uuid) for master_uuid in uuids}
+
+    answers = lookup_executor.map(lambda master_uuid: request_service_id(master_uuid, service_name), uuids)
+    return {master_uuid: service_id for master_uuid, service_id in zip(uuids, answers) if service_id is not MISSING}
+
+
+# Async variants of the lookups for asyncio callers, sharing the caches and the local mirror
+async def get_service_id_async(master_uuid, service_name):
+    service_id = cached_service_id(master_uuid, service_name)
+    if service_id is MISSING:
+        status, data = await uuid_request_async('getServiceId', {"MASTERUUID": master_uuid, "Service": service_name})
+        if status != 200:
+            return None
+        service_id = data[service_name]
+        if service_id is None:
+            remember_unmapped(service_ids, (master_uuid, service_name))
+        remember_mapping(master_uuid, service_id, service_name)
+    return service_id
+
+
+async def get_master_uuid_async(service_id, service_name):
+    master_uuid = cached_master_uuid(service_id, service_name)
+    if master_uuid is MISSING:
+        status, data = await uuid_request_async('getMasterUuid', {"ServiceId": service_id, "Service": service_name})
+        if status != 200:
+            return None
+        master_uuid = data.get("UUID")
+        if master_uuid is None:
+            remember_unmapped(master_uuids, (service_id, service_name))
+        remember_mapping(master_uuid, service_id, service_name)
+    return master_uuid
+
+
+# Refresh a store from the UUID service: changed mappings are updated and mappings the service no longer knows are removed.
+# Mappings still waiting in the outbox are left alone, the service only lacks them because they were not written yet.
+# Returns the number of updated and removed mappings.
+def reconcile_store(target, service, chunk_size=500):
+    updated = removed = 0
+    pending = target.pending(service)
+    stored = {master_uuid: service_id for master_uuid, service_id, _ in target.mappings(service) if master_uuid not in pending}
+    uuids = list(stored)
+    for start in range(0, len(uuids), chunk_size):
+        for master_uuid, service_id in request_service_ids(uuids[start:start + chunk_size], service).items():
+            if service_id is None:
+                target.delete(master_uuid, service)
+                removed += 1
+            elif service_id != stored[master_uuid]:
+                target.put(master_uuid, service_id, service)
+                updated += 1
+    return updated, removed
+
+
+# Create a custom logger
+logger = init_logger("__uuidapi__")
@@ -12,13 +12,16 @@ from uuidapi import *
 
 TEAM = 'crm'
 
-def read_xml_user(variables, root):
+# With resolve_id=False the master UUID is kept as the id, for upserts by external id
+def read_xml_user(variables, root, resolve_id=True):
     for child in root:
         if child.tag == "routing_key" or child.tag == "crud_operation":
             continue
         elif child.tag == "address":
             for address_field in child:
                 variables[address_field.tag] = address_field.text
+        elif child.tag == "id" and not resolve_id:
+            variables[child.tag] = child.text
         elif child.tag == "id" or child.tag == "company_id":
             if (child.text is not None):
                 variables[child.tag] = get_service_id(child.text, TEAM)
@@ -138,12 +141,12 @@ def create_xml_user(user, routing_key, crud_operation):
     return user_block, uuid
 
 
-def read_xml_company(variables, root):
+def read_xml_company(variables, root, resolve_id=True):
     for child in root:
         if child.tag == "routing_key" or child.tag == "crud_operation":
             continue
         elif child.tag == "id":
-            variables[child.tag] = get_service_id(child.text, TEAM)
+            variables[child.tag] = get_service_id(child.text, TEAM) if resolve_id else child.text
         elif child.tag == "address":
             for address_field in child:
                 variables[address_field.tag] = address_field.text
@@ -242,12 +245,12 @@ def create_xml_company(company, routing_key, crud_operation):
     return ET.tostring(company_element, encoding="utf-8").decode("utf-8"), ucid
 
 
-def read_xml_event(variables, root):
+def read_xml_event(variables, root, resolve_id=True):
     for child in root:
         if child.tag == "routing_key" or child.tag == "crud_operation":
             continue
         elif child.tag == "id":
-            variables[child.tag] = get_service_id(child.text, TEAM)
+            variables[child.tag] = get_service_id(child.text, TEAM) if resolve_id else child.text
         elif child.tag == "speaker":
             for speaker_field in child:
                 variables[speaker_field.tag] = get_service_id(speaker_field.text, TEAM)
@@ -352,10 +355,12 @@ def create_xml_event(event, routing_key, crud_operation):
     return ET.tostring(event_element, encoding="utf-8").decode("utf-8"), ueid
 
 
-def read_xml_attendance(variables, root):
+def read_xml_attendance(variables, root, resolve_id=True):
     for child in root:
         if child.tag == "routing_key" or child.tag == 'crud_operation':
             continue
+        elif child.tag == "id" and not resolve_id:
+            variables[child.tag] = child.text
         else:
             variables[child.tag] = get_service_id(child.text, TEAM)
 
@@ -486,6 +491,36 @@ def write_xml_existing_order(amount):
     )
 
 
+# Elements holding the master UUIDs that read_xml_* resolves for every entity, besides the record's own id
+MASTER_UUID_PATHS = {
+    'user': ['company_id'],
+    'company': [],
+    'event': ['speaker/*'],
+    'attendance': ['user_id', 'event_id'],
+    'product': [],
+    'order': ['user_id', 'company_id', 'products/product/product_id'],
+}
+
+
+# Collect every master UUID a message refers to, so they can be resolved together before the message is read
+def read_xml_master_uuids(root, resolve_id=True):
+    paths = MASTER_UUID_PATHS.get(root.tag, [])
+    if resolve_id and root.tag != 'order':
+        paths = ['id'] + paths
+    master_uuids = []
+    for path in paths:
+        for element in root.findall(path):
+            if element.text is not None and element.text.strip() and element.text.strip() not in master_uuids:
+                master_uuids.append(element.text.strip())
+    return master_uuids
+
+
+def read_xml_payload(payload):
+    # Convert a write_xml_* payload into the field dict the Collections API expects
+    root = ET.fromstring(payload.strip())
+    return {child.tag: child.text for child in root}
+
+
 def get_changed_values(object):
     excluded_fields = {"OwnerId", "Name", "RecordTypeId", "CreatedDate", "CreatedById", "LastModifiedDate", "LastModifiedById"}
     result = {}
@@ -0,0 +1,235 @@
+import gzip
+import json
+import sys
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+import responses
+
+sys.path.append('./')
+import src.API as API
+import src.batcher as batcher
+import config.secrets as secrets
+
+
+class TestAPI(unittest.TestCase):
+    def setUp(self):
+        secrets.DOMAIN_NAME = 'https://crm.my.salesforce.com/services/data/v60.0/'
+        API.salesforce_session.headers['Authorization'] = 'Bearer token'
+        API.payload_fingerprints.cache.clear()
+
+    @responses.activate
+    def test_01_calls_share_session_and_auth_header(self):
+        responses.add(responses.POST, secrets.DOMAIN_NAME + 'sobjects/user__c', json={'id': 'a01'}, status=201)
+        responses.add(responses.PATCH, secrets.DOMAIN_NAME + 'sobjects/user__c/a01', status=204)
+
+        self.assertEqual(API.add_user('<user__c></user__c>'), 'a01')
+        API.update_user('a01', '<user__c></user__c>')
+
+        for call in responses.calls:
+            self.assertEqual(call.request.headers['Authorization'], 'Bearer token')
+            self.assertEqual(call.request.headers['Content-Type'], 'application/xml')
+            self.assertEqual(call.request.headers['Sforce-Call-Options'], 'client=crm-integration')
+
+    @responses.activate
+    def test_02_get_order_user_returns_id_and_amount(self):
+        responses.add(responses.GET, secrets.DOMAIN_NAME + 'query', json={'records': [{'Id': 'a05', 'amount__c': 3}]})
+
+        self.assertEqual(API.get_order_user('a01', 'a04'), ('a05', 3))
+
+    @responses.activate
+    def test_03_batcher_flushes_collections_and_returns_results_per_record(self):
+        responses.add(responses.POST, secrets.DOMAIN_NAME + 'composite/sobjects', json=[
+            {'id': 'a01', 'success': True, 'errors': []},
+            {'id': None, 'success': False, 'errors': [{'statusCode': 'REQUIRED_FIELD_MISSING'}]}
+        ])
+        results = []
+        collections_batcher = batcher.CollectionsBatcher(flush_size=2, flush_interval=60)
+
+        collections_batcher.add('create', 'user__c', {'first_name__c': 'John'}, results.append)
+        self.assertEqual(len(responses.calls), 0)
+        collections_batcher.add('create', 'user__c', {}, results.append)
+        collections_batcher.close()
+
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual([result['success'] for result in results], [True, False])
+        self.assertEqual(results[0]['id'], 'a01')
+
+    @responses.activate
+    def test_04_expired_token_is_refreshed_and_request_retried_once(self):
+        responses.add(responses.PATCH, secrets.DOMAIN_NAME + 'sobjects/user__c/a01', status=401)
+        responses.add(responses.PATCH, secrets.DOMAIN_NAME + 'sobjects/user__c/a01', status=204)
+        token_manager = MagicMock()
+        token_manager.invalidate.side_effect = lambda token: API.set_access_token('fresh')
+
+        with patch.object(API, 'token_manager', token_manager):
+            response = API.salesforce_request('PATCH', 'sobjects/user__c/a01', data='<user__c></user__c>')
+
+        token_manager.invalidate.assert_called_once_with('token')
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(responses.calls[1].request.headers['Authorization'], 'Bearer fresh')
+
+    @responses.activate
+    def test_05_orders_are_fetched_with_one_query_and_saved_with_one_composite_call(self):
+        responses.add(responses.GET, secrets.DOMAIN_NAME + 'query', json={'records': [
+            {'Id': 'a05', 'product_id__c': 'p1', 'amount__c': 2.0}
+        ]})
+        responses.add(responses.POST, secrets.DOMAIN_NAME + 'composite', json={'compositeResponse': [
+            {'referenceId': 'new_orders', 'httpStatusCode': 200, 'body': [{'id': 'a06', 'success': True, 'errors': []}]},
+            {'referenceId': 'updated_orders', 'httpStatusCode': 200, 'body': [{'id': 'a05', 'success': True, 'errors': []}]}
+        ]})
+
+        existing_orders = API.get_orders_user('u1', ['p1', 'p2'])
+        results = API.save_orders([{'product_id__c': 'p2', 'amount__c': '1'}], [{'Id': 'a05', 'amount__c': '3'}])
+
+        self.assertEqual(existing_orders, {'p1': ('a05', 2.0)})
+        self.assertIn("product_id__c IN ('p1','p2')", responses.calls[0].request.params['q'])
+        subrequests = json.loads(responses.calls[1].request.body)['compositeRequest']
+        self.assertEqual([subrequest['url'] for subrequest in subrequests], ['/services/data/v60.0/composite/sobjects'] * 2)
+        self.assertEqual(len(responses.calls), 2)
+        self.assertTrue(all(result['success'] for result in results))
+
+    @responses.activate
+    def test_06_upsert_addresses_the_record_by_master_uuid(self):
+        responses.add(responses.PATCH, secrets.DOMAIN_NAME + 'sobjects/user__c/master_uuid__c/df59f548', json={'id': 'a01', 'created': True}, status=201)
+        responses.add(responses.PATCH, secrets.DOMAIN_NAME + 'sobjects/user__c/master_uuid__c/df59f548', status=204)
+        responses.add(responses.PATCH, secrets.DOMAIN_NAME + 'sobjects/user__c/master_uuid__c/df59f548', json={'id': 'a01', 'created': False}, status=200)
+
+        self.assertEqual(API.upsert_user('df59f548', '<user__c></user__c>'), 'a01')
+        self.assertIsNone(API.upsert_user('df59f548', '<user__c></user__c>'))
+        self.assertIsNone(API.upsert_user('df59f548', '<user__c></user__c>'))
+
+    @responses.activate
+    def test_07_identical_updates_are_sent_once(self):
+        responses.add(responses.PATCH, secrets.DOMAIN_NAME + 'sobjects/Company__c/a02', status=204)
+
+        API.update_company('a02', '<Company__c><Name>Intratech</Name></Company__c>')
+        API.update_company('a02', '<Company__c><Name>Intratech</Name></Company__c>')
+        API.update_company('a02', '<Company__c><Name>Intratech BV</Name></Company__c>')
+
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    def test_08_dict_payloads_are_sent_as_json(self):
+        responses.add(responses.POST, secrets.DOMAIN_NAME + 'sobjects/user__c', json={'id': 'a01'}, status=201)
+
+        self.assertEqual(API.add_user({'first_name__c': 'Jan'}), 'a01')
+
+        self.assertEqual(responses.calls[0].request.headers['Content-Type'], 'application/json')
+        self.assertEqual(json.loads(responses.calls[0].request.body), {'first_name__c': 'Jan'})
+
+    @responses.activate
+    def test_09_calls_are_recorded_per_sobject_and_operation(self):
+        responses.add(responses.POST, secrets.DOMAIN_NAME + 'sobjects/event__c', json={'id': 'a03'}, status=201)
+        responses.add(responses.DELETE, secrets.DOMAIN_NAME + 'sobjects/event__c/a03', status=404)
+        calls = API.metrics.get('crm_sobject_calls_total', sobject='event__c', operation='create') or 0
+        errors = API.metrics.get('crm_sobject_errors_total', sobject='event__c', operation='delete') or 0
+
+        API.add_event({'title__c': 'Meetup'})
+        API.delete_event('a03')
+
+        self.assertEqual(API.metrics.get('crm_sobject_calls_total', sobject='event__c', operation='create'), calls + 1)
+        self.assertEqual(API.metrics.get('crm_sobject_errors_total', sobject='event__c', operation='delete'), errors + 1)
+        self.assertEqual(API.sobjects['event'].record_path, 'sobjects/event__c/')
+
+    @responses.activate
+    def test_10_large_bodies_are_sent_gzipped(self):
+        responses.add(responses.POST, secrets.DOMAIN_NAME + 'sobjects/Company__c', json={'id': 'a02'}, status=201)
+        payload = {'description__c': 'Intratech consulting ' * 200}
+
+        API.add_company(payload)
+        API.add_company({'name__c': 'Intratech'})
+
+        large, small = responses.calls[0].request, responses.calls[1].request
+        self.assertEqual(large.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(large.body)), payload)
+        self.assertNotIn('Content-Encoding', small.headers)
+        self.assertEqual(large.headers['Accept-Encoding'], 'gzip')
+
+    def test_11_operations_on_the_same_record_are_flushed_in_order(self):
+        written = []
+
+        def update_records(sobject, records):
+            time.sleep(0.1)
+            written.append(('update', [record['Id'] for record in records]))
+            return [{'id': record['Id'], 'success': True, 'errors': []} for record in records]
+
+        def delete_records(record_ids):
+            written.append(('delete', list(record_ids)))
+            return [{'id': record_id, 'success': True, 'errors': []} for record_id in record_ids]
+
+        collections_batcher = batcher.CollectionsBatcher(flush_size=10, flush_interval=60)
+        with patch.object(batcher, 'update_records', side_effect=update_records), patch.object(batcher, 'delete_records', side_effect=delete_records):
+            collections_batcher.add('update', 'user__c', {'Id': 'a01', 'first_name__c': 'John'}, lambda result: None)
+            collections_batcher.add('update', 'user__c', {'Id': 'a02', 'first_name__c': 'Jane'}, lambda result: None)
+            collections_batcher.add('update', 'user__c', {'Id': 'a01', 'first_name__c': 'Jack'}, lambda result: None)
+            collections_batcher.add('update', 'user__c', {'Id': 'a05', 'first_name__c': 'Jill'}, lambda result: None)
+            collections_batcher.add('delete', 'user__c', 'a01', lambda result: None)
+            collections_batcher.close()
+
+        self.assertEqual(written, [('update', ['a01', 'a02']), ('update', ['a01', 'a05']), ('delete', ['a01'])])
+
+    def test_12_bulk_jobs_do_not_hold_up_collections_flushes(self):
+        written = []
+        release = threading.Event()
+
+        def run_ingest_job(sobject, operation, records):
+            release.wait(5)
+            written.append(('bulk', [record['Id'] for record in records]))
+            return [{'id': record['Id'], 'success': True, 'errors': []} for record in records]
+
+        def update_records(sobject, records):
+            written.append(('collections', [record['Id'] for record in records]))
+            return [{'id': record['Id'], 'success': True, 'errors': []} for record in records]
+
+        collections_batcher = batcher.CollectionsBatcher(flush_size=1, flush_interval=60, bulk_flush_size=1)
+        with patch.object(batcher, 'run_ingest_job', side_effect=run_ingest_job), patch.object(batcher, 'update_records', side_effect=update_records):
+            collections_batcher.set_bulk_mode(True)
+            collections_batcher.add('update', 'user__c', {'Id': 'a01', 'first_name__c': 'John'}, lambda result: None)
+            collections_batcher.set_bulk_mode(False)
+            other = threading.Event()
+            collections_batcher.add('update', 'user__c', {'Id': 'a03', 'first_name__c': 'Jane'}, lambda result: other.set())
+            self.assertTrue(other.wait(2))
+            # An update on the record of the running bulk job waits for it
+            collections_batcher.add('update', 'user__c', {'Id': 'a01', 'first_name__c': 'Jack'}, lambda result: None)
+            time.sleep(0.1)
+            release.set()
+            collections_batcher.close()
+
+        self.assertEqual(written, [('collections', ['a03']), ('bulk', ['a01']), ('collections', ['a01'])])
+
+
+    def test_13_an_update_back_to_the_written_value_is_not_skipped_while_another_is_queued(self):
+        written = []
+
+        def update_records(sobject, records):
+            written.extend(record['first_name__c'] for record in records)
+            return [{'id': record['Id'], 'success': True, 'errors': []} for record in records]
+
+        collections_batcher = batcher.CollectionsBatcher(flush_size=10, flush_interval=60)
+        with patch.object(batcher, 'update_records', side_effect=update_records):
+            done = threading.Event()
+            collections_batcher.add('update', 'user__c', {'Id': 'a04', 'first_name__c': 'X'}, lambda result: done.set())
+            collections_batcher.flush()
+            self.assertTrue(done.wait(2))
+
+            skipped = []
+            collections_batcher.add('update', 'user__c', {'Id': 'a04', 'first_name__c': 'Y'}, skipped.append)
+            collections_batcher.add('update', 'user__c', {'Id': 'a04', 'first_name__c': 'X'}, skipped.append)
+            self.assertEqual(skipped, [])
+            collections_batcher.close()
+
+        self.assertEqual(written, ['X', 'Y', 'X'])
+
+        # Nothing is queued anymore, so a repeat of the last value is skipped again
+        collections_batcher = batcher.CollectionsBatcher(flush_size=10, flush_interval=60)
+        skipped = []
+        collections_batcher.add('update', 'user__c', {'Id': 'a04', 'first_name__c': 'X'}, skipped.append)
+        collections_batcher.close()
+        self.assertEqual(len(skipped), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
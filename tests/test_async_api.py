@@ -0,0 +1,96 @@
+import asyncio
+import sys
+import threading
+import unittest
+from unittest.mock import MagicMock, patch
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+sys.path.append('./')
+import src.async_api as async_api
+from src.rate_limiter import AdaptiveLimiter, AsyncAdaptiveLimiter
+import config.secrets as secrets
+
+
+class TestAsyncAPI(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.requests = []
+        self.statuses = []
+        app = web.Application()
+        app.router.add_route('*', '/{path:.*}', self.handle)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        self.domain_name = secrets.DOMAIN_NAME
+        secrets.DOMAIN_NAME = str(self.server.make_url('/'))
+        async_api.API.salesforce_session.headers['Authorization'] = 'Bearer token'
+        async_api.resilience.breakers.clear()
+
+    async def asyncTearDown(self):
+        await async_api.close()
+        await self.server.close()
+        secrets.DOMAIN_NAME = self.domain_name
+
+    # Answers with the queued statuses first, then creates every record as a01
+    async def handle(self, request):
+        self.assertEqual(request.headers['Sforce-Call-Options'], 'client=crm-integration')
+        self.requests.append((request.method, request.path, request.headers.get('Authorization')))
+        if self.statuses:
+            return web.Response(status=self.statuses.pop(0))
+        return web.json_response({'id': 'a01', 'success': True}, status=201)
+
+    async def test_01_expired_token_is_refreshed_and_request_retried_once(self):
+        self.statuses = [401, 204]
+        token_manager = MagicMock()
+        token_manager.invalidate.side_effect = lambda token: async_api.API.set_access_token('fresh')
+
+        with patch.object(async_api.API, 'token_manager', token_manager):
+            response = await async_api.salesforce_request('PATCH', 'sobjects/user__c/a01', data={'first_name__c': 'John'})
+
+        token_manager.invalidate.assert_called_once_with('token')
+        self.assertEqual(response.status, 204)
+        self.assertEqual([authorization for _, _, authorization in self.requests], ['Bearer token', 'Bearer fresh'])
+
+    async def test_02_add_order_returns_the_new_id(self):
+        order_id = await async_api.add_order({'user_id__c': 'u1', 'product_id__c': 'p1', 'amount__c': 2})
+
+        self.assertEqual(order_id, 'a01')
+        self.assertEqual(self.requests, [('POST', '/sobjects/order__c', 'Bearer token')])
+
+    async def test_03_requests_cancelled_while_waiting_for_the_limiter_take_no_slot(self):
+        limiter = AsyncAdaptiveLimiter(max_concurrency=1)
+        await limiter.acquire()
+        with patch.object(async_api, 'limiter', limiter):
+            request = asyncio.create_task(async_api.add_order({'amount__c': 1}))
+            await asyncio.sleep(0.1)
+            request.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await request
+
+            limiter.release()
+            self.assertEqual(limiter.in_flight, 0)
+            self.assertEqual(limiter.waiters, [])
+            self.assertEqual(self.requests, [])
+            self.assertEqual(await async_api.add_order({'amount__c': 1}), 'a01')
+
+    async def test_04_concurrent_401s_refresh_without_waiting_on_the_blocking_client(self):
+        self.statuses = [401] * 20
+        # Every slot of the blocking client and every thread of the default executor is taken
+        blocking = AdaptiveLimiter(max_concurrency=1)
+        blocking.acquire()
+        release = threading.Event()
+        loop = asyncio.get_running_loop()
+        busy = [loop.run_in_executor(None, release.wait) for _ in range(64)]
+        token_manager = MagicMock()
+        token_manager.invalidate.side_effect = lambda token: async_api.API.set_access_token('fresh')
+
+        with patch.object(async_api.API, 'limiter', blocking), patch.object(async_api.API, 'token_manager', token_manager):
+            ids = await asyncio.wait_for(asyncio.gather(*(async_api.add_order({'amount__c': index}) for index in range(20))), 5)
+
+        release.set()
+        await asyncio.gather(*busy)
+        self.assertEqual(ids, ['a01'] * 20)
+        self.assertEqual(async_api.limiter.in_flight, 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,35 @@
+import sys
+import unittest
+from unittest.mock import patch
+
+sys.path.append('./')
+import src.backfill as backfill
+
+
+class TestBackfill(unittest.TestCase):
+    def test_01_records_without_master_uuid_get_theirs_page_by_page(self):
+        pages = [[{'Id': 'a01'}, {'Id': 'a02'}, {'Id': 'a03'}], [{'Id': 'a04'}], []]
+        conditions = []
+        updates = []
+
+        def query(fields, condition):
+            conditions.append(condition)
+            return pages.pop(0)
+
+        def update_records(sobject, records):
+            updates.append((sobject, records))
+            return [{'id': record['Id'], 'success': record['Id'] != 'a04', 'errors': [] if record['Id'] != 'a04' else ['DUPLICATE_VALUE']} for record in records]
+
+        master_uuids = {'a01': 'u1', 'a02': None, 'a03': 'u3', 'a04': 'u4'}
+        with patch.object(backfill.sobjects['user'], 'query', side_effect=query), patch.object(backfill, 'update_records', side_effect=update_records), \
+                patch.object(backfill.uuidapi, 'get_master_uuid', side_effect=lambda service_id, service: master_uuids[service_id]):
+            self.assertEqual(backfill.backfill_master_uuids('user'), (2, 2))
+
+        self.assertEqual(updates[0], ('user__c', [{'Id': 'a01', 'master_uuid__c': 'u1'}, {'Id': 'a03', 'master_uuid__c': 'u3'}]))
+        self.assertEqual(conditions[0], 'master_uuid__c=null+ORDER+BY+Id+LIMIT+2000')
+        self.assertIn("Id>'a03'", conditions[1])
+        self.assertIn("Id>'a04'", conditions[2])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+import json
+import sys
+import unittest
+from unittest.mock import patch
+
+import responses
+
+sys.path.append('./')
+import src.bulk as bulk
+from src.API import metrics
+import config.secrets as secrets
+
+
+class FakeBulkEndpoint:
+    # Minimal in-memory Bulk API 2.0 ingest endpoint: accepts one job, fails records without a last name
+    def __init__(self, mock):
+        self.url = secrets.DOMAIN_NAME + 'jobs/ingest'
+        self.upload = None
+        self.polls = 0
+        mock.add(responses.POST, self.url, json={'id': '750x', 'state': 'Open'})
+        mock.add_callback(responses.PUT, self.url + '/750x/batches', callback=self.put_batch)
+        mock.add(responses.PATCH, self.url + '/750x', json={'id': '750x', 'state': 'UploadComplete'})
+        mock.add_callback(responses.GET, self.url + '/750x', callback=self.get_job)
+        mock.add_callback(responses.GET, self.url + '/750x/successfulResults/', callback=self.get_results(True))
+        mock.add_callback(responses.GET, self.url + '/750x/failedResults/', callback=self.get_results(False))
+
+    def put_batch(self, request):
+        self.upload = bulk.read_csv(request.body.decode('utf-8'))
+        return 201, {}, ''
+
+    def get_job(self, request):
+        self.polls += 1
+        state = 'JobComplete' if self.polls > 1 else 'InProgress'
+        return 200, {}, json.dumps({'id': '750x', 'state': state})
+
+    def get_results(self, success):
+        def callback(request):
+            rows = [row for row in self.upload if bool(row['last_name__c']) == success]
+            header = ['sf__Id', 'sf__Created'] if success else ['sf__Id', 'sf__Error']
+            lines = [','.join(header + list(self.upload[0]))]
+            for index, row in reversed(list(enumerate(rows))):
+                extra = [f'a0{index}', 'true'] if success else ['', 'REQUIRED_FIELD_MISSING:last_name__c']
+                lines.append(','.join(extra + list(row.values())))
+            return 200, {}, '\n'.join(lines) + '\n'
+        return callback
+
+
+class TestBulk(unittest.TestCase):
+    def setUp(self):
+        secrets.DOMAIN_NAME = 'https://crm.my.salesforce.com/services/data/v60.0/'
+
+    @responses.activate
+    def test_01_results_are_mapped_back_to_their_records(self):
+        endpoint = FakeBulkEndpoint(responses)
+        records = [
+            {'first_name__c': 'John', 'last_name__c': 'Doe'},
+            {'first_name__c': 'Jane'},
+            {'first_name__c': 'Jack', 'last_name__c': 'Doe'},
+        ]
+        calls = metrics.get('crm_sobject_calls_total', sobject='user__c', operation='bulk_create') or 0
+
+        with patch.object(bulk, 'BULK_POLL_INTERVAL', 0):
+            results = bulk.run_ingest_job('user__c', 'create', records)
+
+        self.assertEqual(endpoint.polls, 2)
+        self.assertEqual([result['success'] for result in results], [True, False, True])
+        self.assertEqual(results[0]['id'], 'a00')
+        self.assertEqual(results[2]['id'], 'a01')
+        self.assertEqual(results[1]['errors'], ['REQUIRED_FIELD_MISSING:last_name__c'])
+        # Open, upload, close, two polls and two result downloads
+        self.assertEqual(metrics.get('crm_sobject_calls_total', sobject='user__c', operation='bulk_create'), calls + 7)
+
+
+if __name__ == "__main__":
+    unittest.main()
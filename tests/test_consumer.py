@@ -37,7 +37,7 @@ class TestConsumer(unittest.TestCase):
             self.stop.set()
             self.consumer_thread.join()
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_01_user_create_should_make_valid_request(self, mock_post):
         with (patch('src.consumer.add_service_id') as add_service_id_mock,
               patch('src.xml_parser.get_service_id') as get_service_id_mock,
@@ -84,7 +84,7 @@ class TestConsumer(unittest.TestCase):
             self.assertTrue(channel._consumer_infos)
             add_user_mock.assert_called_once()
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_02_user_update_should_make_valid_request(self, mock_post):
         with (patch('src.consumer.add_service_id') as add_service_id_mock,
               patch('src.xml_parser.get_service_id') as get_service_id_mock,
@@ -135,7 +135,7 @@ class TestConsumer(unittest.TestCase):
             self.assertTrue(channel._consumer_infos)
             update_user_mock.assert_called_once()
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_03_company_create_should_make_valid_request(self, mock_post):
         with patch('src.consumer.add_service_id') as add_service_id_mock, \
                 patch('src.xml_parser.get_service_id') as get_service_id_mock, \
@@ -181,7 +181,7 @@ class TestConsumer(unittest.TestCase):
             self.assertTrue(channel._consumer_infos)
             add_company_mock.assert_called_once()
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_04_company_update_should_make_valid_request(self, mock_post):
         with patch('src.consumer.add_service_id') as add_service_id_mock, \
                 patch('src.xml_parser.get_service_id') as get_service_id_mock, \
@@ -231,7 +231,7 @@ class TestConsumer(unittest.TestCase):
             self.assertTrue(channel._consumer_infos)
             update_company_mock.assert_called_once()
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_05_event_create_should_make_valid_request(self, mock_post):
         with (patch('src.consumer.add_service_id') as add_service_id_mock, \
               patch('src.xml_parser.get_service_id') as get_service_id_mock, \
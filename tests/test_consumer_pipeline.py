@@ -0,0 +1,301 @@
+import queue
+import sys
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+sys.path.append('./')
+import src.consumer as consumer
+
+
+class FakeChannel:
+    def __init__(self, connection):
+        self.connection = connection
+        self.consumers = {}
+        self.prefetch = None
+        self.acks = []
+        self.nacks = []
+        self.settled_on = set()
+
+    def queue_declare(self, queue='', **kwargs):
+        return SimpleNamespace(method=SimpleNamespace(queue=queue or 'exclusive', message_count=0))
+
+    def exchange_declare(self, *args, **kwargs):
+        pass
+
+    def queue_bind(self, *args, **kwargs):
+        pass
+
+    def basic_qos(self, prefetch_count):
+        self.prefetch = prefetch_count
+
+    def basic_consume(self, queue, on_message_callback, auto_ack=False):
+        self.consumers[queue] = on_message_callback
+        return queue
+
+    def basic_cancel(self, consumer_tag):
+        pass
+
+    def basic_ack(self, delivery_tag):
+        self.settled_on.add(threading.current_thread())
+        self.acks.append(delivery_tag)
+
+    def basic_nack(self, delivery_tag, requeue):
+        self.settled_on.add(threading.current_thread())
+        self.nacks.append((delivery_tag, requeue))
+
+    # Runs deliveries and thread-safe callbacks one at a time on the calling thread, like the pika I/O loop
+    def start_consuming(self):
+        self.connection.thread = threading.current_thread()
+        delivery_tag = 0
+        while not self.connection.stopped.is_set():
+            try:
+                kind, item = self.connection.events.get(timeout=0.01)
+            except queue.Empty:
+                continue
+            if kind == 'callback':
+                item()
+            else:
+                delivery_tag += 1
+                self.consumers['crm'](self, SimpleNamespace(delivery_tag=delivery_tag), None, item)
+
+
+# Stands in for pika.BlockingConnection
+class FakeConnection:
+    def __init__(self, *args, **kwargs):
+        self.events = queue.Queue()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.fake_channel = FakeChannel(self)
+        FakeConnection.last = self
+
+    def channel(self):
+        return self.fake_channel
+
+    def add_callback_threadsafe(self, callback):
+        self.events.put(('callback', callback))
+
+    def call_later(self, delay, callback):
+        timer = threading.Timer(delay, self.events.put, (('callback', callback),))
+        timer.daemon = True
+        timer.start()
+
+
+def user(operation, master_uuid, company_id=''):
+    return f'''
+    <user>
+        <routing_key>user.frontend</routing_key>
+        <crud_operation>{operation}</crud_operation>
+        <id>{master_uuid}</id>
+        <first_name>John</first_name>
+        <last_name>Doe</last_name>
+        <email>john.doe@mail.com</email>
+        <telephone/>
+        <birthday/>
+        <address><country/><state/><city/><zip/><street/><house_number/></address>
+        <company_email/>
+        <company_id>{company_id}</company_id>
+        <source/>
+        <user_role/>
+        <invoice/>
+        <calendar_link/>
+    </user>'''.encode()
+
+
+class ConsumerTestCase(unittest.TestCase):
+    def setUp(self):
+        consumer.uuidapi.service_ids.clear()
+        consumer.uuidapi.master_uuids.clear()
+        consumer.uuidapi.resilience.breakers.clear()
+        self.logged_on = []
+        logged = MagicMock(side_effect=lambda *args, **kwargs: self.logged_on.append(threading.current_thread()))
+        for target, value in (('pika.BlockingConnection', FakeConnection), ('src.consumer.log', logged)):
+            patcher = patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        for name, value in (('store', None),):
+            patcher = patch.object(consumer.uuidapi, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def start(self):
+        self.thread = threading.Thread(target=consumer.main, daemon=True)
+        self.thread.start()
+        while getattr(FakeConnection, 'last', None) is None or FakeConnection.last.thread is None:
+            time.sleep(0.01)
+        self.connection = FakeConnection.last
+        self.channel = self.connection.fake_channel
+        self.addCleanup(self.stop)
+
+    def stop(self):
+        self.connection.stopped.set()
+        self.thread.join(2)
+        FakeConnection.last = None
+
+    def deliver(self, *bodies):
+        for body in bodies:
+            self.connection.events.put(('message', body))
+
+    def wait_settled(self, count, timeout=5):
+        deadline = time.monotonic() + timeout
+        while len(self.channel.acks) + len(self.channel.nacks) < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(self.channel.acks) + len(self.channel.nacks), count)
+
+
+class TestConsumerPipeline(ConsumerTestCase):
+    def test_01_messages_run_in_parallel_and_are_acked_on_the_connection_thread(self):
+        running, most_running = [0], [0]
+        lock = threading.Lock()
+
+        def add_user(payload):
+            with lock:
+                running[0] += 1
+                most_running[0] = max(most_running[0], running[0])
+            time.sleep(0.1)
+            with lock:
+                running[0] -= 1
+            return 'a01'
+
+        with patch.object(consumer, 'add_user', side_effect=add_user), patch.object(consumer, 'add_service_id'), \
+                patch.object(consumer, 'prime_service_ids', return_value=[]), \
+                patch('requests.Session.post', return_value=MagicMock(status_code=200, json=MagicMock(return_value={'crm': None}))):
+            self.start()
+            self.deliver(*(user('create', f'u{index}') for index in range(8)))
+            self.wait_settled(8)
+
+        self.assertEqual(sorted(self.channel.acks), list(range(1, 9)))
+        self.assertGreater(most_running[0], 1)
+        self.assertEqual(self.channel.settled_on, {self.connection.thread})
+        self.assertEqual(self.channel.prefetch, consumer.CONSUMER_PREFETCH)
+        self.assertEqual(consumer.metrics.get('crm_consumer_in_flight'), 0)
+        deadline = time.monotonic() + 2
+        while len(self.logged_on) < 8 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(self.logged_on), 8)
+        self.assertNotIn(self.connection.thread, self.logged_on)
+
+    def test_02_unreadable_failed_and_circuit_open_messages_are_nacked(self):
+        def add_user(payload):
+            raise consumer.CircuitOpenError('salesforce', 30) if 'Retry' in str(payload) else Exception('INVALID_FIELD')
+
+        with patch.object(consumer, 'add_user', side_effect=add_user), patch.object(consumer, 'prime_service_ids', return_value=[]), \
+                patch('requests.Session.post', return_value=MagicMock(status_code=200, json=MagicMock(return_value={'crm': None}))):
+            self.start()
+            self.deliver(b'not xml', user('create', 'u1'), user('create', 'u2').replace(b'John', b'Retry'))
+            self.wait_settled(3)
+
+        self.assertEqual(sorted(self.channel.nacks), [(1, False), (2, False), (3, True)])
+        self.assertEqual(self.channel.settled_on, {self.connection.thread})
+        self.assertEqual(consumer.metrics.get('crm_consumer_in_flight'), 0)
+
+    def test_03_collections_batching_widens_the_prefetch_window(self):
+        with patch.object(consumer, 'COLLECTIONS_BATCHING', True):
+            self.start()
+        self.assertEqual(self.channel.prefetch, 2 * consumer.COLLECTIONS_FLUSH_SIZE)
+
+    def test_04_redelivered_upsert_creates_do_not_record_a_missing_service_id(self):
+        upsert = MagicMock(side_effect=['a01', None])
+        with patch.object(consumer, 'UPSERT_BY_MASTER_UUID', True), patch.dict(consumer.UPSERTS, {'user': (*consumer.UPSERTS['user'][:2], upsert)}), \
+                patch.object(consumer, 'add_service_id') as add_service_id, patch.object(consumer, 'prime_service_ids', return_value=[]), \
+                patch('requests.Session.post', return_value=MagicMock(status_code=200, json=MagicMock(return_value={'crm': None}))):
+            self.start()
+            self.deliver(user('create', 'u1'), user('create', 'u1'))
+            self.wait_settled(2)
+
+        self.assertEqual(self.channel.acks, [1, 2])
+        add_service_id.assert_called_once_with('u1', 'a01', 'crm')
+
+    def test_05_upserted_updates_that_create_the_record_record_its_id(self):
+        results = iter([{'id': 'a01', 'success': True, 'errors': [], 'created': False}, {'id': 'a02', 'success': True, 'errors': [], 'created': True}])
+        batcher = sys.modules[consumer.CollectionsBatcher.__module__]
+        with patch.object(consumer, 'UPSERT_BY_MASTER_UUID', True), patch.object(consumer, 'COLLECTIONS_BATCHING', True), \
+                patch.object(consumer, 'COLLECTIONS_FLUSH_INTERVAL', 0.05), \
+                patch.object(batcher, 'upsert_records', side_effect=lambda sobject, records: [next(results) for _ in records]), \
+                patch.object(consumer, 'add_service_id') as add_service_id, patch.object(consumer, 'prime_service_ids', return_value=[]):
+            self.start()
+            self.deliver(user('update', 'u1'))
+            self.wait_settled(1)
+            self.deliver(user('update', 'u2'))
+            self.wait_settled(2)
+
+        self.assertEqual(self.channel.acks, [1, 2])
+        add_service_id.assert_called_once_with('u2', 'a02', 'crm')
+
+    def test_06_created_records_carry_their_master_uuid(self):
+        created = []
+        batcher = sys.modules[consumer.CollectionsBatcher.__module__]
+        with patch.object(consumer, 'COLLECTIONS_BATCHING', True), patch.object(consumer, 'COLLECTIONS_FLUSH_INTERVAL', 0.05), \
+                patch.object(batcher, 'create_records', side_effect=lambda sobject, records: created.extend(records) or [{'id': 'a01', 'success': True, 'errors': []}]), \
+                patch.object(consumer, 'add_service_id'), patch.object(consumer, 'prime_service_ids', return_value=[]), \
+                patch('requests.Session.post', return_value=MagicMock(status_code=200, json=MagicMock(return_value={'crm': None}))):
+            self.start()
+            self.deliver(user('create', 'u1'))
+            self.wait_settled(1)
+
+        self.assertEqual(created[0][consumer.MASTER_UUID_FIELD], 'u1')
+        self.assertEqual(consumer.read_xml_payload(consumer.with_master_uuid('<user__c><first_name__c>John</first_name__c></user__c>', 'u1')),
+                         {'first_name__c': 'John', consumer.MASTER_UUID_FIELD: 'u1'})
+
+
+class TestMicroBatching(ConsumerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.lookups = []
+        self.collections = []
+        batcher = sys.modules[consumer.CollectionsBatcher.__module__]
+        for target, name, value in (
+                (consumer, 'CONSUMER_BATCH_SIZE', 8),
+                (consumer, 'CONSUMER_BATCH_WAIT', 0.5),
+                (consumer, 'COLLECTIONS_FLUSH_INTERVAL', 60),
+                (consumer.uuidapi, 'UUID_BATCH_ENDPOINT', 'getServiceIds'),
+                (consumer, 'add_service_id', MagicMock()),
+                (batcher, 'create_records', self.create_records)):
+            patcher = patch.object(target, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = patch('requests.Session.post', side_effect=self.post)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    # The UUID service knows the companies, the users are created by the messages themselves
+    def post(self, url, **kwargs):
+        self.lookups.append(url.rsplit('/', 1)[1])
+        uuids = kwargs['json'].get('MASTERUUIDS') or [kwargs['json'].get('MASTERUUID')]
+        body = {uuid: ('sf-' + uuid if uuid.startswith('c') else None) for uuid in uuids}
+        return MagicMock(status_code=200, json=MagicMock(return_value=body if 'MASTERUUIDS' in kwargs['json'] else {'crm': body[uuids[0]]}))
+
+    def create_records(self, sobject, records):
+        self.collections.append((sobject, len(records)))
+        return [{'id': f'a{index}', 'success': True, 'errors': []} for index in range(len(records))]
+
+    def test_01_full_batches_share_one_lookup_and_one_collections_call(self):
+        self.start()
+        self.deliver(*(user('create', f'u{index}', f'c{index}') for index in range(16)))
+        self.wait_settled(16, timeout=1)
+
+        self.assertEqual(sorted(self.channel.acks), list(range(1, 17)))
+        self.assertEqual(self.lookups, ['getServiceIds', 'getServiceIds'])
+        self.assertEqual(self.collections, [('user__c', 8), ('user__c', 8)])
+        self.assertEqual(consumer.add_service_id.call_count, 16)
+
+    def test_02_partial_batches_are_dispatched_once_their_wait_is_over(self):
+        self.start()
+        self.deliver(*(user('create', f'u{index}', f'c{index}') for index in range(8)))
+        self.wait_settled(8, timeout=0.4)
+
+        # The first batch went out full, its timer must not cut the next batch short
+        time.sleep(0.2)
+        self.deliver(user('create', 'u8', 'c8'))
+        time.sleep(0.4)
+        self.deliver(user('create', 'u9', 'c9'))
+        self.wait_settled(10)
+
+        self.assertEqual(self.collections, [('user__c', 8), ('user__c', 2)])
+        self.assertEqual(self.lookups, ['getServiceIds', 'getServiceIds'])
+
+
+if __name__ == "__main__":
+    unittest.main()
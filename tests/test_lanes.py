@@ -0,0 +1,51 @@
+import sys
+import threading
+import time
+import unittest
+
+sys.path.append('./')
+from src.lanes import SerialLanes
+
+
+class TestLanes(unittest.TestCase):
+    def setUp(self):
+        self.lanes = SerialLanes('test', 4)
+        self.addCleanup(self.lanes.shutdown)
+
+    def test_01_calls_with_the_same_key_run_in_submission_order(self):
+        done = []
+
+        def work(key, index):
+            time.sleep(0.01 if index % 2 else 0)
+            done.append((key, index))
+
+        for index in range(10):
+            for key in ('u1', 'u2', 'u3'):
+                self.lanes.submit(key, work, key, index)
+        self.lanes.shutdown()
+
+        for key in ('u1', 'u2', 'u3'):
+            self.assertEqual([index for done_key, index in done if done_key == key], list(range(10)))
+
+    def test_02_occupancy_counts_queued_and_running_calls(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def block():
+            started.set()
+            release.wait()
+
+        index = self.lanes.lane('u1')
+        self.lanes.submit('u1', block)
+        self.lanes.submit('u1', lambda: None)
+        started.wait()
+        self.assertEqual(self.lanes.occupancy[index], 2)
+        self.assertEqual(sum(self.lanes.occupancy), 2)
+
+        release.set()
+        self.lanes.shutdown()
+        self.assertEqual(self.lanes.occupancy, [0] * 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
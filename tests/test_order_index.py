@@ -0,0 +1,124 @@
+import sys
+import unittest
+from unittest.mock import MagicMock, patch
+
+sys.path.append('./')
+import src.consumer as consumer
+import src.publisher as publisher
+from src.order_index import OrderIndex
+
+
+def change_event(change_type, record_id, origin='', **fields):
+    return {'ChangeEventHeader': {'changeType': change_type, 'changeOrigin': origin, 'recordIds': [record_id]}, **fields}
+
+
+class TestOrderIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = OrderIndex()
+
+    def test_01_late_events_of_our_own_writes_do_not_overwrite_newer_amounts(self):
+        self.index.put('u1', 'p1', 'o1', 5)
+        self.index.put('u1', 'p1', 'o1', 7)
+
+        self.index.apply_change_event(change_event('UPDATE', 'o1', 'com/salesforce/api/rest/60.0;client=crm-integration', amount__c=5))
+        self.index.apply_change_event(change_event('UPDATE', 'o1', 'com/salesforce/api/async/60.0;client=crm-integration', amount__c=5))
+
+        self.assertEqual(self.index.get('u1', 'p1'), ('o1', 7))
+
+    def test_02_changes_made_by_others_only_invalidate(self):
+        self.index.put('u1', 'p1', 'o1', 5)
+        self.index.put('u1', 'p2', 'o2', 3)
+        self.index.put('u2', 'p1', 'o3', 1)
+
+        # REST edits of other integrations are not ours
+        self.index.apply_change_event(change_event('UPDATE', 'o1', 'com/salesforce/api/rest/60.0;client=other-app', amount__c=9))
+        self.index.apply_change_event(change_event('CREATE', 'o4', user_id__c='u1', product_id__c='p2', amount__c=4))
+
+        self.assertIsNone(self.index.get('u1', 'p1'))
+        self.assertIsNone(self.index.get('u1', 'p2'))
+        self.assertEqual(self.index.get('u2', 'p1'), ('o3', 1))
+
+        self.index.apply_change_event({'ChangeEventHeader': {'changeType': 'GAP_UPDATE', 'recordIds': []}})
+        self.assertIsNone(self.index.get('u2', 'p1'))
+
+    def test_03_index_is_bounded_and_never_serves_entries_it_could_not_invalidate(self):
+        index = OrderIndex(maxsize=2, ttl=60)
+        index.put('u1', 'p1', 'o1', 1)
+        index.put('u1', 'p2', 'o2', 2)
+        index.put('u1', 'p3', 'o3', 3)
+        self.assertEqual((len(index.orders), len(index.keys)), (2, 2))
+        self.assertIsNone(index.get('u1', 'p1'))
+
+        # Reading p2 keeps it in the order map, but its reverse entry is evicted next
+        self.assertEqual(index.get('u1', 'p2'), ('o2', 2))
+        index.keys.set('o9', ('u9', 'p9'))
+        index.keys.set('o8', ('u8', 'p8'))
+        self.assertIsNone(index.get('u1', 'p2'))
+
+
+class TestShareOrderChanges(unittest.TestCase):
+    def setUp(self):
+        publisher.order_channel = None
+        self.addCleanup(setattr, publisher, 'order_channel', None)
+
+    def test_01_only_order_changes_of_others_are_shared_over_one_channel(self):
+        channel = MagicMock(is_closed=False)
+        events = [
+            {'ChangeEventHeader': {'entityName': 'order__c', 'changeType': 'UPDATE', 'changeOrigin': origin, 'recordIds': ['o1']}}
+            for origin in ('com/salesforce/api/rest/60.0;client=crm-integration', 'com/salesforce/api/soap/60.0', 'com/salesforce/api/rest/60.0;client=other-app')
+        ]
+        with patch.object(publisher, 'authenticate_rabbitmq', return_value=channel) as authenticate_rabbitmq, \
+                patch.object(publisher.broadcast, 'publish') as publish:
+            for event in events:
+                publisher.handle_change_event(event)
+
+        authenticate_rabbitmq.assert_called_once()
+        self.assertEqual([call.args for call in publish.call_args_list], [(channel, publisher.ORDER_EXCHANGE, event) for event in events[1:]])
+
+    def test_02_a_dropped_connection_is_reopened_and_the_change_sent_again(self):
+        dropped, fresh = MagicMock(is_closed=False), MagicMock(is_closed=False)
+        publisher.order_channel = dropped
+        event = {'ChangeEventHeader': {'entityName': 'order__c', 'changeType': 'DELETE', 'changeOrigin': '', 'recordIds': ['o1']}}
+        with patch.object(publisher, 'authenticate_rabbitmq', return_value=fresh), \
+                patch.object(publisher.broadcast, 'publish', side_effect=[Exception('Connection reset'), None]) as publish:
+            publisher.handle_change_event(event)
+
+        dropped.connection.close.assert_called_once()
+        self.assertEqual(publish.call_args.args[0], fresh)
+        self.assertIs(publisher.order_channel, fresh)
+
+
+class TestSaveOrderLines(unittest.TestCase):
+    def setUp(self):
+        consumer.order_index.clear()
+        self.addCleanup(consumer.order_index.clear)
+
+    def test_01_indexed_orders_are_incremented_without_a_query(self):
+        consumer.order_index.put('u1', 'p1', 'o1', 7)
+        with patch.object(consumer, 'get_orders_user') as get_orders_user, \
+                patch.object(consumer, 'save_orders', return_value=[{'id': None, 'success': True, 'errors': []}]) as save_orders:
+            consumer.save_order_lines('u1', '', [{'product_id': 'p1', 'amount': '2'}])
+
+        get_orders_user.assert_not_called()
+        new_orders, updated_orders = save_orders.call_args.args
+        self.assertEqual(new_orders, [])
+        self.assertEqual(updated_orders[0]['Id'], 'o1')
+        self.assertEqual(str(updated_orders[0]['amount__c']), '9')
+        self.assertEqual(consumer.order_index.get('u1', 'p1'), ('o1', 9))
+
+    def test_02_stale_index_entries_are_retried_with_fresh_amounts(self):
+        consumer.order_index.put('u1', 'p1', 'o1', 7)
+        results = [[{'id': None, 'success': False, 'errors': ['ENTITY_IS_DELETED']}], [{'id': 'o2', 'success': True, 'errors': []}]]
+        with patch.object(consumer, 'get_orders_user', return_value={}) as get_orders_user, \
+                patch.object(consumer, 'save_orders', side_effect=results) as save_orders:
+            consumer.save_order_lines('u1', '', [{'product_id': 'p1', 'amount': '2'}])
+
+        get_orders_user.assert_called_once_with('u1', ['p1'])
+        new_orders, updated_orders = save_orders.call_args.args
+        self.assertEqual(len(new_orders), 1)
+        self.assertEqual(updated_orders, [])
+        self.assertEqual(consumer.order_index.get('u1', 'p1'), ('o2', 2))
+
+
+if __name__ == "__main__":
+    unittest.main()
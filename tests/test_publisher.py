@@ -159,14 +159,14 @@ class TestPublisher(unittest.TestCase):
         '''
 
         with (
-            patch('src.uuidapi.requests.post') as mock_post,
+            patch('requests.Session.post') as mock_post,
             patch('src.publisher.log', return_value={'success': True, 'message': 'Log successfully added.'})
         ):
             channel: BlockingChannel = self.configure_rabbitMQ()
             mock_post.return_value = mock_masteruuid_response
 
             def run_publisher():
-                with patch('src.uuidapi.requests.post', mock_post), \
+                with patch('requests.Session.post', mock_post), \
                         patch('src.publisher.log', return_value={'success': True, 'message': 'Log successfully added.'}):
                     publisher.handle_change_event(user_object)
 
@@ -271,14 +271,14 @@ class TestPublisher(unittest.TestCase):
         '''
 
         with (
-            patch('src.uuidapi.requests.post') as mock_post,
+            patch('requests.Session.post') as mock_post,
             patch('src.publisher.log', return_value={'success': True, 'message': 'Log successfully added.'})
         ):
             channel: BlockingChannel = self.configure_rabbitMQ()
             mock_post.return_value = mock_masteruuid_response
 
             def run_publisher():
-                with patch('src.uuidapi.requests.post', mock_post), \
+                with patch('requests.Session.post', mock_post), \
                         patch('src.publisher.log', return_value={'success': True, 'message': 'Log successfully added.'}):
                     publisher.handle_change_event(user_object)
 
@@ -383,14 +383,14 @@ class TestPublisher(unittest.TestCase):
         '''
 
         with (
-            patch('src.uuidapi.requests.post') as mock_post,
+            patch('requests.Session.post') as mock_post,
             patch('src.publisher.log', return_value={'success': True, 'message': 'Log successfully added.'})
         ):
             channel: BlockingChannel = self.configure_rabbitMQ()
             mock_post.return_value = mock_masteruuid_response
 
             def run_publisher():
-                with patch('src.uuidapi.requests.post', mock_post), \
+                with patch('requests.Session.post', mock_post), \
                         patch('src.publisher.log', return_value={'success': True, 'message': 'Log successfully added.'}):
                     publisher.handle_change_event(user_object)
 
@@ -488,14 +488,14 @@ class TestPublisher(unittest.TestCase):
         '''
 
         with (
-            patch('src.uuidapi.requests.post') as mock_post,
+            patch('requests.Session.post') as mock_post,
             patch('src.publisher.log', return_value={'success': True, 'message': 'Log successfully added.'})
         ):
             channel: BlockingChannel = self.configure_rabbitMQ()
             mock_post.return_value = mock_masteruuid_response
 
             def run_publisher():
-                with patch('src.uuidapi.requests.post', mock_post), \
+                with patch('requests.Session.post', mock_post), \
                         patch('src.publisher.log', return_value={'success': True, 'message': 'Log successfully added.'}):
                     publisher.handle_change_event(company_object)
 
@@ -589,14 +589,14 @@ class TestPublisher(unittest.TestCase):
         '''
 
         with (
-            patch('src.uuidapi.requests.post') as mock_post,
+            patch('requests.Session.post') as mock_post,
             patch('src.publisher.log', return_value={'success': True, 'message': 'Log successfully added.'})
         ):
             channel: BlockingChannel = self.configure_rabbitMQ()
             mock_post.return_value = mock_masteruuid_response
 
             def run_publisher():
-                with patch('src.uuidapi.requests.post', mock_post), \
+                with patch('requests.Session.post', mock_post), \
                         patch('src.publisher.log', return_value={'success': True, 'message': 'Log successfully added.'}):
                     publisher.handle_change_event(company_object)
 
@@ -690,14 +690,14 @@ class TestPublisher(unittest.TestCase):
         '''
 
         with (
-            patch('src.uuidapi.requests.post') as mock_post,
+            patch('requests.Session.post') as mock_post,
             patch('src.publisher.log', return_value={'success': True, 'message': 'Log successfully added.'})
         ):
             channel: BlockingChannel = self.configure_rabbitMQ()
             mock_post.return_value = mock_masteruuid_response
 
             def run_publisher():
-                with patch('src.uuidapi.requests.post', mock_post), \
+                with patch('requests.Session.post', mock_post), \
                         patch('src.publisher.log', return_value={'success': True, 'message': 'Log successfully added.'}):
                     publisher.handle_change_event(company_object)
 
@@ -793,14 +793,14 @@ class TestPublisher(unittest.TestCase):
         '''
 
         with (
-            patch('src.uuidapi.requests.post') as mock_post,
+            patch('requests.Session.post') as mock_post,
             patch('src.publisher.log', return_value={'success': True, 'message': 'Log successfully added.'})
         ):
             channel: BlockingChannel = self.configure_rabbitMQ()
             mock_post.return_value = mock_masteruuid_response
 
             def run_publisher():
-                with patch('src.uuidapi.requests.post', mock_post), \
+                with patch('requests.Session.post', mock_post), \
                         patch('src.publisher.log', return_value={'success': True, 'message': 'Log successfully added.'}):
                     publisher.handle_change_event(event_object)
 
@@ -891,14 +891,14 @@ class TestPublisher(unittest.TestCase):
         '''
 
         with (
-            patch('src.uuidapi.requests.post') as mock_post,
+            patch('requests.Session.post') as mock_post,
             patch('src.publisher.log', return_value={'success': True, 'message': 'Log successfully added.'})
         ):
             channel: BlockingChannel = self.configure_rabbitMQ()
             mock_post.return_value = mock_masteruuid_response
 
             def run_publisher():
-                with patch('src.uuidapi.requests.post', mock_post), \
+                with patch('requests.Session.post', mock_post), \
                         patch('src.publisher.log', return_value={'success': True, 'message': 'Log successfully added.'}):
                     publisher.handle_change_event(event_object)
 
@@ -989,14 +989,14 @@ class TestPublisher(unittest.TestCase):
         '''
 
         with (
-            patch('src.uuidapi.requests.post') as mock_post,
+            patch('requests.Session.post') as mock_post,
             patch('src.publisher.log', return_value={'success': True, 'message': 'Log successfully added.'})
         ):
             channel: BlockingChannel = self.configure_rabbitMQ()
             mock_post.return_value = mock_masteruuid_response
 
             def run_publisher():
-                with patch('src.uuidapi.requests.post', mock_post), \
+                with patch('requests.Session.post', mock_post), \
                         patch('src.publisher.log', return_value={'success': True, 'message': 'Log successfully added.'}):
                     publisher.handle_change_event(event_object)
 
@@ -1074,14 +1074,14 @@ class TestPublisher(unittest.TestCase):
         '''
 
         with (
-            patch('src.uuidapi.requests.post') as mock_post,
+            patch('requests.Session.post') as mock_post,
             patch('src.publisher.log', return_value={'success': True, 'message': 'Log successfully added.'})
         ):
             channel: BlockingChannel = self.configure_rabbitMQ()
             mock_post.return_value = mock_masteruuid_response
 
             def run_publisher():
-                with patch('src.uuidapi.requests.post', mock_post), \
+                with patch('requests.Session.post', mock_post), \
                         patch('src.publisher.log', return_value={'success': True, 'message': 'Log successfully added.'}):
                     publisher.handle_change_event(attendance_object)
 
@@ -1154,14 +1154,14 @@ class TestPublisher(unittest.TestCase):
         '''
 
         with (
-            patch('src.uuidapi.requests.post') as mock_post,
+            patch('requests.Session.post') as mock_post,
             patch('src.publisher.log', return_value={'success': True, 'message': 'Log successfully added.'})
         ):
             channel: BlockingChannel = self.configure_rabbitMQ()
             mock_post.return_value = mock_masteruuid_response
 
             def run_publisher():
-                with patch('src.uuidapi.requests.post', mock_post), \
+                with patch('requests.Session.post', mock_post), \
                         patch('src.publisher.log', return_value={'success': True, 'message': 'Log successfully added.'}):
                     publisher.handle_change_event(attendance_object)
             
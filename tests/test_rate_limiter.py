@@ -0,0 +1,122 @@
+import asyncio
+import sys
+import threading
+import time
+import unittest
+
+sys.path.append('./')
+from src.rate_limiter import AdaptiveLimiter, AsyncAdaptiveLimiter
+
+
+def limit_info(used, maximum=1000):
+    return f'api-usage={used}/{maximum}'
+
+
+class TestAdaptiveLimiter(unittest.TestCase):
+    def setUp(self):
+        self.limiter = AdaptiveLimiter(budget=0.8, max_concurrency=10, min_concurrency=1, pace=0.2, ramp=0.2)
+
+    def test_01_usage_is_read_from_the_limit_info_header(self):
+        self.limiter.limit = 5
+
+        self.limiter.observe(None)
+        self.limiter.observe('per-app-api-usage=95/100(appName=crm)')
+        self.assertEqual(self.limiter.limit, 5)
+
+        self.limiter.observe('per-app-api-usage=1/100(appName=crm); ' + limit_info(850))
+        self.assertTrue(self.limiter.over_budget)
+        self.assertEqual(self.limiter.limit, 2)
+
+        self.limiter.observe(limit_info(0, 0))
+        self.assertFalse(self.limiter.over_budget)
+        self.assertEqual(self.limiter.limit, 3)
+
+    def test_02_limit_ramps_down_as_usage_nears_the_budget(self):
+        limits, intervals = [], []
+        for used in (500, 600, 650, 700, 750, 790):
+            self.limiter.observe(limit_info(used))
+            limits.append(self.limiter.limit)
+            intervals.append(self.limiter.interval)
+
+        self.assertEqual(limits, [10, 10, 8, 6, 3, 1])
+        self.assertEqual(intervals[:2], [0.0, 0.0])
+        self.assertEqual(intervals, sorted(intervals))
+        self.assertLess(intervals[-1], self.limiter.pace)
+        self.assertFalse(self.limiter.over_budget)
+
+        # Falling back out of the ramp grows the limit one response at a time
+        self.limiter.observe(limit_info(100))
+        self.limiter.observe(limit_info(100))
+        self.assertEqual(self.limiter.limit, 3)
+        self.assertEqual(self.limiter.interval, 0.0)
+
+    def test_03_limit_is_halved_on_every_response_over_the_budget(self):
+        limits = []
+        for _ in range(5):
+            self.limiter.observe(limit_info(900))
+            limits.append(self.limiter.limit)
+
+        self.assertEqual(limits, [5, 2, 1, 1, 1])
+        self.assertEqual(self.limiter.interval, self.limiter.pace)
+
+    def test_04_requests_are_paced_and_capped_at_the_limit(self):
+        self.limiter.observe(limit_info(900))
+        self.limiter.observe(limit_info(900))
+        self.assertEqual(self.limiter.limit, 2)
+
+        started = time.monotonic()
+        acquired = []
+
+        def request():
+            self.limiter.acquire()
+            acquired.append(time.monotonic() - started)
+
+        threads = [threading.Thread(target=request) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.5)
+        self.assertEqual(len(acquired), 2)
+        self.assertEqual(self.limiter.in_flight, 2)
+
+        self.limiter.release()
+        for thread in threads:
+            thread.join(2)
+        self.assertEqual(len(acquired), 3)
+        # Requests are spread one pace apart
+        acquired.sort()
+        self.assertLess(acquired[0], 0.1)
+        self.assertGreaterEqual(acquired[1], 0.2 - 0.01)
+
+
+
+class TestAsyncAdaptiveLimiter(unittest.IsolatedAsyncioTestCase):
+    async def test_01_waiters_get_a_slot_when_one_is_released_without_blocking_a_thread(self):
+        limiter = AsyncAdaptiveLimiter(max_concurrency=2)
+        await limiter.acquire()
+        await limiter.acquire()
+        waiting = [asyncio.create_task(limiter.acquire()) for _ in range(2)]
+        await asyncio.sleep(0.05)
+        self.assertFalse(any(task.done() for task in waiting))
+
+        waiting[0].cancel()
+        limiter.release()
+        await asyncio.wait_for(waiting[1], 1)
+        self.assertTrue(waiting[0].cancelled())
+        self.assertEqual(limiter.in_flight, 2)
+
+    async def test_02_paced_acquires_cancelled_while_waiting_for_their_turn_give_the_slot_back(self):
+        limiter = AsyncAdaptiveLimiter(max_concurrency=10, pace=0.5)
+        limiter.observe(limit_info(900))
+        await limiter.acquire()
+        paced = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0.05)
+        self.assertEqual(limiter.in_flight, 2)
+
+        paced.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await paced
+        self.assertEqual(limiter.in_flight, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+import sys
+import unittest
+from unittest.mock import MagicMock, patch
+
+import requests
+
+sys.path.append('./')
+import src.resilience as resilience
+
+
+class TestResilience(unittest.TestCase):
+    def setUp(self):
+        resilience.breakers.clear()
+        patcher = patch.object(resilience, 'backoff', return_value=0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_01_transient_responses_are_retried_until_success(self):
+        send = MagicMock(side_effect=[MagicMock(status_code=503), MagicMock(status_code=200)])
+
+        response = resilience.call('test', send)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(send.call_count, 2)
+
+    def test_02_non_idempotent_calls_are_not_retried_after_a_read_timeout(self):
+        send = MagicMock(side_effect=requests.ReadTimeout())
+
+        with self.assertRaises(requests.ReadTimeout):
+            resilience.call('test', send, idempotent=False)
+        self.assertEqual(send.call_count, 1)
+
+    def test_03_breaker_opens_after_consecutive_failures(self):
+        send = MagicMock(side_effect=requests.ConnectionError())
+
+        for _ in range(resilience.BREAKER_FAILURE_THRESHOLD):
+            with self.assertRaises(requests.ConnectionError):
+                resilience.call('test', send, attempts=1)
+        with self.assertRaises(resilience.CircuitOpenError):
+            resilience.call('test', send)
+
+        self.assertEqual(send.call_count, resilience.BREAKER_FAILURE_THRESHOLD)
+        self.assertEqual(resilience.get_breaker('test').state, resilience.OPEN)
+
+
+if __name__ == "__main__":
+    unittest.main()
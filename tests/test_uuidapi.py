@@ -0,0 +1,206 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import xml.etree.ElementTree as ET
+from unittest.mock import MagicMock, patch
+
+sys.path.append('./')
+import src.uuidapi as uuidapi
+import src.xml_parser as xml_parser
+from src.uuid_store import UuidStore
+import src.mapping_sync as mapping_sync
+from src.uuid_outbox import MappingOutbox
+
+
+def response(status_code, body):
+    return MagicMock(status_code=status_code, json=MagicMock(return_value=body))
+
+
+class TestUuidApi(unittest.TestCase):
+    def setUp(self):
+        uuidapi.service_ids.clear()
+        uuidapi.master_uuids.clear()
+        uuidapi.store = None
+        uuidapi.resilience.breakers.clear()
+
+    def test_01_lookups_are_cached_in_both_directions(self):
+        with patch('requests.Session.post', return_value=response(200, {'crm': 'a01'})) as mock_post:
+            self.assertEqual(uuidapi.get_service_id('df59f548', 'crm'), 'a01')
+            self.assertEqual(uuidapi.get_service_id('df59f548', 'crm'), 'a01')
+            self.assertEqual(uuidapi.get_master_uuid('a01', 'crm'), 'df59f548')
+
+        self.assertEqual(mock_post.call_count, 1)
+
+    def test_02_deleted_mappings_are_looked_up_again(self):
+        with patch('requests.Session.post', return_value=response(201, {'success': True})) as mock_post:
+            uuidapi.add_service_id('df59f548', 'a01', 'crm')
+            self.assertEqual(uuidapi.get_service_id('df59f548', 'crm'), 'a01')
+
+            uuidapi.delete_service_id('df59f548', 'crm')
+            mock_post.return_value = response(200, {'crm': None})
+            self.assertIsNone(uuidapi.get_service_id('df59f548', 'crm'))
+
+        self.assertEqual(mock_post.call_count, 3)
+
+    def test_03_batch_endpoint_resolves_all_missing_ids_in_one_call(self):
+        uuidapi.remember_mapping('u1', 'a01', 'crm')
+        with patch.object(uuidapi, 'UUID_BATCH_ENDPOINT', 'getServiceIds'), \
+                patch('requests.Session.post', return_value=response(200, {'p1': 'a04', 'p2': None})) as mock_post:
+            resolved = uuidapi.get_service_ids(['u1', 'p1', 'p2', 'p1'], 'crm')
+
+        self.assertEqual(resolved, {'u1': 'a01', 'p1': 'a04', 'p2': None})
+        self.assertEqual(mock_post.call_count, 1)
+        self.assertTrue(mock_post.call_args.args[0].endswith('/getServiceIds'))
+
+    def test_04_without_batch_endpoint_ids_are_resolved_one_by_one(self):
+        with patch('requests.Session.post', side_effect=lambda url, **kwargs: response(200, {'crm': 'sf-' + kwargs['json']['MASTERUUID']})) as mock_post:
+            resolved = uuidapi.get_service_ids(['p1', 'p2'], 'crm')
+
+        self.assertEqual(resolved, {'p1': 'sf-p1', 'p2': 'sf-p2'})
+        self.assertEqual(mock_post.call_count, 2)
+
+    def test_05_order_messages_list_every_referenced_master_uuid(self):
+        root = ET.fromstring('''
+        <order>
+            <routing_key>order.frontend</routing_key>
+            <crud_operation>create</crud_operation>
+            <id>o1</id>
+            <user_id>u1</user_id>
+            <company_id></company_id>
+            <products>
+                <product><product_id> p1 </product_id><amount>2</amount></product>
+                <product><product_id>p2</product_id><amount>1</amount></product>
+                <product><product_id>p1</product_id><amount>1</amount></product>
+            </products>
+        </order>''')
+
+        self.assertEqual(xml_parser.read_xml_master_uuids(root), ['u1', 'p1', 'p2'])
+
+    def test_06_store_is_written_through_and_warms_the_next_process(self):
+        path = os.path.join(tempfile.mkdtemp(), 'uuid_mappings.db')
+        uuidapi.open_store(path)
+        with patch('requests.Session.post', return_value=response(201, {'success': True})):
+            uuidapi.add_service_id('df59f548', 'a01', 'crm')
+            uuidapi.add_service_id('702805f8', 'a02', 'crm')
+            uuidapi.delete_service_id('702805f8', 'crm')
+
+        uuidapi.service_ids.clear()
+        uuidapi.master_uuids.clear()
+        self.assertEqual(uuidapi.open_store(path), 1)
+        with patch('requests.Session.post') as mock_post:
+            self.assertEqual(uuidapi.get_service_id('df59f548', 'crm'), 'a01')
+            self.assertEqual(uuidapi.get_master_uuid('a01', 'crm'), 'df59f548')
+        mock_post.assert_not_called()
+
+    def test_07_reconcile_updates_changed_and_drops_removed_mappings(self):
+        store = UuidStore(os.path.join(tempfile.mkdtemp(), 'uuid_mappings.db'))
+        store.put('u1', 'a01', 'crm')
+        store.put('u2', 'a02', 'crm')
+        store.put('u3', 'a03', 'crm')
+        # Not written to the UUID service yet
+        store.enqueue('u4', 'a04', 'crm')
+        answers = {'u1': response(200, {'crm': 'a01'}), 'u2': response(200, {'crm': 'a09'}), 'u3': response(200, {'crm': None}), 'u4': response(200, {'crm': None})}
+
+        with patch('requests.Session.post', side_effect=lambda url, **kwargs: answers[kwargs['json']['MASTERUUID']]):
+            self.assertEqual(uuidapi.reconcile_store(store, 'crm'), (1, 1))
+
+        self.assertEqual(sorted(store.mappings('crm')), [('u1', 'a01', 'crm'), ('u2', 'a09', 'crm'), ('u4', 'a04', 'crm')])
+        self.assertEqual([row[:3] for row in store.due(10)], [('u4', 'a04', 'crm')])
+
+        store.delete('u4', 'crm')
+        self.assertEqual(store.outbox_size(), 1)
+        store.delete('u4', 'crm', discard_pending=True)
+        self.assertEqual(store.outbox_size(), 0)
+
+    def test_08_concurrent_lookups_of_the_same_id_share_one_request(self):
+        def slow_unmapped(url, **kwargs):
+            time.sleep(0.2)
+            return response(200, {'crm': None})
+
+        results = []
+        with patch('requests.Session.post', side_effect=slow_unmapped) as mock_post:
+            threads = [threading.Thread(target=lambda: results.append(uuidapi.get_service_id('df59f548', 'crm'))) for _ in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(results, [None] * 5)
+        self.assertEqual(mock_post.call_count, 1)
+
+    def test_09_unmapped_answers_are_cached_until_the_mapping_is_added(self):
+        mapped = []
+        uuidapi.add_mapping_listener(lambda master_uuid, service: mapped.append(master_uuid))
+        self.addCleanup(uuidapi.mapping_listeners.clear)
+
+        with patch('requests.Session.post', return_value=response(200, {'crm': None})) as mock_post:
+            self.assertIsNone(uuidapi.get_service_id('df59f548', 'crm'))
+            self.assertEqual(uuidapi.get_service_ids(['df59f548'], 'crm'), {'df59f548': None})
+            self.assertEqual(mock_post.call_count, 1)
+
+            mock_post.return_value = response(201, {'success': True})
+            uuidapi.add_service_id('df59f548', 'a01', 'crm')
+            self.assertEqual(uuidapi.get_service_id('df59f548', 'crm'), 'a01')
+
+        self.assertEqual(mapped, ['df59f548'])
+
+    def test_10_ids_the_service_did_not_answer_for_are_left_out(self):
+        with patch('requests.Session.post', return_value=response(500, {})):
+            self.assertEqual(uuidapi.get_service_ids(['df59f548'], 'crm'), {})
+
+    def test_11_mapping_changes_are_broadcast_and_applied_by_other_processes(self):
+        changes = []
+        uuidapi.add_change_listener(lambda *change: changes.append(change))
+        self.addCleanup(uuidapi.change_listeners.clear)
+        with patch('requests.Session.post', return_value=response(201, {'success': True})):
+            uuidapi.add_service_id('df59f548', 'a01', 'crm')
+            uuidapi.delete_service_id('df59f548', 'crm')
+        self.assertEqual(changes, [('add', 'df59f548', 'a01', 'crm'), ('delete', 'df59f548', 'a01', 'crm')])
+
+        # The sync module runs against the application's own copy of uuidapi
+        caches = mapping_sync.uuidapi
+        caches.service_ids.clear()
+        caches.master_uuids.clear()
+        sync = mapping_sync.MappingSync()
+        sync.apply({'origin': 'other:1', 'action': 'add', 'master_uuid': 'df59f548', 'service_id': 'a01', 'service': 'crm'})
+        self.assertEqual(caches.service_ids.get(('df59f548', 'crm')), 'a01')
+        sync.apply({'origin': mapping_sync.ORIGIN, 'action': 'delete', 'master_uuid': 'df59f548', 'service_id': None, 'service': 'crm'})
+        self.assertEqual(caches.service_ids.get(('df59f548', 'crm')), 'a01')
+        # Only the reverse entry is still cached, the delete carries the service id to drop it by
+        caches.service_ids.delete(('df59f548', 'crm'))
+        sync.apply({'origin': 'other:1', 'action': 'delete', 'master_uuid': 'df59f548', 'service_id': 'a01', 'service': 'crm'})
+        self.assertIs(caches.service_ids.get(('df59f548', 'crm')), caches.MISSING)
+        self.assertIs(caches.master_uuids.get(('a01', 'crm')), caches.MISSING)
+
+    def test_12_outbox_writes_mappings_behind_and_retries_failures(self):
+        store = UuidStore(os.path.join(tempfile.mkdtemp(), 'uuid_mappings.db'))
+        outbox = MappingOutbox(store, flush_interval=60)
+        outbox.stopped.set()
+        outbox.timer.join()
+        outbox.flush_interval = 0
+
+        with patch('requests.Session.post', return_value=response(400, {})) as mock_post:
+            outbox.add('df59f548', 'a01', 'crm')
+            mock_post.assert_not_called()
+            self.assertEqual(mapping_sync.uuidapi.get_service_id('df59f548', 'crm'), 'a01')
+            self.assertEqual(store.get_service_id('df59f548', 'crm'), 'a01')
+
+            self.assertEqual(outbox.flush(), 0)
+            self.assertEqual(store.outbox_size(), 1)
+
+            mock_post.return_value = response(201, {'success': True})
+            self.assertEqual(outbox.flush(), 1)
+            self.assertEqual(store.outbox_size(), 0)
+            self.assertEqual(mock_post.call_args.kwargs['json'], {'MasterUuid': 'df59f548', 'Service': 'crm', 'ServiceId': 'a01'})
+            self.assertEqual(mock_post.call_count, 2)
+
+        outbox.add('702805f8', 'a02', 'crm')
+        store.delete('702805f8', 'crm', discard_pending=True)
+        self.assertEqual(store.outbox_size(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()